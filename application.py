@@ -1,13 +1,11 @@
 import os
 import sys
-import json
 import logging
+import importlib
 from urllib.parse import urlparse
 from flask import Flask, request, redirect, Response, render_template
 from actingweb import config, aw_web_request, actor
-from src import on_aw
-from actingweb.handlers import callbacks, properties, meta, root, trust, devtest, \
-    subscription, resources, oauth, callback_oauth, bot, www, factory
+from src import on_aw, logutil, store, metrics
 # To debug in pycharm inside the Docker container, remember to uncomment import pydevd as well
 # (and add to requirements.txt)
 # import pydevd_pycharm
@@ -22,12 +20,29 @@ app = Flask(__name__, static_url_path='/googlemail/static')
 OBJ_ON_AW = on_aw.OnAWGoogleMail()
 
 
+# Environment variables that get_config() depends on, a change in any of them rebuilds the config
+CONFIG_ENV = ('APP_HOST_FQDN', 'APP_HOST_PROTOCOL', 'APP_BOT_TOKEN', 'APP_BOT_EMAIL', 'APP_BOT_SECRET',
+              'APP_BOT_ADMIN_ROOM', 'APP_OAUTH_ID', 'APP_OAUTH_KEY', 'LOG_LEVEL')
+_CONFIG_CACHE = {}
+
+
 def get_config():
     # Having settrace here will make sure the process reconnects to the debug server on each request
     # which makes it easier to keep in sync when doing code changes
     # pydevd_pycharm.settrace('docker.for.mac.localhost', port=3001, stdoutToServer=True, stderrToServer=True,
     #                        suspend=False)
     #
+    # The config is built once per process and reused until the environment changes
+    key = tuple(os.environ.get(k) for k in CONFIG_ENV)
+    conf = _CONFIG_CACHE.get(key)
+    if conf is None:
+        conf = build_config()
+        _CONFIG_CACHE.clear()
+        _CONFIG_CACHE[key] = conf
+    return conf
+
+
+def build_config():
     # The greger.ngrok.io address will be overriden by env variables from serverless.yml
     myurl = os.getenv('APP_HOST_FQDN', "greger.ngrok.io")
     proto = os.getenv('APP_HOST_PROTOCOL', "https://")
@@ -60,7 +75,7 @@ def get_config():
             'relationship': 'friend',  # associate, friend, partner, admin
         }
     }
-    return config.Config(
+    conf = config.Config(
         database='dynamodb',
         fqdn=myurl,
         proto=proto,
@@ -82,6 +97,8 @@ def get_config():
         },
         oauth=oauth
     )
+    # Writes to properties and meta change the actor's ETag (see src/conditional.py)
+    return store.track_versions(conf)
 
 
 class SimplifyRequest:
@@ -125,17 +142,122 @@ class SimplifyRequest:
             raise AttributeError(key)
 
 
+class FlaskRequest:
+    """ Read-only view of a Flask request with the attributes Handler needs, without copying anything. """
+
+    __slots__ = ('_req',)
+
+    def __init__(self, req):
+        self._req = req
+
+    @property
+    def method(self):
+        return self._req.method
+
+    @property
+    def path(self):
+        return self._req.path
+
+    @property
+    def url(self):
+        return self._req.url
+
+    @property
+    def data(self):
+        return self._req.data
+
+    @property
+    def headers(self):
+        return self._req.headers
+
+    @property
+    def values(self):
+        return self._req.values
+
+    @property
+    def cookies(self):
+        return self._req.cookies
+
+
+# Handler classes by 'module:Class', imported on first use so a cold start only loads what its
+# request needs. Modules are in actingweb.handlers unless the name starts with 'src.'
+_HANDLERS = {}
+
+
+def handler_class(spec):
+    cls = _HANDLERS.get(spec)
+    if cls is None:
+        module, _, name = spec.partition(':')
+        if not module.startswith('src.'):
+            module = 'actingweb.handlers.' + module
+        cls = _HANDLERS[spec] = getattr(importlib.import_module(module), name)
+    return cls
+
+
+# Handlers for /<name>, the empty path ('') is /<actor_id>
+ROOT_ROUTES = {
+    'oauth': lambda w, c: handler_class('callback_oauth:CallbackOauthHandler')(w, c, on_aw=OBJ_ON_AW),
+    'bot': lambda w, c: handler_class('bot:BotHandler')(webobj=w, config=c, on_aw=OBJ_ON_AW),
+    '': lambda w, c: handler_class('root:RootHandler')(w, c, on_aw=OBJ_ON_AW),
+}
+# Handlers for /<actor_id>/<name>/..., indexed by the number of path segments after <name>,
+# the last handler in the list is used for any deeper path
+ACTOR_ROUTES = {
+    # r'/<actor_id>/meta<:/?><path:(.*)>'
+    'meta': ['src.conditional:ConditionalMetaHandler'],
+    # r'/<actor_id>/oauth<:/?><path:.*>'
+    'oauth': ['oauth:OauthHandler'],
+    # r'/<actor_id>/www<:/?><path:(.*)>'
+    'www': ['www:WwwHandler'],
+    # r'/<actor_id>/properties<:/?><name:(.*)>'
+    'properties': ['src.conditional:ConditionalPropertiesHandler'],
+    # r'/<actor_id>/trust<:/?>'
+    # r'/<actor_id>/trust/<relationship><:/?>'
+    # r'/<actor_id>/trust/<relationship>/<peerid><:/?>'
+    'trust': ['trust:TrustHandler', 'trust:TrustRelationshipHandler', 'trust:TrustPeerHandler'],
+    # r'/<actor_id>/subscriptions<:/?>'
+    # r'/<actor_id>/subscriptions/<peerid><:/?>'
+    # r'/<actor_id>/subscriptions/<peerid>/<subid><:/?>'
+    # r'/<actor_id>/subscriptions/<peerid>/<subid>/<seqnr><:/?>'
+    'subscriptions': ['subscription:SubscriptionRootHandler', 'subscription:SubscriptionRelationshipHandler',
+                      'subscription:SubscriptionHandler', 'subscription:SubscriptionDiffHandler'],
+    # r'/<actor_id>/callbacks<:/?><name:(.*)>'
+    'callbacks': ['callbacks:CallbacksHandler'],
+    # r'/<actor_id>/resources<:/?><name:(.*)>'
+    'resources': ['resources:ResourcesHandler'],
+    # r'/<actor_id>/devtest<:/?><path:(.*)>'
+    'devtest': ['devtest:DevtestHandler'],
+}
+
+
+def route(path):
+    """
+    Find the handler factory for a path split on '/'.
+    :return: Tuple of (actor_id or None, callable(webobj, config) -> handler, or None if no route)
+    """
+    if path[1] in ('oauth', 'bot'):
+        return None, ROOT_ROUTES[path[1]]
+    if len(path) == 2:
+        return None, ROOT_ROUTES['']
+    handlers = ACTOR_ROUTES.get(path[2])
+    if not handlers:
+        return path[1], None
+    cls = handler_class(handlers[min(len(path) - 3, len(handlers) - 1)])
+    return path[1], lambda w, c: cls(w, c, on_aw=OBJ_ON_AW)
+
+
 class Handler:
 
     def __init__(self, req):
-        req = SimplifyRequest(req)
+        if isinstance(req, dict):
+            req = SimplifyRequest(req)
+        else:
+            req = FlaskRequest(req)
         self.handler = None
         self.response = None
         self.actor_id = None
         self.path = req.path
         self.method = req.method
-        LOG.debug('Path: ' + req.url + ', params(' + json.dumps(req.values) + ')' + ', body (' +
-                  json.dumps(req.data.decode('utf-8')) + ')')
         self.webobj = aw_web_request.AWWebObj(
             url=req.url,
             params=req.values,
@@ -146,82 +268,15 @@ class Handler:
         if not req or not self.path:
             return
         if self.path == '/':
-            self.handler = factory.RootFactoryHandler(
+            self.handler = handler_class('factory:RootFactoryHandler')(
                 self.webobj, get_config(), on_aw=OBJ_ON_AW)
         else:
-            path = self.path.split('/')
-            self.path = path
-            f = path[1]
-            if f == 'oauth':
-                self.handler = callback_oauth.CallbackOauthHandler(
-                    self.webobj, get_config(), on_aw=OBJ_ON_AW)
-            elif f == 'bot':
-                self.handler = bot.BotHandler(
-                    webobj=self.webobj, config=get_config(), on_aw=OBJ_ON_AW)
-            elif len(path) == 2:
-                self.handler = root.RootHandler(
-                    self.webobj, get_config(), on_aw=OBJ_ON_AW)
-            else:
-                self.actor_id = f
-                f = path[2]
-                if f == 'meta':
-                    # r'/<actor_id>/meta<:/?><path:(.*)>'
-                    self.handler = meta.MetaHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'oauth':
-                    # r'/<actor_id>/oauth<:/?><path:.*>'
-                    self.handler = oauth.OauthHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'www':
-                    # r'/<actor_id>/www<:/?><path:(.*)>'
-                    self.handler = www.WwwHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'properties':
-                    # r'/<actor_id>/properties<:/?><name:(.*)>'
-                    self.handler = properties.PropertiesHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'trust':
-                    # r'/<actor_id>/trust<:/?>'
-                    # r'/<actor_id>/trust/<relationship><:/?>'
-                    # r'/<actor_id>/trust/<relationship>/<peerid><:/?>'
-                    if len(path) == 3:
-                        self.handler = trust.TrustHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                    elif len(path) == 4:
-                        self.handler = trust.TrustRelationshipHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                    elif len(path) >= 5:
-                        self.handler = trust.TrustPeerHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'subscriptions':
-                    # r'/<actor_id>/subscriptions<:/?>'
-                    # r'/<actor_id>/subscriptions/<peerid><:/?>'
-                    # r'/<actor_id>/subscriptions/<peerid>/<subid><:/?>'
-                    # r'/<actor_id>/subscriptions/<peerid>/<subid>/<seqnr><:/?>'
-                    if len(path) == 3:
-                        self.handler = subscription.SubscriptionRootHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                    elif len(path) == 4:
-                        self.handler = subscription.SubscriptionRelationshipHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                    elif len(path) == 5:
-                        self.handler = subscription.SubscriptionHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                    elif len(path) >= 6:
-                        self.handler = subscription.SubscriptionDiffHandler(
-                            self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'callbacks':
-                    # r'/<actor_id>/callbacks<:/?><name:(.*)>'
-                    self.handler = callbacks.CallbacksHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'resources':
-                    # r'/<actor_id>/resources<:/?><name:(.*)>'
-                    self.handler = resources.ResourcesHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
-                elif f == 'devtest':
-                    # r'/<actor_id>/devtest<:/?><path:(.*)>'
-                    self.handler = devtest.DevtestHandler(
-                        self.webobj, get_config(), on_aw=OBJ_ON_AW)
+            self.path = self.path.split('/')
+            self.actor_id, make = route(self.path)
+            if make:
+                self.handler = make(self.webobj, get_config())
+        logutil.trace(self.actor_id, 'Path: %s, params(%s), body (%s)', req.url,
+                      logutil.LazyJson(lambda: dict(req.values)), logutil.LazyText(req.data))
         if not self.handler:
             LOG.warning('Handler was not set with path: ' + req.url)
 
@@ -256,6 +311,11 @@ class Handler:
                 headers=self.webobj.response.headers
             )
             self.response.status_code = self.webobj.response.status_code
+            etag = getattr(self.handler, 'etag', None)
+            if etag:
+                self.response.headers['ETag'] = etag
+                if self.handler.last_modified:
+                    self.response.headers['Last-Modified'] = self.handler.last_modified
         if len(self.webobj.response.cookies) > 0:
             for a in self.webobj.response.cookies:
                 self.response.set_cookie(a["name"], a["value"], max_age=a["max_age"], secure=a["secure"])
@@ -422,6 +482,23 @@ def app_oauth_callback():
     return h.get_response()
 
 
+@app.route('/metrics', methods=['GET'], strict_slashes=False)
+def app_metrics():
+    # The series carry actor ids, so they are not served to anyone who asks
+    if metrics.METRICS_TOKEN:
+        if request.headers.get('Authorization') != 'Bearer ' + metrics.METRICS_TOKEN:
+            return Response(status=401)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return Response(status=403)
+    return Response(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.after_request
+def flush_metrics(response):
+    metrics.REGISTRY.maybe_flush()
+    return response
+
+
 @app.route('/google91d73b3ba8074162.html', methods=['GET'], strict_slashes=False)
 def app_google_verify():
     return Response("google-site-verification: google91d73b3ba8074162.html")
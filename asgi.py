@@ -0,0 +1,251 @@
+"""
+ASGI entry point, next to the WSGI app in application.py:
+
+    pip install uvicorn httpx
+    uvicorn asgi:app --workers 2 --root-path /googlemail
+
+Gmail pushes (POST /<actor_id>/callbacks/messages) are handled on the event loop. actingweb's
+callbacks handler (authentication, parsing, the duplicate check) runs in a worker thread, then the
+history run awaits its Gmail calls through src.aio, so one worker holds hundreds of callbacks that
+are waiting on Gmail. A push is still answered after its messages are published, as on the WSGI
+path, so Pub/Sub redelivers it if processing fails. Every other request, and all pushes with
+GMAIL_CALLBACK_MODE=async, go to the Flask app in a worker thread.
+"""
+import sys
+import asyncio
+import logging
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import Headers
+from actingweb import aw_web_request
+import application
+from src import aio, codec, dedup, logutil, metrics, on_aw, store, gmail
+
+_STATS = {'pushes': 0, 'in_flight': 0, 'max_in_flight': 0, 'errors': 0, 'waited': 0, 'stale': 0}
+metrics.collector('asgi', lambda: dict(_STATS))
+# actor id -> [asyncio.Lock, pushes holding or waiting for it]
+_RUNS = {}
+
+
+class DeferredPush(on_aw.OnAWGoogleMail):
+    """ Keeps the push that OnAWGoogleMail would process, for the event loop to process instead. """
+
+    def __init__(self):
+        super().__init__()
+        self.push = None
+
+    def process_push(self, data):
+        self.push = data
+
+
+@metrics.timed('asgi.handle_history')
+async def handle_history(myself, agm, pages):
+    """ on_aw.handle_history() for an aio.AsyncGMail history run. """
+    gm = agm.gm
+    run = None
+    try:
+        async for h in pages:
+            logutil.trace(myself.id, 'Publishing %d new messages: %s', len(h), logutil.LazyJson(h))
+            payload = await aio.run_sync(on_aw.publish, myself, h)
+            if payload is None:
+                continue
+            run = on_aw.DIFFS.merge(run, payload)
+            gm.uow.set_property('new', codec.dumps(run))
+    finally:
+        await aio.run_sync(on_aw.DIFFS.end_run, myself.id)
+    if gm.watch_expires_in() < 3 * 24 * 3600:
+        logging.debug('Less than 3 x 24h to gmail watch expiry, refreshing...')
+        await agm.set_up(refresh=True)
+
+
+@metrics.timed('asgi.process_push')
+async def process_push(hook, data):
+    """
+    OnAWGoogleMail.process_push() on the event loop. Pushes for the same actor take turns, else each
+    would walk the same history and fetch the same messages. A push that waited is often covered by
+    the run before it and dropped like a duplicate.
+    """
+    actor_id = hook.myself.id
+    run = _RUNS.get(actor_id)
+    if run is None:
+        run = _RUNS[actor_id] = [asyncio.Lock(), 0]
+    run[1] += 1
+    try:
+        if run[0].locked():
+            _update('waited', 1)
+        async with run[0]:
+            payload = gmail.parse_notification(data)
+            if payload and dedup.WATERMARKS.is_stale(actor_id, int(payload.get('historyId'))):
+                _update('stale', 1)
+                return
+            await _process(hook, data)
+    finally:
+        run[1] -= 1
+        if not run[1]:
+            del _RUNS[actor_id]
+
+
+async def _process(hook, data):
+    uow = store.UnitOfWork(hook.myself)
+    try:
+        gm = await aio.run_sync(gmail.GMail, hook.myself, hook.config, hook.auth, uow=uow)
+        agm = aio.AsyncGMail(gm)
+        await handle_history(hook.myself, agm, agm.iter_callback(data))
+    except BaseException:
+        uow.discard()
+        raise
+    await aio.run_sync(uow.flush)
+
+
+def _callbacks(actor_id, url, query, body, headers):
+    """
+    actingweb's POST /<actor_id>/callbacks/messages up to the history run.
+    :return: (actingweb response, the DeferredPush holding the push to process, if any)
+    """
+    webobj = aw_web_request.AWWebObj(url=url, params=dict(parse_qsl(query)), body=body, headers=headers,
+                                     cookies={})
+    hook = DeferredPush()
+    handler = application.handler_class('callbacks:CallbacksHandler')(webobj, application.get_config(), on_aw=hook)
+    handler.post(actor_id=actor_id, name='messages')
+    return webobj.response, hook
+
+
+def _update(key, n):
+    _STATS[key] += n
+    if key == 'in_flight' and _STATS[key] > _STATS['max_in_flight']:
+        _STATS['max_in_flight'] = _STATS[key]
+
+
+async def _push(scope, actor_id, body):
+    _update('pushes', 1)
+    _update('in_flight', 1)
+    try:
+        headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope.get('headers', [])])
+        res, hook = await aio.run_sync(_callbacks, actor_id, _url(scope, headers), _query(scope), body, headers)
+        if hook.push is not None:
+            await process_push(hook, hook.push)
+    except Exception:
+        _update('errors', 1)
+        logging.exception('Not able to process google callback for ' + actor_id)
+        return 500, [(b'content-length', b'0')], b''
+    finally:
+        _update('in_flight', -1)
+        metrics.REGISTRY.maybe_flush()
+    if res.status_code == 404:
+        # As the Flask routes answer a 404 from a handler
+        return 404, [(b'content-length', b'0'), (b'content-type', b'text/html; charset=utf-8')], b''
+    content = res.body or b''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    out = [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in res.headers.items()]
+    out.append((b'content-length', str(len(content)).encode('latin-1')))
+    if not any(k == b'content-type' for k, _ in out):
+        out.append((b'content-type', b'text/html; charset=utf-8'))
+    return res.status_code, out, content
+
+
+def _path(scope):
+    """ The request path below root_path. """
+    root = scope.get('root_path', '')
+    path = scope['path']
+    if root and path.startswith(root):
+        path = path[len(root):]
+    return path or '/'
+
+
+def _query(scope):
+    return scope.get('query_string', b'').decode('latin-1')
+
+
+def _url(scope, headers):
+    server = scope.get('server') or ('localhost', 80)
+    host = headers.get('Host') or '%s:%s' % server
+    query = _query(scope)
+    return scope.get('scheme', 'http') + '://' + host + scope.get('root_path', '') + _path(scope) + (
+        '?' + query if query else '')
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': _path(scope).encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': _query(scope),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def _wsgi(scope, body):
+    """ Run a request through the Flask app, returns (status, headers, body). """
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    res = application.app(_environ(scope, body), start_response)
+    try:
+        content = b''.join(res)
+    finally:
+        if hasattr(res, 'close'):
+            res.close()
+    status, headers = started
+    return int(status.split()[0]), [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers], content
+
+
+async def _body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aio.ASYNC_TRANSPORT.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    body = await _body(receive)
+    path = _path(scope).split('/')
+    if scope['method'] == 'POST' and len(path) == 4 and path[2:] == ['callbacks', 'messages'] and \
+            on_aw.CALLBACK_MODE == 'sync':
+        status, headers, content = await _push(scope, path[1], body)
+    else:
+        status, headers, content = await aio.run_sync(_wsgi, scope, body)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': content})
@@ -0,0 +1,96 @@
+"""
+Minimal HTTP/1.1 server for an ASGI app, so bench.load can run asgi.app where uvicorn is not
+installed. One request per connection, Content-Length request bodies only, the response is written
+when the app is done. Enough for the load harness, use uvicorn to serve the app for real.
+"""
+import asyncio
+import logging
+import threading
+from http import HTTPStatus
+from urllib.parse import unquote
+
+
+class ASGIServer:
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """ Serve on an event loop in a daemon thread, returns self once listening. """
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self._server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='asgi-server', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self._server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = []
+        length = 0
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            headers.append((name.encode('latin-1'), value.encode('latin-1')))
+            if name == 'content-length':
+                length = int(value)
+        body = await reader.readexactly(length) if length else b''
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version.split('/')[-1],
+            'method': method, 'scheme': 'http', 'path': unquote(path), 'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'), 'root_path': '', 'headers': headers,
+            'server': (self.host, self.port), 'client': writer.get_extra_info('peername')[:2],
+        }
+        received = []
+        response = []
+
+        async def receive():
+            if received:
+                # Nothing more will come, the connection closes after the response
+                await asyncio.Future()
+            received.append(True)
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            response.append(message)
+
+        try:
+            await self.app(scope, receive, send)
+            start = response[0]
+            out = ['HTTP/1.1 %d %s' % (start['status'], HTTPStatus(start['status']).phrase)]
+            out.extend(k.decode('latin-1') + ': ' + v.decode('latin-1') for k, v in start.get('headers', []))
+            out.append('connection: close')
+            writer.write(('\r\n'.join(out) + '\r\n\r\n').encode('latin-1'))
+            writer.write(b''.join(m.get('body', b'') for m in response[1:]))
+            await writer.drain()
+        except Exception:
+            logging.exception('ASGI request ' + method + ' ' + target + ' failed')
+        finally:
+            writer.close()
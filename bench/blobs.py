@@ -0,0 +1,78 @@
+"""
+Memory of 'raw' and 'full' message fetches with large attachments, inline (GMAIL_BLOBS=false) and
+streamed into blobs (src.blobs, 'full' with GMAIL_FULL_BODIES=true), against the fake Gmail server
+in a subprocess. Peak is the Python heap (tracemalloc) while a page of messages is fetched and
+encoded for publishing, blobs are read but not kept (see bench.common.MemoryBlobStore).
+
+    python -m bench.blobs --messages 10 --attachment-mb 4 --distinct 2
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from bench.fake_gmail import Mailbox
+from bench.common import gmail_for, MemoryBlobStore
+from src import blobs, codec, transport
+
+
+def run(server, fmt, streamed, ids):
+    blobs.BLOBS = blobs.FULL_BODIES = streamed
+    gm = gmail_for(server, config=json.dumps({'msgFormat': fmt}))
+    store = gm._blobs = MemoryBlobStore()
+    before = blobs.stats()
+    tracemalloc.start()
+    start = time.perf_counter()
+    msgs = gm.get_messages(ids)
+    published = len(codec.dumps(msgs))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(msgs) == len(ids) and all(m.get('id') for m in msgs.values())
+    after = blobs.stats()
+    return {
+        'format': fmt,
+        'mode': 'streamed' if streamed else 'inline',
+        'messages': len(msgs),
+        'seconds': round(elapsed, 3),
+        'peak_mb': round(peak / 1024 / 1024, 2),
+        'published_bytes': published,
+        'spills': {k: after[k] - before[k] for k in ('values', 'spilled', 'on_disk', 'bytes_spilled')},
+        'distinct_blobs': len(store.blobs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10)
+    parser.add_argument('--attachment-mb', type=float, default=4)
+    parser.add_argument('--distinct', type=int, default=2, help='Distinct attachments, the others are repeats')
+    parser.add_argument('--formats', default='raw,full')
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    # In its own process, so its allocations do not count
+    proc = subprocess.Popen([sys.executable, '-m', 'bench.fake_gmail', '--port', '0', '--messages', str(args.messages),
+                             '--latency', str(args.latency), '--attachment-kb', str(int(args.attachment_mb * 1024)),
+                             '--distinct-attachments', str(args.distinct)], stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    results = []
+    try:
+        # gmail_for() reads the url and the first history id
+        server = SimpleNamespace(url=proc.stdout.readline().split()[-1], mailbox=Mailbox(messages=0))
+        transport.TRANSPORT = transport.TRANSPORT or transport.GmailTransport()
+        ids = [Mailbox.message_id(n) for n in range(args.messages)]
+        for fmt in args.formats.split(','):
+            for streamed in (False, True):
+                results.append(run(server, fmt, streamed, ids))
+    finally:
+        proc.terminate()
+        proc.wait()
+    print(json.dumps({'attachment_mb': args.attachment_mb, 'distinct_attachments': args.distinct,
+                      'runs': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
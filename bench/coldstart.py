@@ -0,0 +1,73 @@
+"""
+Cold-start regression check. Imports the app in fresh interpreters, like a new Lambda container,
+and resolves the handler for a Gmail push. Exits with 1 if:
+- a module that should only load on demand (Pub/Sub, gRPC, handlers other than callbacks) is imported
+- the median import time is above --max-ms
+- the median import time is more than --tolerance above the --baseline saved with --save
+
+    python -m bench.coldstart --runs 7 --max-ms 800
+    python -m bench.coldstart --save coldstart.json
+    python -m bench.coldstart --baseline coldstart.json --tolerance 0.25
+"""
+import argparse
+import json
+import statistics
+import sys
+
+from src import importtime
+
+# Loaded on first use only, none of them is needed to handle a Gmail push
+DEFERRED = ('google.cloud.pubsub_v1', 'google.api_core', 'grpc', 'actingweb.handlers.trust',
+            'actingweb.handlers.subscription', 'actingweb.handlers.www', 'actingweb.handlers.devtest',
+            'actingweb.handlers.factory', 'actingweb.handlers.properties', 'src.conditional')
+# Import the app and resolve the handler for POST /<actor_id>/callbacks/messages
+FIRST_PUSH = "import application; application.route(['', 'x', 'callbacks', 'messages'])"
+
+
+def deferred_loaded(rows):
+    """ The DEFERRED modules (or packages) that were imported. """
+    names = set(r[0] for r in rows)
+    return [d for d in DEFERRED if any(n == d or n.startswith(d + '.') for n in names)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--max-ms', type=float, help='Fail if the median import time is above this')
+    parser.add_argument('--baseline', help='Fail if the median is more than --tolerance above this saved result')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--save', help='Write the result to this file, for use as --baseline')
+    args = parser.parse_args()
+    totals = []
+    rows = []
+    for _ in range(args.runs):
+        rows = importtime.profile(code=FIRST_PUSH)
+        totals.append(sum(r[1] for r in rows) / 1000.0)
+    median = statistics.median(totals)
+    summary = importtime.report(rows, top=10)
+    out = {'runs': args.runs, 'median_ms': round(median, 1), 'min_ms': round(min(totals), 1),
+           'max_ms': round(max(totals), 1), 'modules': summary['modules'],
+           'deferred_loaded': deferred_loaded(rows), 'top_cumulative_ms': summary['top_cumulative_ms']}
+    failures = []
+    if out['deferred_loaded']:
+        failures.append('modules that should load on demand were imported: ' + ', '.join(out['deferred_loaded']))
+    if args.max_ms and median > args.max_ms:
+        failures.append('median import time %.1f ms is above %.1f ms' % (median, args.max_ms))
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)['median_ms']
+        out['baseline_ms'] = base
+        if median > base * (1 + args.tolerance):
+            failures.append('median import time %.1f ms is more than %d%% above the baseline %.1f ms' % (
+                median, args.tolerance * 100, base))
+    out['failures'] = failures
+    print(json.dumps(out, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(out, f, indent=2)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Minimal stand-ins for the actingweb actor and auth objects, so GMail can be driven
+against bench.fake_gmail without a datastore or a real OAuth token.
+"""
+import json
+import urllib.request
+import urllib.error
+
+from src import blobs, store
+
+
+class Attributes:
+    """ Mimics actor.property / actor.store: unset attributes read as None. """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, key):
+        return None
+
+
+class FakeActor:
+
+    def __init__(self, actor_id='bench', creator='bench@example.com', subscribers=0, **props):
+        self.id = actor_id
+        self.creator = creator
+        self.config = None
+        self.property = Attributes(**props)
+        self.store = Attributes()
+        self.diffs = []
+        self.subscriptions = [{'peerid': 'peer%d' % n, 'subscriptionid': 'sub%d' % n, 'target': 'properties',
+                               'subtarget': 'new', 'resource': None} for n in range(subscribers)]
+
+    def register_diffs(self, target=None, subtarget=None, blob=None):
+        self.diffs.append((target, subtarget, blob))
+
+    def get_subscriptions(self, target=None, subtarget=None, resource=None, callback=False):
+        return list(self.subscriptions)
+
+
+class MemoryUnitOfWork(store.UnitOfWork):
+    """ Unit of work that keeps everything on the fake actor. """
+
+    def __init__(self, me):
+        super().__init__(me, defer=True)
+
+    def load(self, names=store.GMAIL_PROPERTIES):
+        pass
+
+    def _write(self, model, items):
+        pass
+
+    def flush(self):
+        self.discard()
+
+
+class FakeOAuth:
+
+    def __init__(self):
+        self.last_response_code = 0
+
+
+class FakeAuth:
+
+    def __init__(self, token='bench-token'):
+        self.token = token
+        self.oauth = FakeOAuth()
+        self.calls = 0
+
+    def _request(self, url, method='GET', params=None):
+        self.calls += 1
+        data = None
+        headers = {'Authorization': 'Bearer ' + self.token}
+        if params is not None:
+            data = json.dumps(params).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(url, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as res:
+                self.oauth.last_response_code = res.status
+                body = res.read()
+        except urllib.error.HTTPError as e:
+            self.oauth.last_response_code = e.code
+            return None
+        if not body:
+            return {}
+        return json.loads(body.decode('utf-8'))
+
+    def oauth_get(self, url=None, params=None):
+        return self._request(url)
+
+    def oauth_post(self, url=None, params=None):
+        return self._request(url, method='POST', params=params or {})
+
+
+def percentile(values, p):
+    """ The p (0-1) percentile of values, 0.0 for no values. """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+class MemoryBlobStore:
+    """ Mimics src.blobs.BlobStore: reads stored blobs chunk by chunk, but keeps only their sizes. """
+
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, spill):
+        if spill.sha256 not in self.blobs:
+            size = 0
+            while True:
+                chunk = spill.file.read(blobs.BLOB_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+            self.blobs[spill.sha256] = size
+        return {'blob': spill.sha256, 'size': spill.size}
+
+
+class FakeConfig:
+    root = 'http://127.0.0.1/'
+
+
+def gmail_for(server, **props):
+    """ Return a GMail object pointed at a running FakeGmailServer. """
+    from src import gmail
+    gmail.GMAIL_URL = server.url + '/gmail/v1/users/'
+    gmail.GMAIL_BATCH_URL = server.url + '/batch/gmail/v1'
+    props.setdefault('historyId', str(server.mailbox.first_history_id))
+    me = FakeActor(**props)
+    me.store.pubsub_topic = 'projects/bench/topics/mail-bench'
+    me.store.pubsub_subscription = 'projects/bench/subscriptions/mail-bench'
+    return gmail.GMail(me, FakeConfig(), FakeAuth(), uow=MemoryUnitOfWork(me))
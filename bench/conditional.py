@@ -0,0 +1,65 @@
+"""
+Polling /<actor_id>/properties with and without If-None-Match: 304 hit rate, DynamoDB calls and
+latency per poll, with a property write every --write-every polls (not counted).
+
+    docker-compose up -d dynamodb
+    AWS_DB_HOST=http://localhost:8000 AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x python -m bench.conditional
+"""
+import argparse
+import base64
+import json
+import os
+import time
+
+from actingweb import actor
+import application
+from src import conditional, store
+
+
+def poll(client, config, me, headers, polls, write_every, conditional_get):
+    tag = None
+    codes = {}
+    elapsed = 0.0
+    calls = 0
+    for n in range(polls):
+        if n % write_every == 0:
+            with store.UnitOfWork(actor.Actor(me.id, config=config)) as uow:
+                uow.set_property('new', json.dumps({'poll': n}))
+        h = dict(headers)
+        if conditional_get and tag:
+            h['If-None-Match'] = tag
+        start = time.perf_counter()
+        with store.count_ops(config) as counter:
+            r = client.get('/' + me.id + '/properties', headers=h)
+        elapsed += time.perf_counter() - start
+        calls += counter.total
+        tag = r.headers.get('ETag') or tag
+        codes[r.status_code] = codes.get(r.status_code, 0) + 1
+    return {'conditional': conditional_get, 'polls': polls, 'status': codes,
+            'ms_per_poll': round(elapsed * 1000 / polls, 2),
+            'dynamodb_calls_per_poll': round(calls / polls, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--polls', type=int, default=200)
+    parser.add_argument('--write-every', type=int, default=10, help='Polls between property writes')
+    args = parser.parse_args()
+    if not os.getenv('AWS_DB_HOST'):
+        raise SystemExit('Set AWS_DB_HOST to a DynamoDB Local endpoint')
+    config = application.get_config()
+    me = actor.Actor(config=config)
+    me.create(url=config.root, creator='bench@example.com', passphrase='bench')
+    me.property.new = json.dumps({})
+    headers = {'Authorization': 'Basic ' + base64.b64encode(b'bench@example.com:bench').decode('utf-8')}
+    client = application.app.test_client()
+    try:
+        for conditional_get in (False, True):
+            print(json.dumps(poll(client, config, me, headers, args.polls, args.write_every, conditional_get)))
+        print(json.dumps(conditional.STATS.as_dict()))
+    finally:
+        me.delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+DynamoDB operations for one callback (load GMail, fetch history, publish) with write-through
+property/store access versus the batched unit of work.
+
+Keep --messages small: property values are also keys in the property-index GSI, which DynamoDB
+caps at 2048 bytes.
+
+    docker-compose up -d dynamodb
+    AWS_DB_HOST=http://localhost:8000 AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x python -m bench.datastore
+"""
+import argparse
+import json
+import os
+
+from actingweb import actor
+import application
+from bench.fake_gmail import FakeGmailServer
+from bench.common import FakeAuth
+from src import codec, gmail, store
+
+
+def callback(me, config, server, uow):
+    gm = gmail.GMail(me, config, FakeAuth(), uow=uow)
+    h = gm.sync(server.mailbox.history_id)
+    if h:
+        gm.uow.set_property('new', codec.dumps(h))
+
+
+def run(config, server, batched):
+    me = actor.Actor(config=config)
+    me.create(url=config.root, creator=server.email, passphrase=config.new_token())
+    me.property.historyId = str(server.mailbox.first_history_id)
+    me = actor.Actor(me.id, config=config)
+    with store.count_ops(config) as counter:
+        if batched:
+            with store.UnitOfWork(me) as uow:
+                callback(me, config, server, uow)
+        else:
+            callback(me, config, server, None)
+    me.delete()
+    return dict(counter.calls, total=counter.total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=2)
+    args = parser.parse_args()
+    if not os.getenv('AWS_DB_HOST'):
+        raise SystemExit('Set AWS_DB_HOST to a DynamoDB Local endpoint')
+    server = FakeGmailServer(messages=args.messages).start()
+    try:
+        gmail.GMAIL_URL = server.url + '/gmail/v1/users/'
+        config = application.get_config()
+        print(json.dumps({'write_through': run(config, server, False), 'unit_of_work': run(config, server, True)}))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Diffs and subscriber deliveries for a busy mailbox with and without windowed diff merging.
+
+Simulates --pushes Gmail pushes for one actor, --interval seconds apart, each with 1-3 history
+pages, and counts the register_diffs() calls and subscriber deliveries for each window.
+
+    python -m bench.diffs --pushes 200 --interval 0.01 --subscribers 5 --windows 0,0.1,0.5
+"""
+import argparse
+import json
+import random
+import time
+
+from bench.common import FakeActor
+from src import diffs
+
+
+def run(window, pushes, interval, subscribers, seed=1):
+    rnd = random.Random(seed)
+    me = FakeActor(subscribers=subscribers)
+    agg = diffs.DiffAggregator(merge=diffs.merge_pointers, window=window)
+    cursor = -1
+    pages = 0
+    for _ in range(pushes):
+        for _ in range(rnd.randint(1, 3)):
+            count = rnd.randint(1, 20)
+            agg.add(me, {'since': str(cursor), 'cursor': str(cursor + count), 'count': count}, messages=count)
+            cursor += count
+            pages += 1
+        agg.end_run(me.id)
+        time.sleep(interval)
+    agg.flush()
+    covered = sum(json.loads(blob)['count'] for _, _, blob in me.diffs)
+    stats = agg.stats()
+    return {
+        'window': window,
+        'pages': pages,
+        'diffs': len(me.diffs),
+        'deliveries': len(me.diffs) * subscribers,
+        'deliveries_unmerged': pages * subscribers,
+        'messages_covered': covered == cursor + 1,
+        'in_order': all(int(json.loads(a[2])['cursor']) == int(json.loads(b[2])['since'])
+                        for a, b in zip(me.diffs, me.diffs[1:])),
+        'stats': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pushes', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01)
+    parser.add_argument('--subscribers', type=int, default=5)
+    parser.add_argument('--windows', default='0,0.1,0.5')
+    args = parser.parse_args()
+    for w in args.windows.split(','):
+        print(run(float(w), args.pushes, args.interval, args.subscribers))
+
+
+if __name__ == '__main__':
+    main()
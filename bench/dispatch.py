@@ -0,0 +1,72 @@
+"""
+Publish synthetic Gmail notifications to the shared topic on the Pub/Sub emulator and measure
+how fast the streaming-pull dispatcher routes them to actors.
+
+    docker-compose up -d pubsub
+    PUBSUB_EMULATOR_HOST=localhost:8085 python -m bench.dispatch --actors 100 --notifications 5000
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from google.cloud import pubsub_v1 as pubsub
+from src import gmail, dispatcher
+
+
+class StaticIndex:
+
+    def __init__(self, actors):
+        self.actors = {'user%d@example.com' % n: 'actor%d' % n for n in range(actors)}
+
+    def lookup(self, email):
+        return self.actors.get(email)
+
+    def forget(self, email):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actors', type=int, default=100)
+    parser.add_argument('--notifications', type=int, default=5000)
+    parser.add_argument('--process-latency', type=float, default=0.01)
+    args = parser.parse_args()
+    if not os.getenv('PUBSUB_EMULATOR_HOST'):
+        raise SystemExit('Set PUBSUB_EMULATOR_HOST, this benchmark only runs against the emulator')
+    subscriber = dispatcher.ensure_shared_pubsub()
+    processed = []
+    lock = threading.Lock()
+
+    def process(actor_id, history_id, config):
+        time.sleep(args.process_latency)
+        with lock:
+            processed.append((actor_id, history_id))
+
+    d = dispatcher.Dispatcher(config=None, process=process, index=StaticIndex(args.actors))
+    d.start(subscriber)
+    publisher = pubsub.PublisherClient()
+    start = time.perf_counter()
+    futures = []
+    for n in range(args.notifications):
+        data = json.dumps({'emailAddress': 'user%d@example.com' % (n % args.actors), 'historyId': 1000 + n})
+        futures.append(publisher.publish(gmail.GMAIL_SHARED_TOPIC, data.encode('utf-8')))
+    for f in futures:
+        f.result()
+    while d.received < args.notifications:
+        time.sleep(0.05)
+    time.sleep(dispatcher.DISPATCH_BATCH_WAIT * 2)
+    elapsed = time.perf_counter() - start
+    d.stop()
+    stats = d.stats()
+    stats.update({
+        'seconds': round(elapsed, 3),
+        'notifications_per_sec': round(args.notifications / elapsed, 1),
+        'history_runs': len(processed),
+    })
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+"""
+Local stand-in for the Gmail REST API, used by the benchmarks in this directory.
+
+Serves a synthetic mailbox under /gmail/v1/users/me/ and the /batch/gmail/v1 endpoint,
+with a configurable per-request latency to mimic the round trip to Google. Mailboxes added with
+add_mailbox() are served to the requests carrying their access token, everything else gets the
+default mailbox. A mailbox with attachment_size set gives each message a text body and an
+attachment, served in 'full' (parts, attachments from messages.attachments.get) and 'raw' (a MIME
+message) format. With tls=True it
+serves HTTPS with a throwaway self-signed certificate (needs the openssl command), and it
+gzips responses for clients that ask for it.
+
+    python -m bench.fake_gmail --port 8086 --messages 1000 --latency 0.05
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from src import batch
+
+PREFIX = '/gmail/v1/users/me/'
+HEADERS = ['To', 'From', 'Subject', 'Date', 'Content-Type', 'X-Mailer', 'Received', 'DKIM-Signature']
+SYSTEM_LABELS = ['INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH',
+                 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES']
+USER_LABELS = {'Label_%d' % n: name
+               for n, name in enumerate(['Work', 'Family', 'Receipts', 'Travel', 'Newsletters'], 1)}
+
+
+def parse_fields(mask):
+    """ Parse a partial response mask ('a,b/c,d(e,f)') into a nested dict, None marks a full field. """
+    tree = {}
+    stack = [tree]
+    name = ''
+
+    def flush():
+        node = stack[-1]
+        parts = [p for p in name.split('/') if p]
+        for p in parts[:-1]:
+            node = node.setdefault(p, {})
+        if parts:
+            node.setdefault(parts[-1], None)
+        return node, parts
+
+    for c in mask:
+        if c == ',':
+            flush()
+            name = ''
+        elif c == '(':
+            node, parts = flush()
+            child = node.get(parts[-1]) or {}
+            node[parts[-1]] = child
+            stack.append(child)
+            name = ''
+        elif c == ')':
+            flush()
+            stack.pop()
+            name = ''
+        else:
+            name += c
+    flush()
+    return tree
+
+
+def apply_fields(data, tree):
+    if tree is None:
+        return data
+    if isinstance(data, list):
+        return [apply_fields(d, tree) for d in data]
+    if not isinstance(data, dict):
+        return data
+    return {k: apply_fields(data[k], sub) for k, sub in tree.items() if k in data}
+
+
+class Mailbox:
+
+    def __init__(self, messages=1000, first_history_id=1000, page_size=100, email=None, attachment_size=0,
+                 distinct_attachments=1):
+        """
+        :param attachment_size: Bytes of the attachment every message has, 0 for messages without a body
+        :param distinct_attachments: Message n has attachment n % distinct_attachments, the rest are repeats
+        """
+        self.first_history_id = first_history_id
+        self.email = email
+        self.attachment_size = attachment_size
+        self.distinct_attachments = max(1, distinct_attachments)
+        self._attachments = {}
+        # History before this id has expired, me/history answers 404 (see expire_history())
+        self.history_floor = first_history_id
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.order = []
+        for _ in range(messages):
+            self.add()
+
+    @property
+    def history_id(self):
+        return self.first_history_id + len(self.order)
+
+    @staticmethod
+    def message_id(n):
+        return '%016x' % (0x170000000000 + n)
+
+    @staticmethod
+    def message_number(mid):
+        return int(mid, 16) - 0x170000000000
+
+    def add(self, labels=None):
+        with self.lock:
+            n = len(self.order)
+            mid = self.message_id(n)
+            self.messages[mid] = {
+                'id': mid,
+                'threadId': mid,
+                'labelIds': labels or ['INBOX', 'UNREAD'],
+                'snippet': 'Synthetic message %d' % n,
+                'historyId': str(self.first_history_id + n + 1),
+                'internalDate': str(1500000000000 + n),
+                'sizeEstimate': 2048,
+                'payload': {
+                    'mimeType': 'text/plain',
+                    'headers': [{'name': h, 'value': '%s value %d' % (h, n)} for h in HEADERS],
+                },
+            }
+            self.order.append(mid)
+            return mid
+
+    def deliver(self, count=1, labels=None):
+        """ Add count new messages, returns the new history id. """
+        for _ in range(count):
+            self.add(labels=labels)
+        return self.history_id
+
+    def message(self, mid, fmt='full'):
+        """ The message as Gmail returns it in format fmt, before any fields mask. """
+        msg = self.messages.get(mid)
+        if not msg or not self.attachment_size or fmt in ('metadata', 'minimal'):
+            return msg
+        n = self.message_number(mid)
+        text = ('Body of synthetic message %d\r\n' % n).encode('utf-8')
+        name = 'file-%d.bin' % (n % self.distinct_attachments)
+        if fmt == 'raw':
+            mime = ''.join('%s: %s\r\n' % (h['name'], h['value']) for h in msg['payload']['headers']
+                           if h['name'] != 'Content-Type')
+            mime += 'MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="b"\r\n\r\n--b\r\n' \
+                    'Content-Type: text/plain\r\n\r\n' + text.decode('utf-8') + '\r\n--b\r\n' \
+                    'Content-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n' \
+                    'Content-Disposition: attachment; filename="' + name + '"\r\n\r\n'
+            data = base64.encodebytes(self.attachment(n)).replace(b'\n', b'\r\n')
+            raw = mime.encode('utf-8') + data + b'--b--\r\n'
+            return dict(msg, raw=base64.urlsafe_b64encode(raw).decode('ascii'), sizeEstimate=len(raw))
+        parts = [
+            {'partId': '0', 'mimeType': 'text/plain', 'filename': '',
+             'headers': [{'name': 'Content-Type', 'value': 'text/plain'}],
+             'body': {'size': len(text), 'data': base64.urlsafe_b64encode(text).decode('ascii')}},
+            {'partId': '1', 'mimeType': 'application/octet-stream', 'filename': name,
+             'headers': [{'name': 'Content-Type', 'value': 'application/octet-stream'}],
+             'body': {'attachmentId': 'att-' + mid, 'size': self.attachment_size}},
+        ]
+        return dict(msg, payload=dict(msg['payload'], partId='', mimeType='multipart/mixed', filename='',
+                                      body={'size': 0}, parts=parts))
+
+    def attachment(self, n):
+        """ The (random, but the same for every run) attachment bytes of message n. """
+        k = n % self.distinct_attachments
+        with self.lock:
+            data = self._attachments.get(k)
+            if data is None:
+                size = self.attachment_size
+                data = self._attachments[k] = random.Random(k).getrandbits(size * 8).to_bytes(size, 'little')
+        return data
+
+    def expire_history(self):
+        """ Drop all history up to now, like Gmail does after a week or so. """
+        self.history_floor = self.history_id
+
+    def list(self, page_token=None, max_results=100, label=None):
+        """ messages.list, newest first. """
+        ids = self.order[::-1] if not label else [i for i in self.order[::-1] if label in self.messages[i]['labelIds']]
+        offset = int(page_token) if page_token else 0
+        res = {'messages': [{'id': i, 'threadId': i} for i in ids[offset:offset + max_results]],
+               'resultSizeEstimate': len(ids)}
+        if offset + max_results < len(ids):
+            res['nextPageToken'] = str(offset + max_results)
+        if not res['messages']:
+            del res['messages']
+        return res
+
+    def history(self, start, page_token=None, label=None):
+        if start < self.history_floor:
+            return None
+        offset = int(page_token) if page_token else start - self.first_history_id
+        ids = self.order[offset:offset + self.page_size]
+        if label:
+            ids = [i for i in ids if label in self.messages[i]['labelIds']]
+        res = {
+            'historyId': str(self.history_id),
+            'history': [{
+                'id': str(self.first_history_id + offset + n + 1),
+                'messagesAdded': [{'message': {
+                    'id': mid,
+                    'threadId': mid,
+                    'labelIds': self.messages[mid]['labelIds']}}]
+            } for n, mid in enumerate(ids)]
+        }
+        if offset + self.page_size < len(self.order):
+            res['nextPageToken'] = str(offset + self.page_size)
+        if not res['history']:
+            del res['history']
+        return res
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batch_parts = 0
+        self.connections = 0
+        # Requests by endpoint, a batch counts once as 'batch' and once per part
+        self.calls = {}
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def count(self, parts=0, endpoint=None):
+        with self.lock:
+            self.requests += 1
+            self.batch_parts += parts
+            if endpoint:
+                self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def count_part(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.batch_parts = 0
+            self.connections = 0
+            self.calls = {}
+
+    def as_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'batch_parts': self.batch_parts, 'connections': self.connections,
+                    'calls': dict(self.calls)}
+
+
+def endpoint(path):
+    """ Short name of the Gmail endpoint a path is for, e.g. 'history' or 'messages.get'. """
+    if path.startswith('/batch/'):
+        return 'batch'
+    rest = path[len(PREFIX):] if path.startswith(PREFIX) else path
+    if rest.startswith('messages/') and '/attachments/' in rest:
+        return 'messages.attachments.get'
+    if rest.startswith('messages/'):
+        return 'messages.get'
+    return rest or 'unknown'
+
+
+def self_signed_cert(directory):
+    """ Write a certificate and key for 127.0.0.1 to directory, returns (cert path, key path). """
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj',
+                    '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+class FakeGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, without this delayed ACKs add ~40 ms per keep-alive call
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stats.connected()
+
+    def _send(self, code, body=b'', content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, code, data):
+        self._send(code, json.dumps(data).encode('utf-8'))
+
+    def _mailbox(self):
+        auth = self.headers.get('Authorization', '')
+        return self.server.mailboxes.get(auth[len('Bearer '):], self.server.mailbox)
+
+    def _route(self, box, path, query):
+        if not path.startswith(PREFIX):
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        rest = path[len(PREFIX):]
+        if rest == 'profile':
+            return 200, {'emailAddress': box.email or self.server.email, 'messagesTotal': len(box.order),
+                         'threadsTotal': len(box.order), 'historyId': str(box.history_id)}
+        if rest == 'labels':
+            return 200, self._project({'labels': [{'id': l, 'name': l, 'type': 'system'} for l in SYSTEM_LABELS] + [
+                {'id': k, 'name': v, 'type': 'user'} for k, v in sorted(USER_LABELS.items())]}, query)
+        if rest == 'history':
+            res = box.history(int(query.get('startHistoryId', ['0'])[0]), query.get('pageToken', [None])[0],
+                              label=query.get('labelId', [None])[0])
+            if res is None:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            return 200, self._project(res, query)
+        if rest == 'messages':
+            return 200, self._project(box.list(query.get('pageToken', [None])[0],
+                                               min(int(query.get('maxResults', ['100'])[0]), 500),
+                                               label=query.get('labelIds', [None])[0]), query)
+        if rest.startswith('messages/') and '/attachments/' in rest:
+            mid, _, aid = rest[len('messages/'):].partition('/attachments/')
+            if not box.attachment_size or not box.message(mid) or aid != 'att-' + mid:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+            data = box.attachment(box.message_number(mid))
+            return 200, {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode('ascii')}
+        if rest.startswith('messages/'):
+            fmt = query.get('format', ['full'])[0]
+            msg = box.message(rest[len('messages/'):], fmt=fmt)
+            if not msg:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+            if fmt == 'metadata' and query.get('metadataHeaders'):
+                keep = set(query['metadataHeaders'])
+                msg = dict(msg, payload=dict(msg['payload'], headers=[
+                    h for h in msg['payload']['headers'] if h['name'] in keep]))
+            return 200, self._project(msg, query)
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    @staticmethod
+    def _project(data, query):
+        if 'fields' not in query:
+            return data
+        return apply_fields(data, parse_fields(query['fields'][0]))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.stats.count(endpoint=endpoint(url.path))
+        time.sleep(self.server.latency)
+        code, data = self._route(self._mailbox(), url.path, parse_qs(url.query))
+        self._json(code, data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        url = urlparse(self.path)
+        if url.path.startswith('/batch/'):
+            self._batch(body)
+            return
+        self.server.stats.count(endpoint=endpoint(url.path))
+        time.sleep(self.server.latency)
+        if url.path == PREFIX + 'watch':
+            self._json(200, {'historyId': str(self._mailbox().history_id),
+                             'expiration': str(int((time.time() + 7 * 24 * 3600) * 1000))})
+        elif url.path == PREFIX + 'stop':
+            self._send(204)
+        else:
+            self._json(404, {'error': {'code': 404, 'message': 'Not Found'}})
+
+    def _batch(self, body):
+        boundary = batch._boundary(self.headers.get('Content-Type'))
+        parts = []
+        for part in body.decode('utf-8').split('--' + (boundary or '')):
+            part = part.strip('\r\n')
+            if not part or part == '--':
+                continue
+            head, http = batch._split_head(part)
+            cid = ''
+            for line in head.splitlines():
+                k, _, v = line.partition(':')
+                if k.strip().lower() == 'content-id':
+                    cid = v.strip().strip('<>')
+            request_line = http.strip().splitlines()[0].split()
+            parts.append((cid, request_line[1]))
+        if len(parts) > batch.BATCH_LIMIT:
+            self._json(400, {'error': {'code': 400, 'message': 'Too many requests in batch'}})
+            return
+        self.server.stats.count(parts=len(parts), endpoint='batch')
+        time.sleep(self.server.latency)
+        box = self._mailbox()
+        out = []
+        boundary = 'batch_fake_response'
+        for cid, path in parts:
+            url = urlparse(path)
+            self.server.stats.count_part(endpoint(url.path))
+            code, data = self._route(box, url.path, parse_qs(url.query))
+            out.extend([
+                '--' + boundary,
+                'Content-Type: application/http',
+                'Content-ID: <response-' + cid + '>',
+                '',
+                'HTTP/1.1 %d %s' % (code, 'OK' if code == 200 else 'Error'),
+                'Content-Type: application/json; charset=UTF-8',
+                '',
+                json.dumps(data),
+            ])
+        out.extend(['--' + boundary + '--', ''])
+        self._send(200, '\r\n'.join(out).encode('utf-8'), 'multipart/mixed; boundary=' + boundary)
+
+
+class FakeGmailServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, messages=1000, latency=0.0, email='bench@example.com', tls=False, attachment_size=0,
+                 distinct_attachments=1):
+        super().__init__(('127.0.0.1', port), FakeGmailHandler)
+        self.mailbox = Mailbox(messages=messages, attachment_size=attachment_size,
+                               distinct_attachments=distinct_attachments)
+        self.mailboxes = {}
+        self.latency = latency
+        self.email = email
+        self.stats = Stats()
+        self._thread = None
+        self.cert = None
+        if tls:
+            self._tmp = tempfile.TemporaryDirectory()
+            self.cert, key = self_signed_cert(self._tmp.name)
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(self.cert, key)
+            # The handshake runs in the handler thread, on the first read
+            self.socket = ctx.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+    def add_mailbox(self, token, messages=0, email=None, attachment_size=0, distinct_attachments=1):
+        """ Serve a new mailbox to requests with access token token. """
+        box = self.mailboxes[token] = Mailbox(messages=messages, email=email, attachment_size=attachment_size,
+                                              distinct_attachments=distinct_attachments)
+        return box
+
+    @property
+    def url(self):
+        return ('https' if self.cert else 'http') + '://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Gmail REST server')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every request')
+    parser.add_argument('--attachment-kb', type=int, default=0, help='Attachment size of every message')
+    parser.add_argument('--distinct-attachments', type=int, default=1)
+    args = parser.parse_args()
+    server = FakeGmailServer(port=args.port, messages=args.messages, latency=args.latency,
+                             attachment_size=args.attachment_kb * 1024, distinct_attachments=args.distinct_attachments)
+    print('Fake Gmail listening on ' + server.url, flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compare serial, batched and concurrent message fetching against the fake Gmail server.
+
+    python -m bench.fetch --messages 200 --latency 0.05
+"""
+import argparse
+import time
+
+from bench.fake_gmail import FakeGmailServer
+from bench.common import gmail_for
+from src import gmail
+
+
+def run(server, mode, ids):
+    gmail.GMAIL_FETCH_MODE = mode
+    gm = gmail_for(server)
+    server.stats.reset()
+    start = time.perf_counter()
+    msgs = gm.get_messages(ids)
+    elapsed = time.perf_counter() - start
+    assert len(msgs) == len(ids) and all(m.get('id') for m in msgs.values())
+    return {
+        'mode': mode,
+        'messages': len(msgs),
+        'seconds': round(elapsed, 3),
+        'msgs_per_sec': round(len(msgs) / elapsed, 1),
+        'latency_per_msg_ms': round(elapsed * 1000 / len(msgs), 2),
+        'http_requests': server.stats.requests,
+        'fetch_stats': gm.fetch_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--modes', default='serial,batch,concurrent')
+    args = parser.parse_args()
+    server = FakeGmailServer(messages=args.messages, latency=args.latency).start()
+    try:
+        ids = list(server.mailbox.order)
+        for mode in args.modes.split(','):
+            print(run(server, mode, ids))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
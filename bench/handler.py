@@ -0,0 +1,60 @@
+"""
+Requests per second through request dispatch (config, request adapter, handler lookup) for
+POST /<actor_id>/callbacks/messages, before and after the cached config and route table.
+
+    python -m bench.handler --requests 20000
+"""
+import argparse
+import json
+import time
+
+import application
+from actingweb import aw_web_request
+from actingweb.handlers import callbacks
+
+BODY = json.dumps({'message': {'data': 'eyJlbWFpbEFkZHJlc3MiOiAiYkBleGFtcGxlLmNvbSIsICJoaXN0b3J5SWQiOiAxMjM0fQ==',
+                               'messageId': '1'}, 'subscription': 'projects/x/subscriptions/mail-x'})
+
+
+def legacy(req):
+    """ Dispatch as Handler.__init__ did before: copy the request, build a new config, walk the path. """
+    req = application.SimplifyRequest({
+        'method': req.method, 'path': req.path, 'data': req.data, 'url': req.url,
+        'headers': {k: v for k, v in req.headers.items()},
+        'cookies': {k: v for k, v in req.cookies.items()},
+        'values': {k: v for k, v in req.values.items()},
+    })
+    webobj = aw_web_request.AWWebObj(url=req.url, params=req.values, body=req.data, headers=req.headers,
+                                     cookies=req.cookies)
+    path = req.path.split('/')
+    if path[1] not in ('oauth', 'bot') and len(path) > 2 and path[2] == 'callbacks':
+        return callbacks.CallbacksHandler(webobj, application.build_config(), on_aw=application.OBJ_ON_AW)
+
+
+def fast(req):
+    return application.Handler(req).handler
+
+
+def run(fn, n):
+    with application.app.test_request_context('/0123456789abcdef/callbacks/messages', method='POST', data=BODY,
+                                              headers={'Content-Type': 'application/json'}):
+        from flask import request
+        assert fn(request) is not None
+        start = time.perf_counter()
+        for _ in range(n):
+            fn(request)
+        return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+    before = run(legacy, args.requests)
+    after = run(fast, args.requests)
+    print(json.dumps({'requests': args.requests, 'before_rps': round(before), 'after_rps': round(after),
+                      'speedup': round(after / before, 2)}))
+
+
+if __name__ == '__main__':
+    main()
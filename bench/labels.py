@@ -0,0 +1,117 @@
+"""
+Label filtering over large synthetic history pages: the old per-message list walk against the
+compiled rules in src/labels.py, plus label name resolution through the cached labels.list.
+
+    python -m bench.labels --records 100000
+"""
+import argparse
+import random
+import time
+
+from bench.fake_gmail import FakeGmailServer, SYSTEM_LABELS, USER_LABELS
+from bench.common import gmail_for
+from src import labels
+
+CONFIG = {
+    'watchLabels': ['INBOX', 'Label_1', 'Label_3'],
+    'nonWatchLabels': ['SENT', 'DRAFT', 'SPAM'],
+    'labelRule': {'not': {'all': ['CATEGORY_PROMOTIONS', 'UNREAD']}},
+}
+
+
+def legacy(myconf, records):
+    """ The label filter as it was in GMail.get_history (only ever looks at the first label). """
+    msgs = {}
+    for h in records:
+        for k, v in h.items():
+            if k != 'messagesAdded':
+                continue
+            for i in v:
+                found = False
+                if not myconf.get('watchLabels'):
+                    found = True
+                else:
+                    for l in i['message']['labelIds']:
+                        if l in myconf.get('watchLabels'):
+                            found = True
+                        break
+                if myconf.get('nonWatchLabels'):
+                    for l in i['message']['labelIds']:
+                        if l in myconf.get('nonWatchLabels'):
+                            found = False
+                        break
+                if found:
+                    msgs[i['message']['id']] = {}
+    return list(msgs)
+
+
+def naive(myconf, records):
+    """ Same rules as the compiled engine, evaluated with list walks for every message. """
+    msgs = {}
+    for h in records:
+        for i in h.get('messagesAdded') or []:
+            ids = i['message']['labelIds']
+            if myconf.get('watchLabels') and not any(l in myconf.get('watchLabels') for l in ids):
+                continue
+            if any(l in myconf.get('nonWatchLabels') for l in ids):
+                continue
+            if 'CATEGORY_PROMOTIONS' in ids and 'UNREAD' in ids:
+                continue
+            msgs[i['message']['id']] = {}
+    return list(msgs)
+
+
+def synthetic_records(count, seed=1):
+    rnd = random.Random(seed)
+    pool = SYSTEM_LABELS + sorted(USER_LABELS)
+    return [{'id': str(1000 + n), 'messagesAdded': [{'message': {
+        'id': '%016x' % n, 'threadId': '%016x' % n, 'labelIds': rnd.sample(pool, rnd.randint(1, 5))}}]}
+        for n in range(count)]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--actors', type=int, default=100, help='GMail objects resolving label names')
+    args = parser.parse_args()
+    records = synthetic_records(args.records)
+    pages = [records[i:i + args.page_size] for i in range(0, len(records), args.page_size)]
+
+    compile_start = time.perf_counter()
+    rules = labels.compile(CONFIG)
+    compile_ms = (time.perf_counter() - compile_start) * 1000
+    results = {}
+    for name, fn in (('legacy', lambda p: legacy(CONFIG, p)),
+                     ('naive', lambda p: naive(CONFIG, p)),
+                     ('compiled', rules.select)):
+        selected, elapsed = timed(lambda: [m for p in pages for m in fn(p)])
+        results[name] = selected
+        print({'filter': name, 'records': len(records), 'selected': len(selected),
+               'seconds': round(elapsed, 3), 'records_per_sec': round(len(records) / elapsed)})
+    print({'compile_ms': round(compile_ms, 3), 'compiled_matches_naive': results['compiled'] == results['naive'],
+           'legacy_wrong': len(set(results['legacy']) ^ set(results['naive']))})
+
+    # Label names are resolved once per actor and TTL, not per request
+    server = FakeGmailServer(messages=1).start()
+    try:
+        conf = dict(CONFIG, watchLabels=['INBOX', 'Work', 'Travel'])
+        server.stats.reset()
+        for _ in range(args.actors):
+            gm = gmail_for(server, config=None)
+            gm.my_config(**conf)
+            gm.label_rules()
+        print({'name_resolution': sorted(gm.label_rules().include), 'gmail_objects': args.actors,
+               'labels_list_calls': server.stats.requests, 'cache_hits': labels.CACHE.hits})
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""
+End-to-end load test: Gmail push notifications through the whole app (HTTP server, request
+dispatch, actingweb auth, DynamoDB and the Gmail calls) against bench.fake_gmail.
+
+Creates --actors actors through the factory (POST /), each with its own fake mailbox. Then for
+--seconds, --rate times a second, it delivers --messages new messages to a random actor's mailbox
+and sends the Pub/Sub push for them to /<actor_id>/callbacks/messages. Latency runs from when a
+push was due to when the app has answered it, so a saturated app shows up as latency and not as
+a lower send rate. With --pubsub the notifications are published to the actors' topics on the
+Pub/Sub emulator, which pushes them to the app (--app-host must be reachable from the emulator).
+With GMAIL_CALLBACK_MODE=async the app answers before it fetches, latency is then the time to ack
+and caught_up_actors shows whether the workers kept up.
+
+--server asgi serves asgi.app (on bench.asgi_server) instead of the Flask app, compare it with the
+Flask app limited to as many requests at once as uwsgi runs (processes x threads):
+
+    ... python -m bench.load --threads 4 --latency 0.1 --rate 50
+    ... python -m bench.load --server asgi --latency 0.1 --rate 50
+
+Prints, and with --output writes, one JSON document: throughput, latency percentiles, Gmail calls
+and DynamoDB operations per notification.
+
+    docker-compose up -d dynamodb pubsub
+    AWS_DB_HOST=http://localhost:8000 AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x \\
+        python -m bench.load --actors 20 --rate 20 --seconds 30 --output load.json
+    PUBSUB_EMULATOR_HOST=localhost:8085 ... python -m bench.load --pubsub --app-host host.docker.internal
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from werkzeug.serving import make_server
+
+from actingweb import actor, auth
+import application
+from bench.asgi_server import ASGIServer
+from bench.common import percentile
+from bench.fake_gmail import FakeGmailServer
+from src import gmail, on_aw, pubsub_clients, store, tokens, transport
+
+
+class Recorder:
+    """ WSGI middleware timing the pushes to /<actor_id>/callbacks/messages. """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        # (actor id, history id) -> epoch seconds the notification was due or published
+        self.due = {}
+        self.latencies = []
+        self.status = {}
+        self.redelivered = 0
+        self.last = 0.0
+
+    def expect(self, actor_id, history_id, at):
+        with self.lock:
+            self.due[(actor_id, history_id)] = at
+
+    def pending(self):
+        with self.lock:
+            return len(self.due)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if environ.get('REQUEST_METHOD') != 'POST' or not path.endswith('/callbacks/messages'):
+            return self.app(environ, start_response)
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        environ['wsgi.input'] = BytesIO(body)
+        codes = []
+
+        def capture(status, headers, exc_info=None):
+            codes.append(int(status.split()[0]))
+            return start_response(status, headers, exc_info)
+
+        try:
+            return list(self.app(environ, capture))
+        finally:
+            self._done(path.split('/')[1], body, codes[0] if codes else 500)
+
+    def _done(self, actor_id, body, code):
+        now = time.time()
+        try:
+            payload = gmail.parse_notification(json.loads(body.decode('utf-8')))
+        except ValueError:
+            payload = None
+        key = (actor_id, int(payload['historyId'])) if payload else None
+        with self.lock:
+            self.status[code] = self.status.get(code, 0) + 1
+            at = self.due.pop(key, None)
+            if at is None:
+                self.redelivered += 1
+                return
+            self.latencies.append(now - at)
+            self.last = max(self.last, now)
+
+
+    def asgi(self, app):
+        """ The same recording around an ASGI app. """
+
+        async def recorded(scope, receive, send):
+            path = scope.get('path', '')
+            if scope['type'] != 'http' or scope['method'] != 'POST' or not path.endswith('/callbacks/messages'):
+                return await app(scope, receive, send)
+            chunks = []
+            codes = []
+
+            async def receive_body():
+                message = await receive()
+                chunks.append(message.get('body', b''))
+                return message
+
+            async def capture(message):
+                if message['type'] == 'http.response.start':
+                    codes.append(message['status'])
+                await send(message)
+
+            try:
+                await app(scope, receive_body, capture)
+            finally:
+                self._done(path.split('/')[1], b''.join(chunks), codes[0] if codes else 500)
+
+        return recorded
+
+
+class Bounded:
+    """ WSGI middleware running at most n requests at once, like uwsgi with n = processes x threads. """
+
+    def __init__(self, app, n):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(n)
+
+    def __call__(self, environ, start_response):
+        with self.slots:
+            return list(self.app(environ, start_response))
+
+
+class LoadActor:
+
+    def __init__(self, actor_id, email, mailbox):
+        self.id = actor_id
+        self.email = email
+        self.mailbox = mailbox
+        self.topic = 'projects/' + gmail.GMAIL_PROJECT + '/topics/mail-' + actor_id
+        self.subscription = 'projects/' + gmail.GMAIL_PROJECT + '/subscriptions/mail-' + actor_id
+
+
+def post_json(url, data):
+    req = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'), method='POST',
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=60) as res:
+        body = res.read()
+    return json.loads(body.decode('utf-8')) if body else None
+
+
+def create_actor(config, server, n, backlog, pubsub):
+    """ Create an actor through the factory and connect it to a new fake mailbox, like after OAuth. """
+    email = 'load%d@example.com' % n
+    actor_id = post_json(config.root, {'creator': email, 'passphrase': config.new_token()})['id']
+    token = 'load-' + config.new_token()
+    box = server.add_mailbox(token, messages=backlog, email=email)
+    la = LoadActor(actor_id, email, box)
+    expiry = str(time.time() + 24 * 3600)
+    store.save_store(config, actor_id, {'oauth_token': token, 'oauth_token_expiry': expiry,
+                                        'oauth_refresh_token': 'load-refresh', 'oauth_refresh_token_expiry': expiry})
+    me = actor.Actor(actor_id, config=config)
+    with store.UnitOfWork(me) as uow:
+        gm = gmail.GMail(me, config, auth.Auth(actor_id, auth_type='oauth', config=config), uow=uow)
+        if pubsub:
+            gm.set_up(refresh=True)
+        else:
+            uow.set_store('pubsub_topic', la.topic)
+            uow.set_store('pubsub_subscription', la.subscription)
+            gm.topic = la.topic
+            gm.create_watch(refresh=True)
+    return la
+
+
+def notification(la, history_id):
+    return json.dumps({'emailAddress': la.email, 'historyId': history_id}).encode('utf-8')
+
+
+def push(config, la, history_id, n):
+    """ POST the body Pub/Sub would push for a Gmail notification. """
+    data = {'message': {'data': base64.b64encode(notification(la, history_id)).decode('utf-8'),
+                        'messageId': str(n), 'publishTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+            'subscription': la.subscription}
+    try:
+        post_json(config.root + la.id + '/callbacks/messages', data)
+    except urllib.error.HTTPError:
+        # Counted by the recorder
+        pass
+    except (urllib.error.URLError, OSError) as e:
+        logging.warning('Push to ' + la.id + ' failed: ' + str(e))
+
+
+def caught_up(config, actors):
+    """ Actors whose stored historyId has reached their mailbox. """
+    done = 0
+    for la in actors:
+        me = actor.Actor(la.id, config=config)
+        if me.property.historyId and int(me.property.historyId) >= la.mailbox.history_id:
+            done += 1
+    return done
+
+
+def run(args, config, server, recorder, actors):
+    total = int(args.rate * args.seconds)
+    pool = ThreadPoolExecutor(max_workers=args.concurrency)
+    publisher = pubsub_clients.publisher() if args.pubsub else None
+    server.stats.reset()
+    start = time.time()
+    with store.count_ops(config) as ops:
+        for n in range(total):
+            due = start + n / args.rate
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            la = random.choice(actors)
+            history_id = la.mailbox.deliver(args.messages)
+            recorder.expect(la.id, history_id, due)
+            if publisher:
+                publisher.publish(la.topic, notification(la, history_id))
+            else:
+                pool.submit(push, config, la, history_id, n)
+        pool.shutdown(wait=True)
+        end = time.time() + args.drain
+        while recorder.pending() and time.time() < end:
+            time.sleep(0.05)
+        if on_aw.CALLBACK_MODE == 'async':
+            on_aw.CALLBACK_QUEUE.drain(timeout=max(0.0, end - time.time()))
+        elapsed = (recorder.last or time.time()) - start
+    handled = len(recorder.latencies)
+    per = float(handled or 1)
+    gmail_stats = server.stats.as_dict()
+    return {
+        'notifications': {'sent': total, 'handled': handled, 'lost': recorder.pending(),
+                          'redelivered': recorder.redelivered, 'status': recorder.status},
+        'throughput_per_sec': round(handled / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {k: round(percentile(recorder.latencies, p) * 1000, 1)
+                       for k, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+        'gmail_calls_per_notification': round(gmail_stats['requests'] / per, 2),
+        'gmail_batch_parts_per_notification': round(gmail_stats['batch_parts'] / per, 2),
+        'gmail_calls': gmail_stats['calls'],
+        'dynamodb_ops_per_notification': round(ops.total / per, 2),
+        'dynamodb_ops': dict(ops.calls),
+        'caught_up_actors': caught_up(config, actors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=20.0, help='Notifications per second')
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--messages', type=int, default=1, help='New messages per notification')
+    parser.add_argument('--backlog', type=int, default=10, help='Messages in each mailbox before the run')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every Gmail request')
+    parser.add_argument('--concurrency', type=int, default=32, help='Pushes in flight at most')
+    parser.add_argument('--drain', type=float, default=30.0, help='Seconds to wait for outstanding pushes')
+    parser.add_argument('--pubsub', action='store_true', help='Send the notifications through the Pub/Sub emulator')
+    parser.add_argument('--app-host', default='127.0.0.1', help='Host the app is reached at')
+    parser.add_argument('--app-port', type=int, default=0)
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask',
+                        help='Serve the Flask app (threaded werkzeug server) or asgi.app')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='With --server flask, requests handled at once at most (0: no limit)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Also write the JSON result to this file')
+    args = parser.parse_args()
+    if not os.getenv('AWS_DB_HOST'):
+        raise SystemExit('Set AWS_DB_HOST to a DynamoDB Local endpoint')
+    if args.pubsub and not os.getenv('PUBSUB_EMULATOR_HOST'):
+        raise SystemExit('Set PUBSUB_EMULATOR_HOST to the Pub/Sub emulator')
+    random.seed(args.seed)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = FakeGmailServer(messages=0, latency=args.latency).start()
+    gmail.GMAIL_URL = server.url + '/gmail/v1/users/'
+    gmail.GMAIL_BATCH_URL = server.url + '/batch/gmail/v1'
+    bind = '127.0.0.1' if args.app_host == '127.0.0.1' else '0.0.0.0'
+    if args.server == 'asgi':
+        # Imported here, the Flask runs should not load it
+        import asgi
+        from src import aio
+        recorder = Recorder(None)
+        app_server = ASGIServer(recorder.asgi(asgi.app), host=bind, port=args.app_port).start()
+        port = app_server.port
+        stop_app = app_server.stop
+        server_settings = {'aio_client': aio.ASYNC_TRANSPORT.mode, 'aio_threads': aio.AIO_THREADS}
+    else:
+        recorder = Recorder(application.app.wsgi_app)
+        application.app.wsgi_app = Bounded(recorder, args.threads) if args.threads else recorder
+        app_server = make_server(bind, args.app_port, application.app, threaded=True)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        port = app_server.server_port
+        stop_app = app_server.shutdown
+        server_settings = {'threads': args.threads or None}
+    # The config root, and so the factory and push endpoint, point at this server
+    os.environ['APP_HOST_FQDN'] = '%s:%d' % (args.app_host, port)
+    os.environ['APP_HOST_PROTOCOL'] = 'http://'
+    config = application.get_config()
+    actors = []
+    try:
+        for n in range(args.actors):
+            actors.append(create_actor(config, server, n, args.backlog, args.pubsub))
+        out = {
+            'settings': {'actors': args.actors, 'rate': args.rate, 'seconds': args.seconds,
+                         'messages': args.messages, 'gmail_latency': args.latency,
+                         'push': 'pubsub' if args.pubsub else 'direct', 'callback_mode': on_aw.CALLBACK_MODE,
+                         'fetch_mode': gmail.GMAIL_FETCH_MODE, 'transport': transport.GMAIL_TRANSPORT,
+                         'server': args.server, **server_settings},
+            'result': run(args, config, server, recorder, actors),
+            'tokens': tokens.MANAGER.as_dict(),
+        }
+        if transport.TRANSPORT:
+            out['transport'] = transport.TRANSPORT.stats()
+    finally:
+        for la in actors:
+            actor.Actor(la.id, config=config).delete()
+        stop_app()
+        server.stop()
+    print(json.dumps(out, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Cost of the pipeline metrics: time added per timed() call and per generator item, and the time
+to render /metrics and flush a log line with many actors and stages.
+
+    python -m bench.metrics --calls 200000 --actors 1000
+"""
+import argparse
+import json
+import logging
+import time
+
+from src import metrics
+
+
+def plain():
+    return 1
+
+
+def items(n):
+    for i in range(n):
+        yield i
+
+
+def per_call(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--actors', type=int, default=1000)
+    args = parser.parse_args()
+    registry = metrics.REGISTRY
+    timed = metrics.timed('bench.plain')(plain)
+    overhead = per_call(timed, args.calls) - per_call(plain, args.calls)
+    start = time.perf_counter()
+    sum(metrics.timed('bench.items')(items)(args.calls))
+    with_timer = time.perf_counter() - start
+    start = time.perf_counter()
+    sum(items(args.calls))
+    item_overhead = (with_timer - (time.perf_counter() - start)) / args.calls
+    for n in range(args.actors):
+        metrics.gmail_call('actor%d' % n, 'messages.get', 200, 0.05)
+    for n in range(40):
+        registry.observe('gmail_stage_seconds', (('stage', 'bench.stage%d' % n),), 0.01)
+    start = time.perf_counter()
+    text = registry.render()
+    render = time.perf_counter() - start
+    logging.disable(logging.INFO)
+    start = time.perf_counter()
+    registry.flush()
+    flush = time.perf_counter() - start
+    print(json.dumps({'timed_call_overhead_us': round(overhead * 1e6, 2),
+                      'generator_item_overhead_us': round(item_overhead * 1e6, 2),
+                      'render_ms': round(render * 1000, 2), 'render_bytes': len(text),
+                      'flush_ms': round(flush * 1000, 2)}))
+
+
+if __name__ == '__main__':
+    main()
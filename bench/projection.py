@@ -0,0 +1,45 @@
+"""
+Measure bytes on the wire for message and history calls with and without projection.
+
+    python -m bench.projection --messages 200
+"""
+import argparse
+import json
+
+from bench.fake_gmail import FakeGmailServer
+from bench.common import gmail_for
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+    server = FakeGmailServer(messages=args.messages).start()
+    try:
+        gm = gmail_for(server)
+        p = gm.projection
+        auth = gm.auth
+        ids = list(server.mailbox.order)
+        for name, paths in (
+                ('messages.get', [(p.message_path(i), p.message_path(i, project=False)) for i in ids]),
+                ('history.list', [(p.history_path(server.mailbox.first_history_id),
+                                   p.history_path(server.mailbox.first_history_id, project=False))])):
+            projected = full = 0
+            for proj, raw in paths:
+                projected += len(json.dumps(auth.oauth_get(gm_url(proj))))
+                full += len(json.dumps(auth.oauth_get(gm_url(raw))))
+            calls = len(paths)
+            print({'call': name, 'calls': calls, 'bytes_full_per_call': full // calls,
+                   'bytes_projected_per_call': projected // calls,
+                   'bytes_saved_per_call': (full - projected) // calls})
+    finally:
+        server.stop()
+
+
+def gm_url(path):
+    from src import gmail
+    return gmail.GMAIL_URL + path
+
+
+if __name__ == '__main__':
+    main()
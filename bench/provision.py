@@ -0,0 +1,53 @@
+"""
+Bulk actor provisioning (per-actor topic, IAM binding and push subscription) against the
+Pub/Sub emulator, with fresh admin clients per call versus the shared client registry.
+
+    docker-compose up -d pubsub
+    PUBSUB_EMULATOR_HOST=localhost:8085 python -m bench.provision --actors 200
+"""
+import argparse
+import json
+import os
+import time
+
+from google.cloud import pubsub_v1 as pubsub
+from bench.common import FakeActor, FakeAuth, FakeConfig, MemoryUnitOfWork
+from src import gmail, pubsub_clients
+
+
+def provision(n, prefix):
+    start = time.perf_counter()
+    for i in range(n):
+        me = FakeActor(actor_id='%s%05d' % (prefix, i))
+        gm = gmail.GMail(me, FakeConfig(), FakeAuth(), uow=MemoryUnitOfWork(me))
+        assert gm._create_pubsub(refresh=True) is True
+        assert gm._delete_pubsub() is True
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actors', type=int, default=200)
+    args = parser.parse_args()
+    if not os.getenv('PUBSUB_EMULATOR_HOST'):
+        raise SystemExit('Set PUBSUB_EMULATOR_HOST, this benchmark only runs against the emulator')
+    gmail.GMAIL_PUBSUB_MODE = 'push'
+    registry_publisher, registry_subscriber = pubsub_clients.publisher, pubsub_clients.subscriber
+    # Baseline: what _create_pubsub/_delete_pubsub did before the registry
+    pubsub_clients.publisher, pubsub_clients.subscriber = pubsub.PublisherClient, pubsub.SubscriberClient
+    fresh = provision(args.actors, 'fresh')
+    pubsub_clients.publisher, pubsub_clients.subscriber = registry_publisher, registry_subscriber
+    shared = provision(args.actors, 'shared')
+    print(json.dumps({
+        'actors': args.actors,
+        'fresh_clients_seconds': round(fresh, 3),
+        'shared_clients_seconds': round(shared, 3),
+        'fresh_actors_per_sec': round(args.actors / fresh, 1),
+        'shared_actors_per_sec': round(args.actors / shared, 1),
+        'registry': pubsub_clients.stats(),
+    }))
+    pubsub_clients.shutdown()
+
+
+if __name__ == '__main__':
+    main()
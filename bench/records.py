@@ -0,0 +1,109 @@
+"""
+Memory and encode time for new messages as plain dicts (as Gmail returns them) versus
+records.Message, and json.dumps() versus codec.dumps() for the message blob of a history run
+(property new with GMAIL_NEW_MODE=blob, re-encoded after every page).
+
+    python -m bench.records --messages 10000
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from bench.fake_gmail import Mailbox
+from src import codec, projection, records
+
+CONFIG = {'msgFormat': 'metadata', 'msgHeaders': ['From', 'To', 'Subject', 'Date']}
+
+
+def gmail_responses(count):
+    """ Message bodies as Gmail sends them with the message projection. """
+    box = Mailbox(messages=count)
+    proj = projection.compile(CONFIG)
+    out = []
+    for mid in box.order:
+        msg = dict(box.message(mid))
+        msg['payload'] = {'headers': [h for h in msg['payload']['headers'] if h['name'] in proj.headers]}
+        out.append(json.dumps(msg))
+    return out, proj
+
+
+def strip(res, proj, record):
+    """ GMail._strip_message(), returning a dict as before or a records.Message. """
+    res['headers'] = proj.filter_headers(res['payload']['headers'])
+    del res['payload']
+    return records.Message(res) if record else res
+
+
+def measure_memory(bodies, proj, record):
+    gc.collect()
+    tracemalloc.start()
+    msgs = {}
+    for body in bodies:
+        m = strip(codec.loads(body), proj, record)
+        msgs[m['id']] = m
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return msgs, size
+
+
+def timed(fn):
+    start = time.perf_counter()
+    res = fn()
+    return res, time.perf_counter() - start
+
+
+def run_blob(msgs, page_size, dumps):
+    """ Encode the growing run after each page, like handle_history() does for property new. """
+    ids = list(msgs)
+    run = {}
+    out = None
+    for i in range(0, len(ids), page_size):
+        run.update((k, msgs[k]) for k in ids[i:i + page_size])
+        out = dumps(run)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+    bodies, proj = gmail_responses(args.messages)
+
+    decode_json = min(timed(lambda: [json.loads(b) for b in bodies])[1] for _ in range(3))
+    decode_codec = min(timed(lambda: [codec.loads(b) for b in bodies])[1] for _ in range(3))
+    print({'decode': codec.name(), 'messages': args.messages, 'json_ms': round(decode_json * 1000, 1),
+           'codec_ms': round(decode_codec * 1000, 1)})
+
+    dicts, dict_bytes = measure_memory(bodies, proj, record=False)
+    recs, rec_bytes = measure_memory(bodies, proj, record=True)
+    print({'bytes_per_message': {'dict': dict_bytes // args.messages, 'record': rec_bytes // args.messages}})
+
+    once_json, t_json = timed(lambda: json.dumps(dicts))
+    once_codec, t_codec = timed(lambda: codec.dumps(recs))
+    _, t_cached = timed(lambda: codec.dumps(recs))
+    # Memory held by the cached JSON, on records that have not been encoded yet
+    fresh, _ = measure_memory(bodies, proj, record=True)
+    gc.collect()
+    tracemalloc.start()
+    for m in fresh.values():
+        m.json()
+    cached_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del fresh
+    print({'encode_once_ms': {'json': round(t_json * 1000, 1), 'codec_first': round(t_codec * 1000, 1),
+                              'codec_cached': round(t_cached * 1000, 1)},
+           'cached_json_bytes_per_message': cached_bytes // args.messages})
+
+    blob_json, t_blob_json = timed(lambda: run_blob(dicts, args.page_size, json.dumps))
+    blob_codec, t_blob_codec = timed(lambda: run_blob(recs, args.page_size, codec.dumps))
+    print({'blob_run_ms': {'json': round(t_blob_json * 1000, 1), 'codec': round(t_blob_codec * 1000, 1)},
+           'pages': -(-args.messages // args.page_size)})
+    print({'byte_identical': once_json == once_codec and blob_json == blob_codec,
+           'dicts_equal': all(recs[k] == dicts[k] for k in dicts)})
+
+
+if __name__ == '__main__':
+    main()
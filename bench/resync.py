@@ -0,0 +1,88 @@
+"""
+Full resync of a mailbox whose history has expired, against the fake Gmail server.
+
+The run is interrupted after --interrupt-after pages and continued by a fresh GMail object on the
+same actor (as after a process restart), then incremental sync is checked to take over.
+
+    python -m bench.resync --messages 100000 --concurrency 4 --fetch-mode batch
+"""
+import argparse
+import json
+import time
+
+from bench.fake_gmail import FakeGmailServer
+from bench.common import FakeActor, FakeAuth, FakeConfig, MemoryUnitOfWork
+from src import gmail, dedup, resync
+
+
+def new_gmail(me):
+    return gmail.GMail(me, FakeConfig(), FakeAuth(), uow=MemoryUnitOfWork(me))
+
+
+def consume(gm, seen, limit=None):
+    """ Run iter_history(), stop after limit pages, return (pages, redelivered messages). """
+    pages = 0
+    again = 0
+    it = gm.iter_history()
+    for page in it:
+        again += sum(1 for k in page if k in seen)
+        seen.update(page.keys())
+        pages += 1
+        if limit and pages >= limit:
+            it.close()
+            break
+    return pages, again
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=resync.RESYNC_CONCURRENCY)
+    parser.add_argument('--page-size', type=int, default=resync.RESYNC_PAGE_SIZE)
+    parser.add_argument('--fetch-mode', default='batch')
+    parser.add_argument('--max-pages', type=int, default=0, help='GMAIL_RESYNC_MAX_PAGES, 0 for the whole mailbox')
+    parser.add_argument('--interrupt-after', type=int, default=20, help='Pages before the simulated restart')
+    args = parser.parse_args()
+    resync.RESYNC_CONCURRENCY = args.concurrency
+    resync.RESYNC_PAGE_SIZE = args.page_size
+    resync.RESYNC_MAX_PAGES = args.max_pages
+    gmail.GMAIL_FETCH_MODE = args.fetch_mode
+    server = FakeGmailServer(messages=args.messages, latency=args.latency).start()
+    try:
+        gmail.GMAIL_URL = server.url + '/gmail/v1/users/'
+        gmail.GMAIL_BATCH_URL = server.url + '/batch/gmail/v1'
+        box = server.mailbox
+        me = FakeActor(historyId=str(box.first_history_id))
+        box.expire_history()
+        seen = set()
+        report = {'messages': args.messages, 'concurrency': args.concurrency, 'page_size': args.page_size,
+                  'fetch_mode': args.fetch_mode}
+
+        gm = new_gmail(me)
+        pages, _ = consume(gm, seen, limit=args.interrupt_after)
+        report['first_run'] = dict(gm.resync_stats.as_dict(), checkpoint=resync.pending(gm))
+
+        # Restart: new process state, same datastore
+        dedup.SEEN.forget(me.id)
+        gm = new_gmail(me)
+        start = time.perf_counter()
+        _, again = consume(gm, seen)
+        report['resumed_run'] = gm.resync_stats.as_dict()
+        report['redelivered'] = again
+        report['delivered'] = len(seen)
+        report['complete'] = len(seen) == args.messages and resync.pending(gm) is None
+        report['history_id'] = {'stored': gm.history_id, 'mailbox': box.history_id}
+
+        # Incremental sync takes over from the fresh history id
+        for _ in range(5):
+            box.add()
+        report['incremental'] = len(new_gmail(me).get_history())
+        report['seconds'] = round(time.perf_counter() - start, 3)
+        print(json.dumps(report, indent=2))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Gmail calls with short-lived access tokens: actingweb's refresh-after-failure against
+tokens.TokenManager (refresh before the call, single-flight per actor, background refresh ahead
+of expiry). Gmail and the OAuth token endpoint are simulated in process with fixed latencies.
+
+    python -m bench.tokens --actors 20 --seconds 10
+"""
+import argparse
+import itertools
+import threading
+import time
+
+from bench.common import percentile
+from src import tokens
+
+
+class TokenServer:
+    """ Issues tokens valid for lifetime seconds and counts refresh calls. """
+
+    def __init__(self, lifetime, latency):
+        self.lifetime = lifetime
+        self.latency = latency
+        self.valid = {}
+        self.refreshes = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def issue(self):
+        time.sleep(self.latency)
+        with self._lock:
+            self.refreshes += 1
+            token = 'token-%d' % next(self._ids)
+            self.valid[token] = time.time() + self.lifetime
+        return {'access_token': token, 'expires_in': self.lifetime}
+
+    def ok(self, token):
+        return self.valid.get(token, 0) > time.time()
+
+
+class Store:
+    pass
+
+
+class Actor:
+
+    def __init__(self, actor_id):
+        self.id = actor_id
+        self.store = Store()
+
+
+class OAuth:
+
+    def __init__(self):
+        self.last_response_code = 0
+
+    def set_token(self, token):
+        pass
+
+
+class Auth:
+    """ Mimics actingweb's Auth: on a 401 the token is refreshed and the call retried. """
+
+    def __init__(self, actor_id, server, call_latency):
+        self.actor = Actor(actor_id)
+        self.config = None
+        self.server = server
+        self.call_latency = call_latency
+        self.oauth = OAuth()
+        self.refresh_token = 'refresh-' + actor_id
+        self.reactive = 0
+        self.set(server.issue())
+
+    def set(self, result):
+        self.token = result['access_token']
+        self.expiry = str(time.time() + result['expires_in'])
+
+    def _call(self):
+        time.sleep(self.call_latency)
+        return self.server.ok(self.token)
+
+    def oauth_get(self, url=None, params=None):
+        if self._call():
+            return {'ok': True}
+        self.reactive += 1
+        self.set(self.server.issue())
+        return {'ok': True} if self._call() else None
+
+
+def run(args, managed):
+    server = TokenServer(args.lifetime, args.refresh_latency)
+    manager = tokens.TokenManager(
+        refresh=lambda t: server.issue(), save=lambda t, values: None, ahead=args.lifetime / 3.0,
+        min_ttl=args.call_latency * 4, sweep=0.1, background=True, name='bench-tokens') if managed else None
+    auths = [Auth('actor%d' % n, server, args.call_latency) for n in range(args.actors)]
+    latencies = []
+    lock = threading.Lock()
+    stop = time.time() + args.seconds
+
+    def worker(auth):
+        while time.time() < stop:
+            start = time.perf_counter()
+            if manager:
+                manager.prepare(auth)
+                auth.oauth_get('me/messages')
+                manager.observe(auth)
+            else:
+                auth.oauth_get('me/messages')
+            with lock:
+                latencies.append(time.perf_counter() - start)
+            time.sleep(args.interval)
+
+    threads = [threading.Thread(target=worker, args=(a,)) for a in auths for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out = {
+        'managed': managed,
+        'calls': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'max_ms': round(max(latencies) * 1000, 1),
+        'token_endpoint_calls': server.refreshes - args.actors,
+        'failed_calls_refreshed': sum(a.reactive for a in auths),
+    }
+    if manager:
+        out['manager'] = manager.as_dict()
+    return out
+
+
+def single_flight(args):
+    """ Many threads of one actor hitting an expired token at the same time. """
+    server = TokenServer(args.lifetime, args.refresh_latency)
+    manager = tokens.TokenManager(refresh=lambda t: server.issue(), save=lambda t, values: None,
+                                  min_ttl=args.lifetime / 10.0, background=False)
+    auth = Auth('actor', server, 0)
+    auth.expiry = str(time.time() - 1)
+    before = server.refreshes
+    threads = [threading.Thread(target=manager.prepare, args=(auth,)) for _ in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {'threads': 32, 'refreshes': server.refreshes - before, 'joined': manager.stats['joined']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actors', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=2, help='Concurrent callers per actor')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--lifetime', type=float, default=3.0, help='Access token lifetime in seconds')
+    parser.add_argument('--call-latency', type=float, default=0.02)
+    parser.add_argument('--refresh-latency', type=float, default=0.15)
+    parser.add_argument('--interval', type=float, default=0.05, help='Pause between calls of a caller')
+    args = parser.parse_args()
+    print(run(args, managed=False))
+    print(run(args, managed=True))
+    print({'single_flight': single_flight(args)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Gmail calls over HTTPS against the local TLS stub: a new connection per call (as actingweb's OAuth
+helper does) versus the pooled keep-alive transport in src/transport.py, for one history sync with
+serial and concurrent message fetches.
+
+    python -m bench.transport --messages 300 --latency 0.002
+"""
+import argparse
+import time
+
+from bench.fake_gmail import FakeGmailServer
+from bench.common import gmail_for
+from src import dedup, gmail, transport
+
+
+class PerCallTransport(transport.GmailTransport):
+    """ A fresh session, and so a fresh connection and TLS handshake, for every call. """
+
+    def _session(self):
+        return self._new_client()
+
+
+def sync(server, mode):
+    gmail.GMAIL_FETCH_MODE = mode
+    dedup.SEEN.forget('bench')
+    gm = gmail_for(server)
+    start = time.perf_counter()
+    msgs = gm.sync(server.mailbox.history_id)
+    return len(msgs), time.perf_counter() - start
+
+
+def run(server, name, t, mode):
+    transport.TRANSPORT = t
+    server.stats.reset()
+    count, elapsed = sync(server, mode)
+    out = {'transport': name, 'fetch': mode, 'messages': count, 'seconds': round(elapsed, 3),
+           'calls_per_sec': round(server.stats.requests / elapsed), 'http_requests': server.stats.requests,
+           'tls_connections': server.stats.connections}
+    if not isinstance(t, PerCallTransport):
+        out['client'] = t.stats()
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds added to every request')
+    args = parser.parse_args()
+    # Measure the transport, not the per-user quota limiter
+    gmail.GMAIL_QUOTA_RATE = 1000000
+    server = FakeGmailServer(messages=args.messages, latency=args.latency, tls=True).start()
+    try:
+        for mode in ('serial', 'concurrent'):
+            print(run(server, 'per_call', PerCallTransport(verify=server.cert), mode))
+            print(run(server, 'pooled', transport.GmailTransport(verify=server.cert), mode))
+        if transport.httpx:
+            # The stub only speaks HTTP/1.1, this checks the httpx client rather than multiplexing
+            print(run(server, 'httpx', transport.GmailTransport(verify=server.cert, http2=True), 'concurrent'))
+        else:
+            print({'transport': 'httpx', 'skipped': 'httpx is not installed'})
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+asyncio versions of the GMail calls, for the ASGI serving mode (asgi.py).
+
+AsyncGMail wraps a GMail object and shares its state, request masks, label rules and unit of work,
+only the Gmail calls are awaited: get_profile, create_watch, get_message(s), iter_history and
+iter_callback. They go out on an httpx.AsyncClient when httpx is installed, else through the pooled
+transport (src.transport) in worker threads, which frees the event loop but takes a thread per call
+in flight. The rest is sync (actingweb, pynamodb, Pub/Sub admin, token refresh, batch fetches, full
+resyncs and the streamed 'raw'/'full' message fetches of src.blobs) and runs in the same threads
+through run_sync(). A call rejected with 401/403 is repeated on GMail's sync path, where actingweb
+refreshes the token. What to call and what to do with the results (paging, label filtering,
+checkpoints, message stripping) is left to the GMail helpers, so both take the same decisions.
+"""
+import os
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src import blobs, fetch, gmail, labels, metrics, resync, tokens, transport
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Worker threads for sync work, and for the Gmail calls themselves without httpx
+AIO_THREADS = int(os.getenv('GMAIL_AIO_THREADS', '64'))
+# Keep-alive connections of the async client, shared by all callbacks on the event loop
+AIO_POOL_SIZE = int(os.getenv('GMAIL_AIO_POOL_SIZE', '100'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=AIO_THREADS, thread_name_prefix='gmail-aio')
+    return _executor
+
+
+async def run_sync(fn, *args, **kwargs):
+    """ Await a blocking call run in a worker thread. """
+    return await asyncio.get_event_loop().run_in_executor(executor(), functools.partial(fn, *args, **kwargs))
+
+
+async def iterate_sync(gen):
+    """ The items of a sync generator, each one produced in a worker thread. """
+    done = object()
+    try:
+        while True:
+            item = await run_sync(next, gen, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        await run_sync(gen.close)
+
+
+class AsyncTransport:
+
+    def __init__(self, pool_size=AIO_POOL_SIZE, connect_timeout=transport.HTTP_CONNECT_TIMEOUT,
+                 read_timeout=transport.HTTP_READ_TIMEOUT, verify=True):
+        """ :param verify: True, or the path of a CA bundle (e.g. for a local TLS test server) """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        # 'httpx', 'threads' (the sync transport in worker threads) or None (actingweb's OAuth helper)
+        self.mode = None
+        if transport.GMAIL_TRANSPORT == 'pooled':
+            self.mode = 'httpx' if httpx else 'threads' if transport.TRANSPORT else None
+        # httpx clients can not be shared between event loops
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    def _client(self):
+        loop = asyncio.get_event_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = httpx.AsyncClient(
+                http2=transport.HTTP2, verify=self.verify,
+                headers={'Accept-Encoding': 'gzip', 'User-Agent': transport.USER_AGENT},
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+        return client
+
+    async def call(self, method, url, token, params=None):
+        """ transport.GmailTransport.call() without blocking the event loop. """
+        self._count('in_flight', 1)
+        try:
+            if self.mode == 'threads':
+                return await run_sync(transport.TRANSPORT.call, method, url, token, params=params)
+            data, headers = transport.encode_params(params)
+            headers = dict(headers or {}, Authorization='Bearer ' + token)
+            try:
+                res = await self._client().request(method, url, content=data, headers=headers)
+            except Exception as e:
+                self._count('errors')
+                logging.warning('Gmail ' + method + ' ' + url.split('?')[0] + ' failed: ' + str(e))
+                return 0, None
+            self._count('requests')
+            return transport.decode_result(method, url, res.status_code, res.content)
+        finally:
+            self._count('in_flight', -1)
+
+    async def aclose(self):
+        """ Close the client of the running event loop. """
+        client = self._clients.pop(asyncio.get_event_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+            if key == 'in_flight' and self._stats[key] > self._stats['max_in_flight']:
+                self._stats['max_in_flight'] = self._stats[key]
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+        out['mode'] = self.mode
+        return out
+
+
+ASYNC_TRANSPORT = AsyncTransport()
+metrics.collector('aio', ASYNC_TRANSPORT.stats)
+
+
+@metrics.instrument('aio')
+class AsyncGMail:
+    """ The Gmail calls of a GMail object as coroutines, results and side effects are the same as GMail's. """
+
+    def __init__(self, gm, client=None):
+        self.gm = gm
+        self.client = client or ASYNC_TRANSPORT
+
+    async def _get(self, url):
+        return (await self._send('GET', url))[0]
+
+    async def _post(self, url, params=None):
+        return (await self._send('POST', url, params=params))[0]
+
+    async def _send(self, method, url, params=None):
+        """ See GMail._send(), returns (response data or None, HTTP status code). """
+        gm = self.gm
+        token = None
+        if self.client.mode:
+            if tokens.MANAGER.fresh(gm.auth):
+                tokens.MANAGER.prepare(gm.auth)
+            else:
+                # Refreshes the token first, see src.tokens
+                await run_sync(tokens.MANAGER.prepare, gm.auth)
+            token = getattr(gm.auth, 'token', None)
+        if token:
+            start = time.perf_counter()
+            code, res = await self.client.call(method, url, token, params=params)
+            metrics.gmail_call(gm.myself.id, metrics.api_method(url), code, time.perf_counter() - start)
+            if code not in (401, 403):
+                return res, code
+        # actingweb's Auth refreshes the token and retries, see GMail._send()
+        return await run_sync(gm._send, method, url, params=params)
+
+    async def _charge(self, method):
+        """ GMail._charge() without blocking the event loop. """
+        delay = self.gm._bucket().reserve(fetch.QUOTA_UNITS[method])
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def get_profile(self):
+        return await run_sync(self.gm._set_profile, await self._get(gmail.GMAIL_URL + 'me/profile'))
+
+    async def set_up(self, refresh=False):
+        if not await run_sync(self.gm._create_pubsub, refresh=refresh):
+            return False
+        return await self.create_watch(refresh=refresh)
+
+    async def create_watch(self, labels=None, refresh=False):
+        gm = self.gm
+        if gm._watch_due(refresh):
+            params = await run_sync(gm._watch_params, labels)
+            res, code = await self._send('POST', gmail.GMAIL_URL + 'me/watch', params=params)
+            return await run_sync(gm._set_watch, res, code)
+        return True
+
+    async def get_message(self, id=None, fmt=None):
+        """ See GMail.get_message(). """
+        gm = self.gm
+        if not id:
+            return {}
+        fmt = gm._format(fmt)
+        if blobs.streams(fmt):
+            # Decoded and stored while the response streams in
+            return await run_sync(gm.get_message, id, fmt=fmt)
+        res = await self._get(gm._message_url(id, fmt))
+        sample = await self._get(gm._message_url(id, fmt, project=False)) if gm._sampled(res) else None
+        return gm._got_message(res, sample)
+
+    async def get_messages(self, ids=None, fmt=None):
+        """
+        See GMail.get_messages(). With GMAIL_FETCH_MODE 'concurrent' up to GMAIL_FETCH_CONCURRENCY messages
+        are fetched at once within the user's quota, 'batch' requests run in a worker thread.
+        """
+        gm = self.gm
+        ids = list(ids or [])
+        fmt = gm._format(fmt)
+        msgs = {}
+        if gm._batched(fmt):
+            msgs = await run_sync(gm._get_messages_batch, ids, fmt)
+        concurrent = gmail.GMAIL_FETCH_MODE == 'concurrent'
+        semaphore = asyncio.Semaphore(gmail.GMAIL_FETCH_CONCURRENCY if concurrent else 1)
+
+        async def one(i):
+            async with semaphore:
+                if concurrent:
+                    await self._charge('messages.get')
+                msgs[i] = await self.get_message(i, fmt=fmt)
+
+        await asyncio.gather(*[one(i) for i in ids if i not in msgs])
+        return {i: msgs[i] for i in ids}
+
+    async def iter_history(self):
+        """ See GMail.iter_history(). Resyncs run GMail.iter_history() in a worker thread. """
+        gm = self.gm
+        if resync.pending(gm):
+            async for page in iterate_sync(gm.iter_history()):
+                yield page
+            return
+        start = gm.history_id
+        token = None
+        while True:
+            await self._charge('history.list')
+            res, code = await self._send('GET', gm._history_url(start, token))
+            if not res:
+                if code == 404:
+                    # Expired history id, GMail.iter_history() gets the 404 too and resyncs
+                    async for page in iterate_sync(gm.iter_history()):
+                        yield page
+                return
+            records, token, checkpoint = gm._history_page(res)
+            msgs = await self._new_messages(records)
+            if msgs:
+                yield msgs
+            if checkpoint:
+                # Writes to the datastore
+                await run_sync(gm._page_done, msgs, checkpoint)
+            else:
+                gm._page_done(msgs, None)
+            if not token:
+                return
+
+    async def _new_messages(self, records):
+        gm = self.gm
+        if labels.needs_names(gm.myconf):
+            # Label names may have to be looked up first
+            rules = await run_sync(gm.label_rules)
+        else:
+            rules = gm.label_rules()
+        ids = gm._new_ids(records, rules)
+        return await self.get_messages(ids) if ids else {}
+
+    async def get_history(self):
+        msgs = {}
+        async for page in self.iter_history():
+            msgs.update(page)
+        return msgs
+
+    async def iter_callback(self, data=None):
+        """ See GMail.iter_callback(). """
+        payload = gmail.parse_notification(data)
+        if not payload:
+            return
+        async for page in self.iter_sync(int(payload.get('historyId'))):
+            yield page
+
+    async def iter_sync(self, new_id):
+        if self.gm._behind(new_id):
+            async for page in self.iter_history():
+                yield page
+        self.gm._synced(new_id)
+
+    async def sync(self, new_id):
+        msgs = {}
+        async for page in self.iter_sync(new_id):
+            msgs.update(page)
+        return msgs
@@ -0,0 +1,132 @@
+import logging
+import json
+import uuid
+import urllib.request
+import urllib.error
+from urllib.parse import urlparse
+from src import codec, transport
+
+# Gmail accepts at most 100 calls in one batch request
+BATCH_LIMIT = 100
+# Calls per batch request we send: 50 messages.get are 250 quota units, a user's limit per second
+BATCH_MAX = 50
+
+
+def chunks(items, size=BATCH_MAX):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def build_batch(paths, boundary=None):
+    """
+    Build a multipart/mixed batch body with one GET per path.
+    :param paths: List of (content_id, path) tuples, path relative to the API host
+    :param boundary: Optional boundary string, a random one is used if not set
+    :return: Tuple of (boundary, body as bytes)
+    """
+    if not boundary:
+        boundary = 'batch_' + uuid.uuid4().hex
+    lines = []
+    for cid, path in paths:
+        lines.append('--' + boundary)
+        lines.append('Content-Type: application/http')
+        lines.append('Content-ID: <' + str(cid) + '>')
+        lines.append('')
+        lines.append('GET ' + path)
+        lines.append('')
+    lines.append('--' + boundary + '--')
+    lines.append('')
+    return boundary, '\r\n'.join(lines).encode('utf-8')
+
+
+def _split_head(text):
+    """ Split a header block from its body, tolerating both CRLF and LF line endings. """
+    for sep in ('\r\n\r\n', '\n\n'):
+        idx = text.find(sep)
+        if idx >= 0:
+            return text[:idx], text[idx + len(sep):]
+    return text, ''
+
+
+def _boundary(content_type):
+    for param in (content_type or '').split(';'):
+        k, _, v = param.strip().partition('=')
+        if k.lower() == 'boundary':
+            return v.strip('"')
+    return None
+
+
+def parse_batch(body, content_type):
+    """
+    Split a multipart/mixed batch response into its individual responses.
+    :param body: Response body (bytes or str)
+    :param content_type: Content-Type header of the batch response
+    :return: Dict of content_id -> (status code, decoded json body or None)
+    """
+    boundary = _boundary(content_type)
+    if not boundary:
+        return {}
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    results = {}
+    for part in body.split('--' + boundary):
+        part = part.strip('\r\n')
+        if not part or part == '--':
+            continue
+        head, http = _split_head(part)
+        cid = None
+        for line in head.splitlines():
+            k, _, v = line.partition(':')
+            if k.strip().lower() == 'content-id':
+                cid = v.strip().strip('<>')
+                if cid.startswith('response-'):
+                    cid = cid[len('response-'):]
+        if cid is None:
+            continue
+        status_and_headers, payload = _split_head(http.lstrip('\r\n'))
+        try:
+            code = int(status_and_headers.splitlines()[0].split()[1])
+        except (IndexError, ValueError):
+            code = 0
+        try:
+            data = codec.loads(payload) if payload.strip() else None
+        except json.JSONDecodeError:
+            data = None
+        results[cid] = (code, data)
+    return results
+
+
+def fetch_batch(batch_url, token, paths, timeout=30):
+    """
+    POST one batch request with up to BATCH_LIMIT GETs.
+    :return: Dict of content_id -> (status code, json body), or None if the batch call itself failed
+    """
+    if not token or not paths:
+        return None
+    boundary, body = build_batch(paths)
+    if transport.TRANSPORT:
+        code, content, content_type = transport.TRANSPORT.request('POST', batch_url, token, data=body, headers={
+            'Content-Type': 'multipart/mixed; boundary=' + boundary})
+        if code != 200:
+            logging.warning('Gmail batch request failed with ' + str(code))
+            return None
+        return parse_batch(content, content_type)
+    req = urllib.request.Request(batch_url, data=body, method='POST', headers={
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': 'multipart/mixed; boundary=' + boundary,
+    })
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return parse_batch(res.read(), res.headers.get('Content-Type'))
+    except (urllib.error.URLError, OSError) as e:
+        logging.warning('Gmail batch request failed: ' + str(e))
+        return None
+
+
+def api_path(base_url, path):
+    """ Path component of base_url + path, as used inside a batch part. """
+    parsed = urlparse(base_url + path)
+    if parsed.query:
+        return parsed.path + '?' + parsed.query
+    return parsed.path
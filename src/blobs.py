@@ -0,0 +1,352 @@
+"""
+Streaming decode and content-addressed storage of large message parts (msgFormat 'raw', and 'full'
+with GMAIL_FULL_BODIES=true).
+
+A 'raw' message, and each part body or attachment of a 'full' message, comes as one base64url
+string in Gmail's JSON, megabytes for a message with attachments. GMail.get_message() streams
+such responses through a Splitter instead of decoding the JSON in one piece: the string values of
+'raw' and 'data' keys are taken out of the JSON as they arrive. Values up to BLOB_THRESHOLD bytes
+(decoded) stay inline as before. Larger ones are decoded on the fly into a SpooledTemporaryFile,
+in memory up to BLOB_SPOOL bytes and in a temp file after that, and stored in the actor's
+BlobStore. The message then holds a reference in place of the string:
+
+    "raw": {"blob": "<sha256 of the decoded bytes>", "size": <decoded bytes>}
+
+Blobs are kept per actor in the attribute table (bucket 'blob'), in chunks of BLOB_CHUNK bytes,
+under the sha256 of their content, so an attachment that arrives again is stored once. A blob
+that no new message has referenced for BLOB_TTL seconds (by default as long as the message log
+keeps messages) is deleted, as are all of them with the actor. Read them from
+/<actor_id>/resources/blobs/<sha256>?chunk=N.
+"""
+import os
+import base64
+import hashlib
+import logging
+import re
+import tempfile
+import threading
+from datetime import datetime, timezone
+from pynamodb.exceptions import DeleteError, UpdateError
+from src import metrics, msglog
+
+# GMAIL_BLOBS=false keeps everything inline, as before
+BLOBS = os.getenv('GMAIL_BLOBS', 'true').lower() == 'true'
+# 'full' messages with their part bodies and attachments, as a flat list of parts. This changes the shape
+# of published 'full' messages and costs one messages.attachments.get call (and its quota) per attachment.
+FULL_BODIES = os.getenv('GMAIL_FULL_BODIES', 'false').lower() == 'true'
+BLOB_THRESHOLD = int(os.getenv('GMAIL_BLOB_THRESHOLD', str(64 * 1024)))
+BLOB_SPOOL = int(os.getenv('GMAIL_BLOB_SPOOL', str(1024 * 1024)))
+# base64 in a json attribute, 192 KB become 256 KB, well below DynamoDB's 400 KB item limit
+BLOB_CHUNK = int(os.getenv('GMAIL_BLOB_CHUNK', str(192 * 1024)))
+# Seconds a blob is kept after the last message referencing it
+BLOB_TTL = int(os.getenv('GMAIL_BLOB_TTL', str(msglog.LOG_TTL)))
+BUCKET = 'blob'
+REF_BUCKET = 'blobref'
+# Keys whose string values are base64url content
+KEYS = ('raw', 'data')
+# The opening quote of a KEYS value, the key itself must not follow an escaping backslash
+_VALUE = re.compile(rb'(\\*)"(' + b'|'.join(k.encode('ascii') for k in KEYS) + rb')"\s*:\s*"')
+# Longest tail of a chunk that can hold the start of a _VALUE match, longer whitespace is not expected
+_CARRY = 32
+_PLACEHOLDER = re.compile(r'#([0-9]+)$')
+
+_STATS = {'values': 0, 'spilled': 0, 'on_disk': 0, 'bytes_spilled': 0, 'stored': 0, 'deduplicated': 0,
+          'bytes_stored': 0, 'evicted': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(**kwargs):
+    with _stats_lock:
+        for k, v in kwargs.items():
+            _STATS[k] += v
+
+
+def stats():
+    with _stats_lock:
+        return dict(_STATS)
+
+
+metrics.collector('blobs', stats)
+
+
+def streams(fmt):
+    """ True if messages in format fmt are fetched through a Splitter. """
+    return BLOBS and (fmt == 'raw' or (fmt == 'full' and FULL_BODIES))
+
+
+class Base64urlDecoder:
+    """ Incremental base64url decoder, feed() takes any slices of the encoded text. """
+
+    def __init__(self):
+        self._rest = b''
+
+    def feed(self, data):
+        data = self._rest + data
+        n = len(data) - len(data) % 4
+        self._rest = data[n:]
+        return base64.urlsafe_b64decode(data[:n]) if n else b''
+
+    def close(self):
+        rest, self._rest = self._rest, b''
+        if not rest:
+            return b''
+        return base64.urlsafe_b64decode(rest + b'=' * (-len(rest) % 4))
+
+
+class Spill:
+    """
+    One base64url value. Kept as text until it is longer than the threshold, then decoded into a
+    SpooledTemporaryFile while it streams in.
+    """
+
+    def __init__(self, threshold=BLOB_THRESHOLD, spool=BLOB_SPOOL):
+        # Encoded length of threshold bytes
+        self.limit = (threshold + 2) // 3 * 4
+        self.spool = spool
+        self.text = []
+        self.value = None
+        self.length = 0
+        self.file = None
+        self.size = 0
+        self._decoder = None
+        self._hash = None
+
+    def write(self, data):
+        self.length += len(data)
+        if self.file is None:
+            self.text.append(data)
+            if self.length <= self.limit:
+                return
+            data, self.text = b''.join(self.text), None
+            self.file = tempfile.SpooledTemporaryFile(max_size=self.spool)
+            self._decoder = Base64urlDecoder()
+            self._hash = hashlib.sha256()
+        self._add(self._decoder.feed(data))
+
+    def _add(self, raw):
+        if raw:
+            self._hash.update(raw)
+            self.size += len(raw)
+            self.file.write(raw)
+
+    def close(self):
+        """ End of the value: an inline value is then in value (str), a spilled one in file (decoded). """
+        if self.file is None:
+            self.value = b''.join(self.text).decode('ascii')
+            self.text = None
+            return
+        self._add(self._decoder.close())
+        self.file.seek(0)
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    @property
+    def on_disk(self):
+        """ True if the SpooledTemporaryFile has rolled over to disk. """
+        return self.file is not None and self.size > self.spool
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest() if self._hash else None
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class Splitter:
+    """
+    Takes a Gmail JSON response chunk by chunk and moves the string values of KEYS into Spill
+    objects, leaving a '#<n>' placeholder in the (small) rest of the JSON, see result().
+    """
+
+    def __init__(self, threshold=BLOB_THRESHOLD, spool=BLOB_SPOOL):
+        self.threshold = threshold
+        self.spool = spool
+        self.spills = []
+        self._json = []
+        self._carry = b''
+        self._spill = None
+
+    def feed(self, chunk):
+        while chunk:
+            if self._spill is not None:
+                # base64url has no quotes or escapes, the value ends at the next quote
+                end = chunk.find(b'"')
+                if end < 0:
+                    self._spill.write(chunk)
+                    return
+                self._spill.write(chunk[:end])
+                self._spill.close()
+                self._spill = None
+                self._json.append(b'"')
+                chunk = chunk[end + 1:]
+                continue
+            buf = self._carry + chunk
+            chunk = b''
+            pos = 0
+            while True:
+                m = _VALUE.search(buf, pos)
+                if m is None or len(m.group(1)) % 2 == 0:
+                    break
+                pos = m.end()
+            if m is None:
+                keep = min(_CARRY, len(buf))
+                self._json.append(buf[:len(buf) - keep])
+                self._carry = buf[len(buf) - keep:]
+                return
+            self._json.append(buf[:m.end()] + b'#%d' % len(self.spills))
+            self._carry = b''
+            self._spill = Spill(self.threshold, self.spool)
+            self.spills.append(self._spill)
+            chunk = buf[m.end():]
+
+    def result(self):
+        """
+        The JSON without the KEYS values, parse it and replace the placeholders with resolve().
+        :raises ValueError: If the response ended inside a value
+        """
+        if self._spill is not None:
+            raise ValueError('Response ended inside a ' + '/'.join(KEYS) + ' value')
+        self._json.append(self._carry)
+        self._carry = b''
+        return b''.join(self._json)
+
+    def resolve(self, data, store):
+        """
+        Put the values back into parsed result() data: inline values as the original string, spilled
+        ones as the reference store.put() returns for them.
+        """
+        if isinstance(data, list):
+            return [self.resolve(d, store) for d in data]
+        if not isinstance(data, dict):
+            return data
+        out = {}
+        for k, v in data.items():
+            m = _PLACEHOLDER.match(v) if k in KEYS and isinstance(v, str) else None
+            if m:
+                spill = self.spills[int(m.group(1))]
+                v = store.put(spill) if spill.spilled else spill.value
+            else:
+                v = self.resolve(v, store)
+            out[k] = v
+        return out
+
+    def close(self):
+        """ Count the values and remove the spilled ones, call it once they are stored. """
+        spilled = [s for s in self.spills if s.spilled]
+        _count(values=len(self.spills), spilled=len(spilled), on_disk=sum(1 for s in spilled if s.on_disk),
+               bytes_spilled=sum(s.size for s in spilled))
+        for s in spilled:
+            s.discard()
+        self.spills = []
+
+
+def split(content, threshold=BLOB_THRESHOLD, spool=BLOB_SPOOL):
+    """ A Splitter fed with a whole response (bytes or str), for responses that were not streamed. """
+    splitter = Splitter(threshold, spool)
+    splitter.feed(content.encode('utf-8') if isinstance(content, str) else content)
+    return splitter
+
+
+class BlobStore:
+    """
+    An actor's blobs, see the module doc. Each blob has a small header item (bucket 'blobref') that is
+    written after its chunks and marks it as stored. Its timestamp is the last time a message
+    referenced the blob, blobs not referenced for BLOB_TTL seconds are deleted by evict().
+    """
+
+    def __init__(self, actor_id, config):
+        self.actor_id = actor_id
+        self.model = config.DbAttribute.Attribute
+
+    @staticmethod
+    def _name(sha, n):
+        return sha + ':%06d' % n
+
+    def _item(self, sha, n, data, size, chunks, now):
+        name = self._name(sha, n)
+        return self.model(id=self.actor_id, bucket_name=BUCKET + ':' + name, bucket=BUCKET, name=name,
+                          data={'data': base64.b64encode(data).decode('ascii'), 'size': size, 'chunks': chunks},
+                          timestamp=now)
+
+    def _header(self, sha, size=None, chunks=None, now=None):
+        return self.model(id=self.actor_id, bucket_name=REF_BUCKET + ':' + sha, bucket=REF_BUCKET, name=sha,
+                          data={'size': size, 'chunks': chunks}, timestamp=now)
+
+    def header(self, sha):
+        """ The header item of a stored blob, None if there is none. """
+        try:
+            return self.model.get(self.actor_id, REF_BUCKET + ':' + sha)
+        except self.model.DoesNotExist:
+            return None
+
+    def exists(self, sha):
+        return self.header(sha) is not None
+
+    def _touch(self, header, now):
+        """ Move the last reference time of a blob to now, False if the blob has been evicted meanwhile. """
+        if header.timestamp and (now - header.timestamp).total_seconds() < BLOB_TTL / 10:
+            return True
+        try:
+            header.update(actions=[self.model.timestamp.set(now)], condition=self.model.bucket_name.exists())
+        except UpdateError:
+            return False
+        return True
+
+    def put(self, spill):
+        """
+        Store a spilled value, unless a blob with the same content is already stored.
+        :return: The reference to publish in place of the value
+        """
+        ref = {'blob': spill.sha256, 'size': spill.size}
+        now = datetime.now(timezone.utc)
+        header = self.header(spill.sha256)
+        if header is not None and self._touch(header, now):
+            _count(deduplicated=1)
+            return ref
+        chunks = max(1, (spill.size + BLOB_CHUNK - 1) // BLOB_CHUNK)
+        with self.model.batch_write() as batch:
+            for n in range(chunks):
+                batch.save(self._item(spill.sha256, n, spill.file.read(BLOB_CHUNK), spill.size, chunks, now))
+        # The header marks the blob as stored, so it is written after the chunks
+        self._header(spill.sha256, spill.size, chunks, now).save()
+        _count(stored=1, bytes_stored=spill.size)
+        logging.debug('Stored blob %s of %d bytes in %d chunks for %s', spill.sha256, spill.size, chunks,
+                      self.actor_id)
+        self.evict(now)
+        return ref
+
+    def evict(self, now=None):
+        """ Delete the blobs not referenced for BLOB_TTL seconds. :return: Number of blobs deleted """
+        now = now or datetime.now(timezone.utc)
+        expired = [h for h in self.model.query(self.actor_id, self.model.bucket_name.startswith(REF_BUCKET + ':'))
+                   if h.timestamp and (now - h.timestamp).total_seconds() > BLOB_TTL]
+        evicted = 0
+        for h in expired:
+            try:
+                # Unless it was referenced again in the meantime
+                h.delete(condition=self.model.timestamp == h.timestamp)
+            except DeleteError:
+                continue
+            with self.model.batch_write() as batch:
+                for n in range(int((h.data or {}).get('chunks') or 1)):
+                    batch.delete(self.model(id=self.actor_id, bucket_name=BUCKET + ':' + self._name(h.name, n)))
+            evicted += 1
+        if evicted:
+            _count(evicted=evicted)
+            logging.debug('Evicted %d blobs of %s', evicted, self.actor_id)
+        return evicted
+
+    def read(self, sha, chunk=0):
+        """
+        One chunk of a blob.
+        :return: Dict with blob, size, chunks, chunk and data (standard base64), None if there is no such chunk
+        """
+        try:
+            item = self.model.get(self.actor_id, BUCKET + ':' + self._name(sha, int(chunk)))
+        except self.model.DoesNotExist:
+            return None
+        return dict(item.data, blob=sha, chunk=int(chunk))
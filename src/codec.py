@@ -0,0 +1,61 @@
+"""
+JSON encoding and decoding for the message paths.
+
+dumps() returns exactly what json.dumps() returns, so peers, diffs and stored properties see the
+same bytes as before, but writes records.Message objects from their cached JSON instead of
+encoding every message again for each page, diff and log append.
+
+loads() decodes with orjson when it is installed (and GMAIL_CODEC is 'auto' or 'orjson'), else
+with the stdlib. orjson is not used to encode: it can not produce json.dumps()'s separators and
+ASCII escaping, which peers may depend on.
+"""
+import os
+import json
+import logging
+from src import records
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'auto' (orjson if installed), 'orjson' or 'json'
+CODEC = os.getenv('GMAIL_CODEC', 'auto')
+if CODEC == 'orjson' and not orjson:
+    logging.warning('GMAIL_CODEC is orjson, but orjson is not installed, using json')
+_fast = orjson if CODEC in ('auto', 'orjson') else None
+
+
+def name():
+    """ The decoder in use. """
+    return 'orjson' if _fast else 'json'
+
+
+def default(obj):
+    """ json.dumps() default= for records.Message. """
+    if isinstance(obj, records.Message):
+        return obj.to_dict()
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+
+def dumps(obj):
+    """ json.dumps(obj) for data that may hold records.Message objects, reusing their cached JSON. """
+    if isinstance(obj, records.Message):
+        return obj.json()
+    if isinstance(obj, dict) and any(isinstance(v, records.Message) for v in obj.values()) and \
+            all(isinstance(k, str) for k in obj):
+        return '{' + ', '.join(json.dumps(k) + ': ' + dumps(v) for k, v in obj.items()) + '}'
+    if isinstance(obj, (list, tuple)) and any(isinstance(v, records.Message) for v in obj):
+        return '[' + ', '.join(dumps(v) for v in obj) + ']'
+    return json.dumps(obj, default=default)
+
+
+def loads(data):
+    """ json.loads(data) for str or bytes, raises json.JSONDecodeError (a ValueError) on bad input. """
+    if _fast is not None:
+        try:
+            return _fast.loads(data)
+        except _fast.JSONDecodeError:
+            # Let the stdlib decide, it also takes NaN and integers beyond 64 bits
+            pass
+    return json.loads(data)
@@ -0,0 +1,130 @@
+"""
+Conditional GET for /<actor_id>/properties and /<actor_id>/meta.
+
+Responses carry an ETag made from the actor's version stamp (store.VERSION, changed after every
+write to properties or meta, see store.track_versions()) and the app version. A request with a
+matching If-None-Match gets a 304 right after authentication and authorisation, without reading or
+serializing the properties. The stamp comes with the actor's internal store, which is loaded during
+authentication anyway.
+
+Anything else is answered by the GET of the actingweb handler, so a conditional request that misses
+authenticates twice.
+
+If-Modified-Since is not used to answer 304s: with one-second resolution it can not tell apart
+two writes in the same second. Last-Modified is still sent for information.
+"""
+import os
+import threading
+from email.utils import formatdate
+from actingweb import auth
+from actingweb.handlers import properties, meta
+from src import store, metrics
+
+CONDITIONAL_GET = os.getenv('GMAIL_CONDITIONAL_GET', 'true').lower() == 'true'
+
+
+class ConditionalStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.conditional = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    def count(self, conditional=False, hit=False):
+        with self._lock:
+            self.requests += 1
+            self.conditional += conditional
+            self.not_modified += hit
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'conditional': self.conditional,
+                'not_modified': self.not_modified,
+                'hit_rate': round(self.not_modified / self.conditional, 3) if self.conditional else 0.0,
+            }
+
+
+STATS = ConditionalStats()
+metrics.collector('conditional', STATS.as_dict)
+
+
+def etag(myself, config):
+    """ The ETag of an actor's properties and meta, None if the actor has no version yet. """
+    version = myself.store.__dict__.get(store.VERSION) if myself else None
+    if not version:
+        return None
+    return 'W/"' + version + '.' + str(config.version) + '"'
+
+
+def _matches(header, tag):
+    if header.strip() == '*':
+        return True
+    return tag in [t.strip() for t in header.split(',')]
+
+
+class ConditionalMixin:
+    """
+    Answers If-None-Match before the GET of the actingweb handler and leaves the validators for
+    application.Handler.get_response() in self.etag and self.last_modified.
+    """
+    aw_path = ''
+    # False if the path is readable without authentication
+    approved = True
+    etag = None
+    last_modified = None
+
+    def _answered(self):
+        """ Set the validators after the GET of the actingweb handler. """
+        myself = getattr(self.on_aw, 'myself', None)
+        if self.response.status_code == 200 and myself:
+            self._validators(myself)
+
+    def _not_modified(self, actor_id, subpath):
+        header = self.request.get_header('If-None-Match')
+        if not header:
+            STATS.count()
+            return False
+        # Leaves the response alone, anything but an authorised match gets its error from the GET
+        myself, check = auth.init_actingweb(appreq=self, actor_id=actor_id, path=self.aw_path, subpath=subpath,
+                                            add_response=False, config=self.config)
+        tag = etag(myself, self.config)
+        hit = bool(tag and (not self.approved or check.response['code'] == 200) and _matches(header, tag) and
+                   check.check_authorisation(path=self.aw_path, subpath=subpath.split('/')[0], method='GET',
+                                             approved=self.approved))
+        STATS.count(conditional=True, hit=hit)
+        if hit:
+            self._validators(myself)
+            self.response.set_status(304, 'Not Modified')
+        return hit
+
+    def _validators(self, myself):
+        self.etag = etag(myself, self.config)
+        if self.etag:
+            modified = store.version_time(myself.store.__dict__.get(store.VERSION))
+            self.last_modified = formatdate(modified, usegmt=True) if modified else None
+
+
+class ConditionalPropertiesHandler(ConditionalMixin, properties.PropertiesHandler):
+    aw_path = 'properties'
+
+    def get(self, actor_id, name):
+        if not CONDITIONAL_GET or self.request.get('_method'):
+            return super().get(actor_id, name)
+        if not self._not_modified(actor_id, name or ''):
+            super().get(actor_id, name)
+            self._answered()
+
+
+class ConditionalMetaHandler(ConditionalMixin, meta.MetaHandler):
+    aw_path = 'meta'
+    approved = False
+
+    def get(self, actor_id, path):
+        if not CONDITIONAL_GET:
+            return super().get(actor_id, path)
+        if not self._not_modified(actor_id, path or ''):
+            super().get(actor_id, path)
+            self._answered()
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+from src import metrics
+
+# Bounds for the in-process caches, per process
+DEDUP_MAX_ACTORS = int(os.getenv('GMAIL_DEDUP_MAX_ACTORS', '10000'))
+DEDUP_MAX_MESSAGES = int(os.getenv('GMAIL_DEDUP_MAX_MESSAGES', '2000'))
+
+
+class Watermarks:
+    """
+    Last history id processed per actor, so stale or duplicate Gmail notifications can be
+    dropped before the actor is loaded from the datastore. A miss (other process, evicted,
+    restarted) just means the notification takes the normal path.
+    """
+
+    def __init__(self, max_actors=DEDUP_MAX_ACTORS):
+        self.max_actors = max_actors
+        self._marks = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_stale(self, actor_id, history_id):
+        with self._lock:
+            mark = self._marks.get(actor_id)
+            if mark is not None and history_id <= mark:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {'duplicates': self.hits, 'passed': self.misses}
+
+    def advance(self, actor_id, history_id):
+        if not actor_id or not history_id:
+            return
+        history_id = int(history_id)
+        with self._lock:
+            if history_id > self._marks.get(actor_id, 0):
+                self._marks[actor_id] = history_id
+            self._marks.move_to_end(actor_id)
+            while len(self._marks) > self.max_actors:
+                self._marks.popitem(last=False)
+
+    def forget(self, actor_id):
+        with self._lock:
+            self._marks.pop(actor_id, None)
+
+
+class SeenIndex:
+    """ Bounded LRU of message ids already fetched and published, per actor. """
+
+    def __init__(self, max_actors=DEDUP_MAX_ACTORS, max_messages=DEDUP_MAX_MESSAGES):
+        self.max_actors = max_actors
+        self.max_messages = max_messages
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def unseen(self, actor_id, ids):
+        """ Return the ids in ids that have not been marked as seen for actor_id, in order. """
+        ids = list(ids)
+        with self._lock:
+            seen = self._seen.get(actor_id)
+            if not seen:
+                return ids
+            out = [i for i in ids if i not in seen]
+            self.skipped += len(ids) - len(out)
+            return out
+
+    def mark(self, actor_id, ids):
+        with self._lock:
+            seen = self._seen.get(actor_id)
+            if seen is None:
+                seen = OrderedDict()
+                self._seen[actor_id] = seen
+            self._seen.move_to_end(actor_id)
+            for i in ids:
+                seen[i] = True
+                seen.move_to_end(i)
+            while len(seen) > self.max_messages:
+                seen.popitem(last=False)
+            while len(self._seen) > self.max_actors:
+                self._seen.popitem(last=False)
+
+    def forget(self, actor_id):
+        with self._lock:
+            self._seen.pop(actor_id, None)
+
+
+WATERMARKS = Watermarks()
+SEEN = SeenIndex()
+metrics.collector('dedup', WATERMARKS.stats)
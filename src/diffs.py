@@ -0,0 +1,159 @@
+import os
+import logging
+import threading
+import time
+from src import codec, metrics
+
+# Seconds a diff for property new is held back to merge it with later ones (0: only merge the
+# pages of one history run), and the message count that flushes it early
+DIFF_WINDOW = float(os.getenv('GMAIL_DIFF_WINDOW', '0'))
+DIFF_MAX_MESSAGES = int(os.getenv('GMAIL_DIFF_MAX_MESSAGES', '500'))
+
+
+def merge_pointers(old, new):
+    """ Merge two message log pointers ({since, cursor, count}) into one covering both ranges. """
+    if old is None:
+        return new
+    return {
+        'since': str(min(int(old['since']), int(new['since']))),
+        'cursor': str(max(int(old['cursor']), int(new['cursor']))),
+        'count': old['count'] + new['count'],
+    }
+
+
+def merge_messages(old, new):
+    """ Merge two dicts of message id -> message, keeping the order they arrived in. """
+    if old is None:
+        return new
+    out = dict(old)
+    out.update(new)
+    return out
+
+
+class _Pending:
+    __slots__ = ('myself', 'payload', 'messages', 'diffs', 'first', 'lock')
+
+    def __init__(self):
+        self.myself = None
+        self.payload = None
+        self.messages = 0
+        self.diffs = 0
+        self.first = None
+        # Held while a diff is taken out and registered, so diffs for an actor go out in order
+        self.lock = threading.Lock()
+
+
+class DiffAggregator:
+    """
+    Merges the diffs on property new for an actor into one register_diffs() call, so subscribers get
+    one diff (one stored diff, one sequence number and one callback per subscription) per window
+    instead of one per history page or Gmail push.
+
+    With window > 0 a flusher thread sends diffs once they are window seconds old, started on first
+    use and after a fork like worker.CoalescingQueue (uwsgi only, use window 0 on Lambda). Pending
+    diffs are lost if the process dies, subscribers catch up from the message log cursor.
+    """
+
+    def __init__(self, merge=merge_pointers, window=DIFF_WINDOW, max_messages=DIFF_MAX_MESSAGES,
+                 name='gmail-diffs'):
+        self.merge = merge
+        self.window = window
+        self.max_messages = max_messages
+        self.name = name
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.diffs_in = 0
+        self.diffs_out = 0
+        # register_diffs() calls merged away, each one a delivery to every subscriber of property new
+        self.deliveries_saved = 0
+
+    def add(self, myself, payload, messages=0):
+        """ Queue a diff for myself, it is merged with pending ones and sent by flush() or the flusher. """
+        with self._lock:
+            p = self._pending.get(myself.id)
+            if not p:
+                p = self._pending[myself.id] = _Pending()
+            p.myself = myself
+            p.payload = self.merge(p.payload, payload)
+            p.messages += messages
+            p.diffs += 1
+            if p.first is None:
+                p.first = time.monotonic()
+            self.diffs_in += 1
+            full = p.messages >= self.max_messages
+        if full:
+            self.flush(myself.id)
+        elif self.window > 0:
+            self._ensure_started()
+
+    def end_run(self, actor_id):
+        """ Called at the end of a history run, sends the diff now unless it is held for a window. """
+        if self.window <= 0:
+            self.flush(actor_id)
+
+    def flush(self, actor_id=None):
+        """ Send the pending diff of actor_id, or of all actors. """
+        with self._lock:
+            ids = [actor_id] if actor_id else list(self._pending)
+        for i in ids:
+            self._flush(i)
+
+    def _flush(self, actor_id):
+        p = self._pending.get(actor_id)
+        if not p:
+            return
+        with p.lock:
+            with self._lock:
+                myself, payload, diffs = p.myself, p.payload, p.diffs
+                if payload is None:
+                    return
+                p.payload = None
+                p.messages = 0
+                p.diffs = 0
+                p.first = None
+            with metrics.timer('diffs.register_diffs'):
+                myself.register_diffs(target='properties', subtarget='new', blob=codec.dumps(payload))
+            with self._lock:
+                self.diffs_out += 1
+                self.deliveries_saved += diffs - 1
+        logging.debug('Sent diff for %s merged from %d', actor_id, diffs)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.window, 1.0))
+            now = time.monotonic()
+            with self._lock:
+                due = [k for k, p in self._pending.items() if p.first is not None and now - p.first >= self.window]
+                # Forget actors with nothing pending
+                for k in [k for k, p in self._pending.items() if p.payload is None and not p.lock.locked()]:
+                    del self._pending[k]
+            for k in due:
+                try:
+                    self._flush(k)
+                except Exception as e:
+                    logging.warning('Not able to send diff for ' + k + ': ' + str(e))
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for p in self._pending.values() if p.payload is not None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'diffs_in': self.diffs_in,
+                'diffs_out': self.diffs_out,
+                'diffs_saved': self.diffs_in - self.diffs_out - sum(
+                    p.diffs for p in self._pending.values()),
+                'deliveries_saved': self.deliveries_saved,
+                'pending': sum(1 for p in self._pending.values() if p.payload is not None),
+            }
@@ -0,0 +1,240 @@
+"""
+Streaming-pull dispatcher for GMAIL_PUBSUB_MODE=shared.
+
+All actors' Gmail watches publish to one shared topic. This long-running worker pulls from the
+shared subscription, routes each notification to its actor by emailAddress and processes them in
+batches, one history run per actor per batch.
+
+    GMAIL_PUBSUB_MODE=shared python -m src.dispatcher
+
+Set PUBSUB_EMULATOR_HOST to run against the local Pub/Sub emulator (see docker-compose.yml).
+"""
+import os
+import logging
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import pubsub_v1 as pubsub
+from google.api_core import exceptions as google_exceptions
+from src import gmail, codec, dedup, pubsub_clients
+
+DISPATCH_BATCH_SIZE = int(os.getenv('GMAIL_DISPATCH_BATCH_SIZE', '100'))
+DISPATCH_BATCH_WAIT = float(os.getenv('GMAIL_DISPATCH_BATCH_WAIT', '0.5'))
+DISPATCH_WORKERS = int(os.getenv('GMAIL_DISPATCH_WORKERS', '4'))
+# Seconds an email -> actor id lookup is cached, actors can be deleted and created again elsewhere
+DISPATCH_INDEX_TTL = float(os.getenv('GMAIL_DISPATCH_INDEX_TTL', '300'))
+
+
+def ensure_shared_pubsub(topic=None, subscription=None):
+    """ Create the shared topic, Gmail's publish permission and the pull subscription if missing. """
+    topic = topic or gmail.GMAIL_SHARED_TOPIC
+    subscription = subscription or gmail.GMAIL_SHARED_SUBSCRIPTION
+    publisher = pubsub_clients.publisher()
+    try:
+        publisher.create_topic(request={"name": topic})
+    except google_exceptions.AlreadyExists:
+        pass
+    if not os.getenv('PUBSUB_EMULATOR_HOST'):
+        publisher.set_iam_policy(request={"resource": topic, "policy": {
+            "bindings": [{
+                "role": "roles/pubsub.publisher",
+                "members": ["serviceAccount:gmail-api-push@system.gserviceaccount.com"],
+            }],
+        }})
+    subscriber = pubsub_clients.subscriber()
+    try:
+        subscriber.create_subscription(request={
+            "name": subscription,
+            "topic": topic,
+            "ack_deadline_seconds": 60,
+            "retain_acked_messages": False
+        })
+    except google_exceptions.AlreadyExists:
+        pass
+    return subscriber
+
+
+class EmailIndex:
+    """
+    email -> actor id, backed by the actingweb creator index and cached in process for ttl seconds.
+    Misses are not cached, an actor created in another process is found on its first notification.
+    The app does not set unique_creator, so the index is queried directly (Actor.get_from_creator()
+    finds nothing then), an email with more than one actor is not routed.
+    """
+
+    def __init__(self, config, max_size=dedup.DEDUP_MAX_ACTORS, ttl=DISPATCH_INDEX_TTL):
+        self.config = config
+        self.max_size = max_size
+        self.ttl = ttl
+        # email -> (actor id, monotonic expiry)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, email):
+        with self._lock:
+            hit = self._cache.get(email)
+            if hit and hit[1] > time.monotonic():
+                self._cache.move_to_end(email)
+                return hit[0]
+        found = self.config.DbActor.DbActor().get_by_creator(creator=email) or []
+        actor_id = found[0]['id'] if len(found) == 1 else None
+        if len(found) > 1:
+            logging.warning('Not routing notification for ' + email + ', it has ' + str(len(found)) + ' actors')
+        with self._lock:
+            if actor_id:
+                self._cache[email] = (actor_id, time.monotonic() + self.ttl)
+                self._cache.move_to_end(email)
+            else:
+                self._cache.pop(email, None)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return actor_id
+
+    def forget(self, email):
+        with self._lock:
+            self._cache.pop(email, None)
+
+
+class Dispatcher:
+
+    def __init__(self, config, process=None, index=None, subscription=None, batch_size=DISPATCH_BATCH_SIZE,
+                 batch_wait=DISPATCH_BATCH_WAIT, workers=DISPATCH_WORKERS):
+        """
+        :param config: actingweb config
+        :param process: Callable(actor_id, history_id, config) returning False if there is no such actor,
+            defaults to on_aw.process_notification
+        :param index: Object with lookup(email) -> actor id and forget(email), defaults to EmailIndex
+        """
+        if not process:
+            from src import on_aw
+            process = on_aw.process_notification
+        self.config = config
+        self.process = process
+        self.index = index or EmailIndex(config)
+        self.subscription = subscription or gmail.GMAIL_SHARED_SUBSCRIPTION
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.workers = workers
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._future = None
+        self._stopped = False
+        self.received = 0
+        self.batches = 0
+        self.dispatched = 0
+        self.unrouted = 0
+        self.duplicates = 0
+        self.failed = 0
+
+    def _on_message(self, message):
+        with self._cond:
+            self.received += 1
+            self._buffer.append(message)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _flush_loop(self):
+        while not self._stopped:
+            with self._cond:
+                if len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.batch_wait)
+                msgs, self._buffer = self._buffer, []
+            if msgs:
+                self.dispatch(msgs)
+
+    def dispatch(self, messages):
+        """ Group a batch of pulled messages by actor and run one history sync per actor. """
+        self.batches += 1
+        groups = {}
+        for m in messages:
+            try:
+                payload = codec.loads(m.data)
+                email = payload['emailAddress']
+                history_id = int(payload['historyId'])
+            except (ValueError, KeyError, AttributeError):
+                m.ack()
+                continue
+            g = groups.setdefault(email, [0, []])
+            g[0] = max(g[0], history_id)
+            g[1].append(m)
+
+        def run(email):
+            history_id, msgs = groups[email]
+            try:
+                routed = self._route(email, history_id)
+            except Exception as e:
+                logging.warning('Dispatch to ' + email + ' failed: ' + str(e))
+                self.failed += 1
+                for m in msgs:
+                    m.nack()
+                return
+            if routed == 'dispatched':
+                self.dispatched += 1
+            elif routed == 'duplicate':
+                self.duplicates += len(msgs)
+            else:
+                self.unrouted += len(msgs)
+            for m in msgs:
+                m.ack()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            list(pool.map(run, groups))
+
+    def _route(self, email, history_id):
+        """ Process a notification for email, returns 'dispatched', 'duplicate' or 'unrouted'. """
+        for _ in range(2):
+            actor_id = self.index.lookup(email)
+            if not actor_id:
+                return 'unrouted'
+            if dedup.WATERMARKS.is_stale(actor_id, history_id):
+                return 'duplicate'
+            if self.process(actor_id, history_id, self.config) is not False:
+                return 'dispatched'
+            # The cached actor has been deleted, it may have been created again under a new id
+            self.index.forget(email)
+            dedup.WATERMARKS.forget(actor_id)
+        return 'unrouted'
+
+    def start(self, subscriber=None):
+        subscriber = subscriber or pubsub_clients.subscriber()
+        flow = pubsub.types.FlowControl(max_messages=self.batch_size * 2)
+        self._future = subscriber.subscribe(self.subscription, callback=self._on_message, flow_control=flow)
+        threading.Thread(target=self._flush_loop, name='gmail-dispatch', daemon=True).start()
+        return self._future
+
+    def stop(self):
+        self._stopped = True
+        if self._future:
+            self._future.cancel()
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'batches': self.batches,
+            'actors_dispatched': self.dispatched,
+            'unrouted': self.unrouted,
+            'duplicates': self.duplicates,
+            'failed': self.failed,
+        }
+
+
+def main():
+    from application import get_config
+    logging.info('Starting Gmail dispatcher on ' + gmail.GMAIL_SHARED_SUBSCRIPTION)
+    subscriber = ensure_shared_pubsub()
+    d = Dispatcher(get_config())
+    future = d.start(subscriber)
+    try:
+        while True:
+            time.sleep(60)
+            logging.info('Gmail dispatcher: ' + json.dumps(d.stats()))
+            if future.done():
+                future.result()
+    except KeyboardInterrupt:
+        d.stop()
+
+
+if __name__ == '__main__':
+    main()
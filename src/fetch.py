@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Gmail API quota units per method, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'messages.get': 5,
+    'messages.attachments.get': 5,
+    'messages.list': 5,
+    'history.list': 2,
+    'labels.list': 1,
+    'getProfile': 1,
+    'watch': 100,
+    'stop': 50,
+}
+# Per-user limit is 250 units/s (moving average), a short burst above that is tolerated
+DEFAULT_RATE = 250
+DEFAULT_BURST = 250
+
+
+class TokenBucket:
+    """ Thread-safe token bucket counting Gmail quota units. """
+
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units=1):
+        """ Block until units are available, returns seconds spent waiting. """
+        units = min(float(units), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= units:
+                    self.tokens -= units
+                    self.waited += waited
+                    return waited
+                delay = (units - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def reserve(self, units=1):
+        """
+        Take units now, the balance may go below zero. For callers that can not block (asyncio).
+        :return: Seconds to wait before using the units
+        """
+        units = min(float(units), self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= units
+            delay = max(0.0, -self.tokens / self.rate)
+            self.waited += delay
+        return delay
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket_for(user, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+    """ Process-wide token bucket for a Gmail user, shared by all threads serving that user. """
+    with _buckets_lock:
+        b = _buckets.get(user)
+        if not b:
+            b = TokenBucket(rate=rate, capacity=capacity)
+            _buckets[user] = b
+        return b
+
+
+class FetchStats:
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.busy = 0.0
+        self.wall = 0.0
+        self.throttled = 0.0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            if self.in_flight > self.peak:
+                self.peak = self.in_flight
+
+    def leave(self, busy, throttled):
+        with self._lock:
+            self.in_flight -= 1
+            self.busy += busy
+            self.throttled += throttled
+
+    @property
+    def concurrency(self):
+        """ Average number of calls in flight over the run. """
+        if not self.wall:
+            return 0.0
+        return self.busy / self.wall
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'max_workers': self.max_workers,
+            'peak_concurrency': self.peak,
+            'avg_concurrency': round(self.concurrency, 2),
+            'wall_seconds': round(self.wall, 3),
+            'throttled_seconds': round(self.throttled, 3),
+        }
+
+
+class ConcurrentFetcher:
+    """
+    Run the same call for a set of items on a bounded thread pool, throttled by a quota token bucket.
+    """
+
+    def __init__(self, max_workers=8, bucket=None, units=QUOTA_UNITS['messages.get']):
+        self.max_workers = max(1, int(max_workers))
+        self.bucket = bucket
+        self.units = units
+        self.stats = FetchStats(self.max_workers)
+
+    def _call(self, fn, item):
+        throttled = 0.0
+        if self.bucket:
+            throttled = self.bucket.acquire(self.units)
+        self.stats.enter()
+        start = time.monotonic()
+        try:
+            return fn(item)
+        except Exception as e:
+            logging.warning('Concurrent fetch of ' + str(item) + ' failed: ' + str(e))
+            return None
+        finally:
+            self.stats.leave(time.monotonic() - start, throttled)
+
+    def map(self, fn, items):
+        """
+        :param fn: Callable taking one item
+        :param items: Iterable of items
+        :return: Dict of item -> fn(item) (None if the call raised)
+        """
+        items = list(items)
+        if not items:
+            return {}
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            results = dict(zip(items, pool.map(lambda i: self._call(fn, i), items)))
+        self.stats.wall += time.monotonic() - start
+        return results
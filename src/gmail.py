@@ -1,20 +1,44 @@
+import os
 import logging
 import time
 import base64
+import threading
 import json
-from google.cloud import pubsub_v1 as pubsub
-from google.api_core import exceptions as google_exceptions
+from src import batch, fetch, projection, dedup, pubsub_clients, logutil, store, watch_index, resync, labels
+from src import blobs, codec, records, tokens, transport, metrics
 
-GMAIL_URL = "https://www.googleapis.com/gmail/v1/users/"
+GMAIL_URL = os.getenv('GMAIL_URL', "https://www.googleapis.com/gmail/v1/users/")
+GMAIL_BATCH_URL = os.getenv('GMAIL_BATCH_URL', "https://www.googleapis.com/batch/gmail/v1")
+# How new messages are fetched in get_history: 'serial' (one call per message), 'batch' or 'concurrent'
+GMAIL_FETCH_MODE = os.getenv('GMAIL_FETCH_MODE', 'serial')
+# Max parallel message fetches per request and Gmail quota units/s per user in 'concurrent' mode
+GMAIL_FETCH_CONCURRENCY = int(os.getenv('GMAIL_FETCH_CONCURRENCY', '8'))
+GMAIL_QUOTA_RATE = int(os.getenv('GMAIL_QUOTA_RATE', str(fetch.DEFAULT_RATE)))
+# Ask Gmail for partial responses (fields/metadataHeaders masks) instead of filtering after download
+GMAIL_PROJECTION = os.getenv('GMAIL_PROJECTION', 'true').lower() == 'true'
+# Share of message fetches that also fetch the unprojected message to measure bytes saved
+GMAIL_PROJECTION_SAMPLE = float(os.getenv('GMAIL_PROJECTION_SAMPLE', '0'))
 # Hardcoded for now
 GMAIL_PROJECT = "proud-structure-220107"
+# 'push' creates a topic and push subscription per actor, 'shared' uses one topic for all actors,
+# read by the streaming-pull dispatcher (python -m src.dispatcher)
+GMAIL_PUBSUB_MODE = os.getenv('GMAIL_PUBSUB_MODE', 'push')
+GMAIL_SHARED_TOPIC = os.getenv('GMAIL_SHARED_TOPIC', 'projects/' + GMAIL_PROJECT + '/topics/mail-shared')
+GMAIL_SHARED_SUBSCRIPTION = os.getenv('GMAIL_SHARED_SUBSCRIPTION',
+                                      'projects/' + GMAIL_PROJECT + '/subscriptions/mail-shared')
 
 
+@metrics.instrument('gmail')
 class GMail:
 
-    def __init__(self, me=None, config=None, auth=None):
+    def __init__(self, me=None, config=None, auth=None, uow=None):
+        """
+        :param uow: store.UnitOfWork to defer property/store writes to, if not set writes go straight through
+        """
         if not me or not config or not auth:
             return
+        self.uow = uow or store.UnitOfWork(me, defer=False)
+        self.uow.load()
         self.history_id = me.property.historyId
         if self.history_id:
             self.history_id = int(self.history_id)
@@ -22,13 +46,66 @@ class GMail:
         self.subscription = me.store.pubsub_subscription
         self.watch_exp = me.store.watch_expiry
         self.myconf = None
+        self.fetch_stats = None
+        self.resync_stats = None
         if self.watch_exp:
             self.watch_exp = int(self.watch_exp)
         self.myself = me
         self.config = config
         self.auth = auth
+        # Auth keeps the status of its last call, see _auth_call()
+        self._auth_lock = threading.Lock()
         self.my_config()
 
+    def _oauth_get(self, url):
+        """ auth.oauth_get() with a token that is not about to expire (see src.tokens) over src.transport. """
+        return self._send('GET', url)[0]
+
+    def _oauth_post(self, url, params=None):
+        return self._send('POST', url, params=params)[0]
+
+    def _send(self, method, url, params=None):
+        """
+        One call over the pooled transport. If the token is rejected (or there is no transport) the call
+        goes through actingweb's Auth, which refreshes the token and retries.
+        :return: (response data or None, HTTP status code)
+        """
+        tokens.MANAGER.prepare(self.auth)
+        start = time.perf_counter()
+        res, code = self._call(method, url, params)
+        metrics.gmail_call(self.myself.id, metrics.api_method(url), code, time.perf_counter() - start)
+        tokens.MANAGER.observe(self.auth)
+        return res, code
+
+    def _call(self, method, url, params):
+        token = getattr(self.auth, 'token', None)
+        if transport.TRANSPORT and token:
+            code, res = transport.TRANSPORT.call(method, url, token, params=params)
+            if code not in (401, 403):
+                return res, code
+        return self._auth_call(method, url, params=params)
+
+    def _auth_call(self, method, url, params=None):
+        """
+        The call through actingweb's Auth. Auth keeps the status code (and a refreshed token) of its last call,
+        so fetches running in parallel threads take turns.
+        :return: (response data or None, HTTP status code)
+        """
+        with self._auth_lock:
+            if method == 'GET':
+                res = self.auth.oauth_get(url)
+            else:
+                res = self.auth.oauth_post(url, params=params)
+            return res, self.auth.oauth.last_response_code
+
+    def _bucket(self):
+        """ The quota bucket of the user, shared by all requests and threads in the process. """
+        return fetch.bucket_for(self.myself.creator or self.myself.id, rate=GMAIL_QUOTA_RATE)
+
+    def _charge(self, method, calls=1):
+        """ Take the quota units of calls to a Gmail API method from the bucket, waiting if it is empty. """
+        return self._bucket().acquire(calls * fetch.QUOTA_UNITS[method])
+
     def my_config(self, **kwargs):
         dirty = False
         if not self.myconf:
@@ -70,13 +147,33 @@ class GMail:
                 dirty = True
                 self.myconf[k] = v
         if dirty:
-            self.myself.property.config = json.dumps(self.myconf)
+            self.uow.set_property('config', json.dumps(self.myconf))
+        self.projection = projection.compile(self.myconf, sample_rate=GMAIL_PROJECTION_SAMPLE,
+                                             bodies=blobs.streams('full'))
+        self._rules = None
+        self._blobs = None
+
+    def label_rules(self):
+        """ The compiled label rules of the config (see src.labels), label names are resolved on first use. """
+        if self._rules is None:
+            label_map, version = None, 0
+            if labels.needs_names(self.myconf):
+                label_map, version = labels.CACHE.get(self.myself.id, self.list_labels)
+            self._rules = labels.compile(self.myconf, label_map=label_map, version=version)
+        return self._rules
+
+    def list_labels(self):
+        """ Label name -> id for all labels in the mailbox, or None on failure. """
+        res = self._oauth_get(GMAIL_URL + 'me/labels?fields=labels(id,name)')
+        if not res:
+            logging.warning('Not able to list gmail labels')
+            return None
+        return {l.get('name'): l.get('id') for l in res.get('labels') or []}
 
     def set_up(self, refresh=False):
         if not self._create_pubsub(refresh=refresh):
             return False
-        if not self.create_watch(refresh=refresh):
-            return False
+        return self.create_watch(refresh=refresh)
 
     def all_ok(self):
         if self.watch_exp and self.topic and self.subscription and self.history_id:
@@ -91,27 +188,32 @@ class GMail:
         return True
 
     def get_profile(self):
-        profile = self.auth.oauth_get(GMAIL_URL + 'me/profile')
+        return self._set_profile(self._oauth_get(GMAIL_URL + 'me/profile'))
+
+    def _set_profile(self, profile):
         if not profile or self.myself.creator != profile.get('emailAddress'):
             return False
-        self.myself.property.messagesTotal = str(profile.get('messagesTotal'))
-        self.myself.property.threadsTotal = str(profile.get('threadsTotal'))
-        self.myself.property.historyId = str(profile.get('historyId'))
+        self.uow.set_property('messagesTotal', str(profile.get('messagesTotal')))
+        self.uow.set_property('threadsTotal', str(profile.get('threadsTotal')))
+        self.uow.set_property('historyId', str(profile.get('historyId')))
         self.history_id = profile.get('historyId')
         if self.history_id:
             self.history_id = int(self.history_id)
         return True
 
     def _delete_pubsub(self):
+        if GMAIL_PUBSUB_MODE == 'shared':
+            # Never delete the shared topic, stopping the watch is enough
+            return True
         if self.subscription:
-            client = pubsub.SubscriberClient()
+            client = pubsub_clients.subscriber()
             try:
                 client.delete_subscription(request={ "subscription": self.subscription})
             except:
                 logging.warning('Not able to delete pub/sub subscription ' + self.subscription)
                 return False
         if self.topic:
-            publisher = pubsub.PublisherClient()
+            publisher = pubsub_clients.publisher()
             try:
                 publisher.delete_topic(request={"topic": self.topic})
             except:
@@ -120,7 +222,17 @@ class GMail:
         return True
 
     def _create_pubsub(self, refresh=False):
-        publisher = pubsub.PublisherClient()
+        if GMAIL_PUBSUB_MODE == 'shared':
+            if self.topic != GMAIL_SHARED_TOPIC:
+                self.uow.set_store('pubsub_topic', GMAIL_SHARED_TOPIC)
+                self.topic = GMAIL_SHARED_TOPIC
+            if self.subscription != GMAIL_SHARED_SUBSCRIPTION:
+                self.uow.set_store('pubsub_subscription', GMAIL_SHARED_SUBSCRIPTION)
+                self.subscription = GMAIL_SHARED_SUBSCRIPTION
+            return True
+        # Imported here, it pulls in gRPC and is only needed when setting up a watch
+        from google.api_core import exceptions as google_exceptions
+        publisher = pubsub_clients.publisher()
         name = 'projects/' + GMAIL_PROJECT + '/topics/mail-' + self.myself.id
         if not self.topic or refresh:
             try:
@@ -130,7 +242,7 @@ class GMail:
             except (ValueError, google_exceptions.GoogleAPICallError):
                 logging.warning('Not able to create Google pub/sub topic ' + name)
                 return False
-            # Allow gmail to publish to the topic
+            # Allow gmail to publish to the topic (IAM is not implemented in the Pub/Sub emulator)
             policy = {
                 "bindings": [{
                     "role": "roles/pubsub.publisher",
@@ -138,15 +250,16 @@ class GMail:
                 }],
             }
             try:
-                response = publisher.set_iam_policy(request={"resource": name, "policy": policy})
+                if not os.getenv('PUBSUB_EMULATOR_HOST'):
+                    publisher.set_iam_policy(request={"resource": name, "policy": policy})
             except:
                 logging.warning('Not able to add gmail publish permission on ' + name)
                 return False
-            self.myself.store.pubsub_topic = name
+            self.uow.set_store('pubsub_topic', name)
             self.topic = name
         if not self.subscription or refresh:
             sub = 'projects/' + GMAIL_PROJECT + '/subscriptions/mail-' + self.myself.id
-            client = pubsub.SubscriberClient()
+            client = pubsub_clients.subscriber()
             try:
                 client.create_subscription(
                     request={
@@ -163,39 +276,69 @@ class GMail:
             except (ValueError, google_exceptions.GoogleAPICallError) as e:
                 logging.warning('Not able to create Google pub/sub subscription ' + sub + '\n' + e.args[0])
                 return False
-            self.myself.store.pubsub_subscription = sub
+            self.uow.set_store('pubsub_subscription', sub)
             self.subscription = sub
         return True
 
     def _stop_watch(self):
-        self.auth.oauth_post(GMAIL_URL + 'me/stop')
-        if (299 < self.auth.oauth.last_response_code < 199) and self.auth.oauth.last_response_code != 404:
+        code = self._send('POST', GMAIL_URL + 'me/stop')[1]
+        if (299 < code < 199) and code != 404:
             logging.warning('Not able to stop gmail watch')
             return False
-        self.myself.store.watch_expiry = None
+        self.uow.set_store('watch_expiry', None)
+        old_exp = self.watch_exp
+        self.uow.after_flush(lambda: watch_index.update(self.myself.id, old_expiry=old_exp))
         self.watch_exp = None
         return True
 
+    def watch_expires_in(self, now=None):
+        """ Seconds until the Gmail watch expires, 0 if there is no watch. """
+        expiry = watch_index.expiry_seconds(self.watch_exp)
+        if not expiry:
+            return 0
+        return expiry - (now or time.time())
+
+    def _watch_due(self, refresh=False):
+        return refresh or self.watch_expires_in() < 24 * 3600
+
     def create_watch(self, labels=None, refresh=False):
-        now = time.time()
-        if not self.watch_exp or now > self.watch_exp - (24 * 3600) or refresh:
-            params = {
-                "topicName": self.topic
-            }
-            if labels:
-                params['labelIds'] = labels
-                self.my_config(watchLabels=labels)
-                params['labelFilterAction'] = 'include'
-            res = self.auth.oauth_post(GMAIL_URL + 'me/watch', params=params)
-            if not res and not self.auth.oauth.last_response_code == 409:
-                logging.warning('Not able to create gmail watch')
-                return False
-            self.watch_exp = res.get('expiration', None)
-            self.history_id = res.get('historyId', None)
-            if self.watch_exp:
-                self.myself.store.watch_expiry = str(self.watch_exp)
-            if self.history_id:
-                self.myself.property.historyId = str(self.history_id)
+        if self._watch_due(refresh):
+            res, code = self._send('POST', GMAIL_URL + 'me/watch', params=self._watch_params(labels))
+            return self._set_watch(res, code)
+        return True
+
+    def _watch_params(self, labels=None):
+        params = {
+            "topicName": self.topic
+        }
+        if labels:
+            self.my_config(watchLabels=labels)
+            params['labelIds'] = sorted(self.label_rules().include)
+            params['labelFilterAction'] = 'include'
+        return params
+
+    def _set_watch(self, res, code=200):
+        """
+        Store a me/watch response. The historyId in it is the head of the mailbox, it is only used if there is
+        no history id yet: moving a stored one would skip the messages since the last processed notification,
+        the next notification (or a resync) processes them.
+        """
+        if not res and code != 409:
+            logging.warning('Not able to create gmail watch')
+            return False
+        res = res or {}
+        old_exp = self.watch_exp
+        new_exp = res.get('expiration', None)
+        if new_exp:
+            self.watch_exp = int(new_exp)
+            self.uow.set_store('watch_expiry', str(self.watch_exp))
+            # The index follows the stored expiry, so only once that is written
+            self.uow.after_flush(lambda: watch_index.update(self.myself.id, old_expiry=old_exp,
+                                                            new_expiry=int(new_exp)))
+        if not self.history_id and res.get('historyId'):
+            self.history_id = int(res['historyId'])
+            self.uow.set_property('historyId', str(self.history_id))
+            resync.stamp(self)
         return True
 
     def get_message(self, id=None, fmt=None):
@@ -203,91 +346,352 @@ class GMail:
         Retrieve a specific message from Gmail with id.
         :param id: Gmail message id
         :param fmt: string ('metadata', 'full', 'raw', 'minimal')
-        :return: Dict of message data from Gmail or empty dict
+        :return: records.Message with the message data from Gmail or empty dict
         """
         if not id:
             return {}
-        if not fmt:
-            fmt = self.myconf.get('msgFormat', 'metadata')
-        res = self.auth.oauth_get(GMAIL_URL + 'me/messages/' + str(id) + '?format=' + fmt)
+        fmt = self._format(fmt)
+        if blobs.streams(fmt):
+            return self._get_message_streamed(id, fmt)
+        res = self._oauth_get(self._message_url(id, fmt))
+        sample = self._oauth_get(self._message_url(id, fmt, project=False)) if self._sampled(res) else None
+        return self._got_message(res, sample)
+
+    def _format(self, fmt=None):
+        return fmt or self.myconf.get('msgFormat', 'metadata')
+
+    def _message_url(self, id, fmt, project=None):
+        if project is None:
+            project = GMAIL_PROJECTION
+        return GMAIL_URL + self.projection.message_path(id, fmt, project=project)
+
+    def _sampled(self, res):
+        """ Count a messages.get, True if the unprojected message should be fetched too to measure the savings. """
+        self.projection.stats.count()
+        return bool(GMAIL_PROJECTION and res and self.projection.should_sample())
+
+    def _got_message(self, res, sample=None):
+        """ The message from a messages.get response, sample is the unprojected response if _sampled(). """
+        if sample is not None:
+            self.projection.stats.sample(res, sample)
+            logging.debug('Message projection: %s', self.projection.stats.as_dict())
+        return self._strip_message(res)
+
+    def _get_message_streamed(self, id, fmt):
+        """
+        get_message() for 'raw' and 'full': large base64url values are decoded as they arrive and stored
+        as blobs, the message holds references to them (see src.blobs). A 'full' message gets its part
+        bodies and attachments as a flat list of parts.
+        """
+        splitter = self._get_split(self._message_url(id, fmt))
+        self.projection.stats.count()
+        if splitter is None:
+            return {}
+        try:
+            res = splitter.resolve(codec.loads(splitter.result()), self._blob_store())
+        except ValueError:
+            logging.warning('Not able to decode message %s of %s', id, self.myself.id)
+            return {}
+        finally:
+            splitter.close()
+        if fmt == 'full' and isinstance(res, dict) and res.get('payload'):
+            res['parts'] = message_parts(res['payload'])
+            for part in res['parts']:
+                if part['body'].get('attachmentId') and 'data' not in part['body']:
+                    self._get_attachment(id, part['body'])
+        return self._strip_message(res)
+
+    def _get_attachment(self, id, body):
+        """ Fetch an attachment into a part body (data in place of attachmentId), leaves it as is on failure. """
+        if GMAIL_FETCH_MODE == 'concurrent':
+            self._charge('messages.attachments.get')
+        splitter = self._get_split(GMAIL_URL + 'me/messages/' + str(id) + '/attachments/' + body['attachmentId'])
+        if splitter is None:
+            return
+        try:
+            res = splitter.resolve(codec.loads(splitter.result()), self._blob_store())
+        except ValueError:
+            return
+        finally:
+            splitter.close()
+        if isinstance(res, dict) and 'data' in res:
+            body['data'] = res['data']
+            del body['attachmentId']
+
+    def _get_split(self, url):
+        """
+        A GET streamed through a blobs.Splitter. Without the pooled transport, or if the token is rejected,
+        actingweb's Auth makes the call and the whole response is split after it arrived.
+        :return: The Splitter, None if the call failed
+        """
+        tokens.MANAGER.prepare(self.auth)
+        token = getattr(self.auth, 'token', None)
+        if transport.TRANSPORT and token:
+            splitter = blobs.Splitter()
+            start = time.perf_counter()
+            code = transport.TRANSPORT.stream(url, token, splitter.feed)
+            metrics.gmail_call(self.myself.id, metrics.api_method(url), code, time.perf_counter() - start)
+            if code not in (401, 403):
+                tokens.MANAGER.observe(self.auth)
+                if 200 <= code <= 299:
+                    return splitter
+                splitter.close()
+                return None
+            splitter.close()
+        start = time.perf_counter()
+        res, code = self._auth_call('GET', url)
+        metrics.gmail_call(self.myself.id, metrics.api_method(url), code, time.perf_counter() - start)
+        tokens.MANAGER.observe(self.auth)
+        if not res:
+            return None
+        return blobs.split(codec.dumps(res))
+
+    def _blob_store(self):
+        if self._blobs is None:
+            self._blobs = blobs.BlobStore(self.myself.id, self.config)
+        return self._blobs
+
+    def _strip_message(self, res):
         if not res or 'id' not in res:
             return {}
         if 'payload' in res and 'headers' in res['payload']:
-            hs = {}
-            for h in res['payload']['headers']:
-                name = h.get('name')
-                if name in self.myconf.get('msgHeaders', []):
-                    if name not in hs:
-                        hs[name] = []
-                    hs[name].append(h.get('value'))
-            res['headers'] = hs
+            res['headers'] = self.projection.filter_headers(res['payload']['headers'])
             del res['payload']
+        return records.Message(res)
+
+    def get_messages(self, ids=None, fmt=None):
+        """
+        Retrieve a set of messages from Gmail, using the batch endpoint if GMAIL_FETCH_MODE is 'batch'
+        or a bounded thread pool if it is 'concurrent'.
+        :param ids: Iterable of Gmail message ids
+        :param fmt: string ('metadata', 'full', 'raw', 'minimal')
+        :return: Dict of message id -> message data (same shape as get_message())
+        """
+        ids = list(ids or [])
+        fmt = self._format(fmt)
+        msgs = {}
+        if self._batched(fmt):
+            msgs = self._get_messages_batch(ids, fmt)
+        elif GMAIL_FETCH_MODE == 'concurrent':
+            msgs = self._get_messages_concurrent(ids, fmt)
+        # Anything not retrieved in a batch (or all if serial) is fetched one by one
+        for i in ids:
+            if i not in msgs:
+                msgs[i] = self.get_message(i, fmt=fmt)
+        return {i: msgs[i] for i in ids}
+
+    @staticmethod
+    def _batched(fmt):
+        """ True if messages in fmt are fetched with the batch endpoint. """
+        return GMAIL_FETCH_MODE == 'batch' and not blobs.streams(fmt)
+
+    def _get_messages_batch(self, ids, fmt):
+        msgs = {}
+        tokens.MANAGER.prepare(self.auth)
+        token = getattr(self.auth, 'token', None)
+        for chunk in batch.chunks(ids):
+            # Each part counts against the user's quota like a single messages.get
+            self._charge('messages.get', calls=len(chunk))
+            paths = [(i, batch.api_path(GMAIL_URL, self.projection.message_path(i, fmt, project=GMAIL_PROJECTION)))
+                     for i in chunk]
+            start = time.perf_counter()
+            res = batch.fetch_batch(GMAIL_BATCH_URL, token, paths)
+            metrics.gmail_call(self.myself.id, 'messages.get', 0 if res is None else 200,
+                               time.perf_counter() - start, parts=len(paths))
+            if res is None:
+                # Let the serial path (with the oauth refresh handling) pick up the rest
+                break
+            for i in chunk:
+                code, data = res.get(str(i), (0, None))
+                if code == 200:
+                    msgs[i] = self._strip_message(data)
+        return msgs
+
+    def _get_messages_concurrent(self, ids, fmt):
+        # A token about to expire is refreshed once here, not by every thread
+        tokens.MANAGER.prepare(self.auth)
+        fetcher = fetch.ConcurrentFetcher(
+            max_workers=GMAIL_FETCH_CONCURRENCY, bucket=self._bucket(), units=fetch.QUOTA_UNITS['messages.get'])
+        res = fetcher.map(lambda i: self.get_message(i, fmt=fmt), ids)
+        self.fetch_stats = fetcher.stats.as_dict()
+        logging.debug('Concurrent message fetch: %s', self.fetch_stats)
+        return {k: v for k, v in res.items() if v is not None}
+
+    def iter_history(self):
+        """
+        Walk me/history from the stored history id one page at a time.
+        Yields a dict of new messages (id -> message) per page. The page is checkpointed (historyId advanced and
+        flushed) and its messages marked as seen (src.dedup) when the next page is requested, i.e. after the caller
+        has handled it, so only one page is held in memory and an interrupted run resumes from the last handled page.
+        If the history id has expired (or a resync was interrupted), the mailbox is resynced first, see src.resync.
+        """
+        resynced = False
+        if resync.pending(self):
+            for page in resync.run(self):
+                yield page
+            if resync.pending(self):
+                return
+            resynced = True
+        start = self.history_id
+        token = None
+        while True:
+            self._charge('history.list')
+            res, code = self._send('GET', self._history_url(start, token))
+            if not res:
+                if code == 404 and not resynced:
+                    logging.warning('History of %s has expired at %s, starting full resync', self.myself.id, start)
+                    for page in resync.run(self):
+                        yield page
+                    if resync.pending(self):
+                        return
+                    resynced = True
+                    start = self.history_id
+                    token = None
+                    continue
+                return
+            records, token, checkpoint = self._history_page(res)
+            msgs = self._new_messages(records)
+            if msgs:
+                yield msgs
+            self._page_done(msgs, checkpoint)
+            if not token:
+                return
+
+    def _history_url(self, start, token=None):
+        return GMAIL_URL + self.projection.history_path(start, page_token=token, project=GMAIL_PROJECTION)
+
+    def _history_page(self, res):
+        """ history_page() of a me/history response. """
+        logutil.trace(self.myself.id, 'Got history: %s', logutil.LazyJson(res))
+        return history_page(res)
+
+    def _page_done(self, msgs, checkpoint):
+        """ After a page of iter_history() was handled: mark its messages as seen and checkpoint the history id. """
+        if msgs:
+            # Published, a redelivered push may skip them from now on
+            dedup.SEEN.mark(self.myself.id, [k for k, v in msgs.items() if v])
+        if checkpoint:
+            self.checkpoint(checkpoint)
+
+    def wanted(self, label_ids):
+        """ True if a message with these labels passes the watchLabels/nonWatchLabels/labelRule filter. """
+        return self.label_rules().match(label_ids)
+
+    def _new_messages(self, records):
+        """ Fetch the messages added in a page of history records that pass the label filter. """
+        ids = self._new_ids(records)
+        return self.get_messages(ids) if ids else {}
+
+    def _new_ids(self, records, rules=None):
+        """ Ids of the messages added in history records that pass the label rules and were not published yet. """
+        ids = (rules or self.label_rules()).select(records)
+        if not ids:
+            return []
+        # Skip messages already fetched and published for this actor
+        return dedup.SEEN.unseen(self.myself.id, ids)
+
+    def list_messages(self, page_token=None, max_results=500, query=None):
+        """ One page of messages.list (message ids and nextPageToken), or None on failure. """
+        self._charge('messages.list')
+        res = self._oauth_get(GMAIL_URL + self.projection.list_path(
+            page_token=page_token, max_results=max_results, query=query, project=GMAIL_PROJECTION))
+        logutil.trace(self.myself.id, 'Got message list: %s', logutil.LazyJson(res))
         return res
 
+    def mailbox_history_id(self):
+        """ The current history id of the mailbox, without storing it (see get_profile()). """
+        profile = self._oauth_get(GMAIL_URL + 'me/profile')
+        if not profile or not profile.get('historyId'):
+            return None
+        return int(profile.get('historyId'))
+
+    def checkpoint(self, history_id):
+        """ Persist history_id as the point to resume from, if it is ahead of the stored one. """
+        history_id = int(history_id)
+        if self.history_id and history_id <= int(self.history_id):
+            return
+        self.uow.set_property('historyId', str(history_id))
+        self.history_id = history_id
+        resync.stamp(self)
+        self.uow.flush()
+
     def get_history(self):
-        url = GMAIL_URL + 'me/history?historyTypes=messageAdded&startHistoryId=' + str(self.history_id)
-        res = self.auth.oauth_get(url)
-        logging.debug('Got history: ' + json.dumps(res))
-        if not res or not res.get('history'):
-            return []
-        history = res.get('history')
-        history_id = res.get('historyId')
-        next_token = res.get('nextPageToken')
-        while next_token:
-            res = self.auth.oauth_get(GMAIL_URL + 'me/history?historyTypes=messageAdded&startHistoryId=' +
-                                      str(self.history_id) + '&pageToken=' + next_token)
-            logging.debug('Got history: ' + json.dumps(res))
-            if not res or not res.get('history'):
-                next_token = None
-            else:
-                history.append(res.get('history'))
-                next_token = res.get('nextPageToken')
-        if history_id:
-            self.myself.property.historyId = str(history_id)
-            self.history_id = history_id
+        """ All new messages since the stored history id in one dict, see iter_history() for large backlogs. """
         msgs = {}
-        # We have a series of history records
-        for h in history:
-            # Each history record we can have a series of change types
-            for k, v in h.items():
-                # Only pick up new messages
-                if k != 'messagesAdded':
-                    continue
-                # There may be multiple messages
-                for i in v:
-                    found = False
-                    if not self.myconf.get('watchLabels'):
-                        found = True
-                    else:
-                        for l in i['message']['labelIds']:
-                            if l in self.myconf.get('watchLabels'):
-                                found = True
-                            break
-                    if self.myconf.get('nonWatchLabels'):
-                        for l in i['message']['labelIds']:
-                            if l in self.myconf.get('nonWatchLabels'):
-                                found = False
-                            break
-                    if found:
-                        msgs[i['message']['id']] = {}
-        # Add message data
-        for k, v in msgs.items():
-            msgs[k] = self.get_message(k)
+        for page in self.iter_history():
+            msgs.update(page)
         return msgs
 
     def process_callback(self, data=None):
-        if not data or not data.get('message', {}).get('data', None):
-            return False
-        msg = data.get('message', {}).get('data', '').encode('utf-8')
-        try:
-            payload = json.loads(base64.b64decode(msg).decode('utf-8'))
-        except json.JSONDecodeError:
+        payload = parse_notification(data)
+        if not payload:
             return False
-        if not payload or not payload.get('historyId', None):
-            return False
-        new_id = int(payload.get('historyId'))
-        if new_id > self.history_id:
-            history = self.get_history()
-        else:
-            history = {}
-        return history
+        return self.sync(int(payload.get('historyId')))
+
+    def iter_callback(self, data=None):
+        """ Like process_callback(), but yields the new messages page by page. """
+        payload = parse_notification(data)
+        if not payload:
+            return iter(())
+        return self.iter_sync(int(payload.get('historyId')))
+
+    def sync(self, new_id):
+        """ Fetch new messages if new_id (from a Gmail notification) is ahead of our stored history id. """
+        msgs = {}
+        for page in self.iter_sync(new_id):
+            msgs.update(page)
+        return msgs
+
+    def iter_sync(self, new_id):
+        """ Like sync(), but yields the new messages page by page, see iter_history(). """
+        if self._behind(new_id):
+            for page in self.iter_history():
+                yield page
+        self._synced(new_id)
+
+    def _behind(self, new_id):
+        return bool(self.history_id) and new_id > int(self.history_id)
+
+    def _synced(self, new_id):
+        """ After a notification with new_id was processed, redeliveries of it are skipped (see src.dedup). """
+        dedup.WATERMARKS.advance(self.myself.id, max(new_id, int(self.history_id or 0)))
+
+
+def history_page(res):
+    """
+    Split a me/history response.
+    :return: (history records, next page token, history id to checkpoint once the page is handled or None)
+    """
+    records = res.get('history') or []
+    token = res.get('nextPageToken')
+    if token:
+        # More to come, everything up to the last record on this page is done
+        ids = [int(h['id']) for h in records if h.get('id')]
+        return records, token, max(ids) if ids else None
+    return records, token, res.get('historyId')
+
+
+def message_parts(payload):
+    """ The leaf parts of a 'full' message payload in order, as dicts of partId, mimeType, filename and body. """
+    if payload.get('parts'):
+        return [leaf for p in payload['parts'] for leaf in message_parts(p)]
+    return [{'partId': payload.get('partId', ''), 'mimeType': payload.get('mimeType', ''),
+             'filename': payload.get('filename', ''), 'body': payload.get('body') or {}}]
+
+
+def parse_notification(data=None):
+    """
+    Decode the Gmail notification in a Pub/Sub push.
+    :param data: The json body of the push
+    :return: Dict with emailAddress and historyId, or None if not a valid notification
+    """
+    if not data or not data.get('message', {}).get('data', None):
+        return None
+    msg = data.get('message', {}).get('data', '').encode('utf-8')
+    try:
+        payload = codec.loads(base64.b64decode(msg).decode('utf-8'))
+    except (ValueError, json.JSONDecodeError):
+        return None
+    if not payload or not payload.get('historyId', None):
+        return None
+    return payload
@@ -0,0 +1,80 @@
+"""
+Import-time report: what a cold start spends on imports, from python -X importtime.
+
+    python -m src.importtime
+    python -m src.importtime --module src.renewal --top 40 --json
+
+Imports the module in a fresh interpreter and lists the modules with the most own and cumulative
+import time, plus totals per top-level package. Use it to check that a change does not pull
+google.cloud.pubsub_v1 or grpc back into the request path (see bench/coldstart.py).
+"""
+import os
+import sys
+import argparse
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def profile(module='application', code=None, python=sys.executable):
+    """
+    Import module (or run code) in a fresh interpreter with -X importtime.
+    :return: List of (module name, own microseconds, cumulative microseconds, nesting depth), in import order
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (ROOT, os.getenv('PYTHONPATH')) if p),
+               PYTHONDONTWRITEBYTECODE='1')
+    env.pop('PYTHONPROFILEIMPORTTIME', None)
+    res = subprocess.run([python, '-X', 'importtime', '-c', code or 'import ' + module], cwd=ROOT, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    lines = res.stderr.decode('utf-8', 'replace').splitlines()
+    if res.returncode:
+        raise RuntimeError('Importing ' + module + ' failed:\n' + '\n'.join(lines[-20:]))
+    rows = []
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(own), int(cumulative), depth))
+    return rows
+
+
+def report(rows, top=25):
+    """ Summary of profile() rows: total, top modules by own and cumulative time, time per package. """
+    packages = {}
+    for name, own, _, _ in rows:
+        pkg = name.split('.')[0]
+        packages[pkg] = packages.get(pkg, 0) + own
+    ms = lambda us: round(us / 1000.0, 1)
+    return {
+        'total_ms': ms(sum(r[1] for r in rows)),
+        'modules': len(rows),
+        'top_own_ms': [[r[0], ms(r[1])] for r in sorted(rows, key=lambda r: -r[1])[:top]],
+        'top_cumulative_ms': [[r[0], ms(r[2])] for r in sorted(rows, key=lambda r: -r[2])[:top]],
+        'packages_ms': {k: ms(v) for k, v in sorted(packages.items(), key=lambda kv: -kv[1])[:top]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time report for a cold start')
+    parser.add_argument('--module', default='application')
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+    out = report(profile(args.module), top=args.top)
+    if args.json:
+        print(json.dumps(out, indent=2))
+        return
+    print('%s: %d modules, %.1f ms' % (args.module, out['modules'], out['total_ms']))
+    for title, key in (('Own time', 'top_own_ms'), ('Cumulative time', 'top_cumulative_ms')):
+        print('\n' + title)
+        for name, t in out[key]:
+            print('  %8.1f ms  %s' % (t, name))
+    print('\nPer package')
+    for name, t in out['packages_ms'].items():
+        print('  %8.1f ms  %s' % (t, name))
+
+
+if __name__ == '__main__':
+    main()
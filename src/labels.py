@@ -0,0 +1,189 @@
+"""
+Label rules compiled from an actor's config.
+
+watchLabels includes (a message needs at least one of them, empty means all), nonWatchLabels
+excludes (a message with any of them is dropped) and the optional labelRule is a boolean
+expression that must also hold:
+
+    "labelRule": {"all": ["INBOX", {"not": "CATEGORY_PROMOTIONS"}, {"any": ["Work", "Label_12"]}]}
+
+The rules are compiled once per config into frozensets and nested predicates, and shared between
+requests (see compile()). Labels can be given by id or by name, names are resolved with a cached
+labels.list per actor.
+"""
+import os
+import json
+import logging
+import threading
+import time
+from src import metrics
+
+# Ids of the Gmail system labels, user label ids look like 'Label_123'
+SYSTEM_LABELS = frozenset([
+    'INBOX', 'SPAM', 'TRASH', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'CHAT',
+    'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS',
+])
+# Seconds a labels.list result is used to resolve label names
+LABELS_TTL = int(os.getenv('GMAIL_LABELS_TTL', '3600'))
+
+_OPERATORS = ('any', 'all', 'not')
+
+
+def is_label_id(label):
+    return label in SYSTEM_LABELS or label.startswith('Label_')
+
+
+def referenced(myconf):
+    """ All labels named in the label part of a config. """
+    out = set(myconf.get('watchLabels') or []) | set(myconf.get('nonWatchLabels') or [])
+    stack = [myconf.get('labelRule')]
+    while stack:
+        rule = stack.pop()
+        if isinstance(rule, str):
+            out.add(rule)
+        elif isinstance(rule, list):
+            stack.extend(rule)
+        elif isinstance(rule, dict):
+            stack.extend(rule.values())
+    return out
+
+
+def needs_names(myconf):
+    """ True if the config uses label names that have to be resolved with labels.list. """
+    return any(not is_label_id(l) for l in referenced(myconf))
+
+
+class LabelCache:
+    """ Per-actor label name -> id maps from labels.list, kept for LABELS_TTL seconds. """
+
+    def __init__(self, ttl=LABELS_TTL, max_actors=10000):
+        self.ttl = ttl
+        self.max_actors = max_actors
+        self._maps = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, actor_id, loader):
+        """
+        :param loader: Called without arguments to fetch the map on a miss, returns dict or None on failure
+        :return: (name -> id dict or None, version), the version changes whenever the map is reloaded
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._maps.get(actor_id)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1], entry[2]
+        label_map = loader()
+        if label_map is None:
+            return None, 0
+        with self._lock:
+            self.loads += 1
+            if len(self._maps) >= self.max_actors:
+                self._maps.clear()
+            self._maps[actor_id] = (now + self.ttl, label_map, self.loads)
+            return label_map, self.loads
+
+    def forget(self, actor_id):
+        with self._lock:
+            self._maps.pop(actor_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'loads': self.loads, 'actors': len(self._maps)}
+
+
+CACHE = LabelCache()
+metrics.collector('labels', CACHE.stats)
+
+
+def resolve(names, label_map):
+    """ Label ids for a list of label ids and/or names, unknown names are kept as they are. """
+    if not label_map:
+        return list(names)
+    return [l if is_label_id(l) else label_map.get(l, l) for l in names]
+
+
+def _compile_rule(rule, label_map):
+    if isinstance(rule, str):
+        label = resolve([rule], label_map)[0]
+        return lambda labels: label in labels
+    if not isinstance(rule, dict) or len(rule) != 1 or next(iter(rule)) not in _OPERATORS:
+        raise ValueError('Invalid label rule: ' + json.dumps(rule))
+    op, arg = next(iter(rule.items()))
+    if op == 'not':
+        inner = _compile_rule(arg, label_map)
+        return lambda labels: not inner(labels)
+    if not isinstance(arg, list):
+        arg = [arg]
+    plain = frozenset(resolve([a for a in arg if isinstance(a, str)], label_map))
+    nested = [_compile_rule(a, label_map) for a in arg if not isinstance(a, str)]
+    if op == 'any':
+        return lambda labels: not plain.isdisjoint(labels) or any(p(labels) for p in nested)
+    return lambda labels: plain.issubset(labels) and all(p(labels) for p in nested)
+
+
+class LabelRules:
+    """
+    Compiled watchLabels/nonWatchLabels/labelRule of one config.
+    Use compile() to get a cached instance rather than creating one directly.
+    """
+
+    def __init__(self, myconf, label_map=None):
+        self.include = frozenset(resolve(myconf.get('watchLabels') or [], label_map))
+        self.exclude = frozenset(resolve(myconf.get('nonWatchLabels') or [], label_map))
+        self.rule = None
+        if myconf.get('labelRule'):
+            try:
+                self.rule = _compile_rule(myconf.get('labelRule'), label_map)
+            except ValueError as e:
+                logging.warning(str(e) + ', ignoring labelRule')
+
+    def match(self, label_ids):
+        """ True if a message with these label ids passes the rules. """
+        label_ids = label_ids or ()
+        if self.include and self.include.isdisjoint(label_ids):
+            return False
+        if self.exclude and not self.exclude.isdisjoint(label_ids):
+            return False
+        return self.rule is None or self.rule(label_ids)
+
+    def select(self, records):
+        """ Ids of the added messages in a page of history records that pass the rules, in order. """
+        match = self.match
+        out = {}
+        for h in records:
+            for i in h.get('messagesAdded') or ():
+                m = i['message']
+                if match(m.get('labelIds')):
+                    out[m['id']] = True
+        return list(out)
+
+    def filter(self, msgs):
+        """ The messages (id -> message dict) that pass the rules. """
+        match = self.match
+        return {k: v for k, v in msgs.items() if v and match(v.get('labelIds'))}
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+_MAX_COMPILED = 1024
+
+
+def compile(myconf, label_map=None, version=0):
+    """
+    LabelRules for a config, shared between requests for as long as the config is unchanged.
+    :param label_map: Label name -> id from labels.list, needed only if the config uses label names
+    :param version: Version of label_map (see LabelCache.get()), part of the cache key
+    """
+    key = json.dumps([myconf.get('watchLabels'), myconf.get('nonWatchLabels'), myconf.get('labelRule'),
+                      version if label_map else 0], sort_keys=True)
+    with _compiled_lock:
+        rules = _compiled.get(key)
+        if not rules:
+            if len(_compiled) >= _MAX_COMPILED:
+                _compiled.clear()
+            rules = LabelRules(myconf, label_map=label_map)
+            _compiled[key] = rules
+        return rules
@@ -0,0 +1,90 @@
+"""
+Cheap debug logging for the hot paths.
+
+Payloads are wrapped so they are only serialized if the record is actually emitted, and then
+only up to LOG_MAX_PAYLOAD bytes. Payload dumps are also limited to traced actors: those listed
+in LOG_TRACE_ACTORS plus a stable LOG_TRACE_SAMPLE share of all actors, so DEBUG can be left on.
+"""
+import os
+import json
+import logging
+import zlib
+
+LOG_MAX_PAYLOAD = int(os.getenv('LOG_MAX_PAYLOAD', '2048'))
+LOG_TRACE_SAMPLE = float(os.getenv('LOG_TRACE_SAMPLE', '1.0'))
+LOG_TRACE_ACTORS = frozenset(a for a in os.getenv('LOG_TRACE_ACTORS', '').split(',') if a)
+
+LOG = logging.getLogger()
+
+
+def truncate(text, limit=None):
+    limit = LOG_MAX_PAYLOAD if limit is None else limit
+    if len(text) <= limit // 4:
+        return text
+    raw = text.encode('utf-8')
+    if len(raw) <= limit:
+        return text
+    return raw[:limit].decode('utf-8', 'ignore') + '...(' + str(len(raw) - limit) + ' more bytes)'
+
+
+def _default(obj):
+    # records.Message and the like, anything else is logged as its str()
+    to_dict = getattr(obj, 'to_dict', None)
+    return to_dict() if to_dict else str(obj)
+
+
+class LazyJson:
+    """ json.dumps(obj) on str(), stopping after limit bytes. obj can be a callable returning the object. """
+
+    __slots__ = ('obj', 'limit')
+
+    def __init__(self, obj, limit=None):
+        self.obj = obj
+        self.limit = LOG_MAX_PAYLOAD if limit is None else limit
+
+    def __str__(self):
+        obj = self.obj() if callable(self.obj) else self.obj
+        out = []
+        size = 0
+        for chunk in json.JSONEncoder(default=_default).iterencode(obj):
+            out.append(chunk)
+            size += len(chunk)
+            if size > self.limit:
+                return ''.join(out).encode('utf-8')[:self.limit].decode('utf-8', 'ignore') + '...(truncated)'
+        return ''.join(out)
+
+
+class LazyText:
+    """ Text or bytes, decoded and truncated on str(). """
+
+    __slots__ = ('text', 'limit')
+
+    def __init__(self, text, limit=None):
+        self.text = text
+        self.limit = LOG_MAX_PAYLOAD if limit is None else limit
+
+    def __str__(self):
+        text = self.text
+        if isinstance(text, bytes):
+            if len(text) > self.limit:
+                return text[:self.limit].decode('utf-8', 'ignore') + '...(' + str(len(text) - self.limit) + \
+                    ' more bytes)'
+            text = text.decode('utf-8', 'ignore')
+        return truncate(text or '', self.limit)
+
+
+def traced(actor_id):
+    """ Stable per-actor sampling, the same actor is either always or never traced. """
+    if actor_id in LOG_TRACE_ACTORS:
+        return True
+    if LOG_TRACE_SAMPLE >= 1.0:
+        return True
+    if not actor_id or LOG_TRACE_SAMPLE <= 0.0:
+        return False
+    return (zlib.crc32(actor_id.encode('utf-8')) % 10000) < LOG_TRACE_SAMPLE * 10000
+
+
+def trace(actor_id, msg, *args):
+    """ logging.debug(msg, *args) for traced actors, args are only formatted if the line is emitted. """
+    if LOG.isEnabledFor(logging.DEBUG) and traced(actor_id):
+        LOG.debug(msg, *args)
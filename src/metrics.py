@@ -0,0 +1,360 @@
+"""
+Timers and counters for the callback pipeline, served on /metrics in Prometheus text format.
+
+GMail methods and OnAWGoogleMail hooks are wrapped with instrument(), other stages with timed()
+or timer(): each call is counted and its time added to a histogram per stage. Times include
+nested stages, and for generators (e.g. gmail.iter_history) only the time spent producing items,
+not the time the caller spends on them. Gmail API calls are counted by method and status code,
+and the quota units they use by actor (the first METRICS_MAX_ACTORS actors, the rest as 'other').
+Recording costs two perf_counter() calls and a dict update under a lock, so it can be left on.
+Components with their own stats (tokens, transport, ...) add them with collector().
+
+Each process has its own values, under uwsgi a scrape only sees the worker that answers it.
+On Lambda nobody can scrape /metrics, so (GMAIL_METRICS_LOG, on by default there) the changes
+since the last flush are written as one JSON log line after a request, at most every
+GMAIL_METRICS_LOG_INTERVAL seconds.
+"""
+import os
+import bisect
+import functools
+import inspect
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from src import fetch
+
+METRICS = os.getenv('GMAIL_METRICS', 'true').lower() == 'true'
+# If set, /metrics wants 'Authorization: Bearer <token>', else it only answers requests from localhost
+METRICS_TOKEN = os.getenv('GMAIL_METRICS_TOKEN', '')
+METRICS_MAX_ACTORS = int(os.getenv('GMAIL_METRICS_MAX_ACTORS', '1000'))
+METRICS_LOG = os.getenv('GMAIL_METRICS_LOG', 'true' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'false'
+                        ).lower() == 'true'
+# 0 flushes after every request, Lambda may freeze the process for good after any response
+METRICS_LOG_INTERVAL = float(os.getenv('GMAIL_METRICS_LOG_INTERVAL', '0'))
+# Histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    'gmail_stage_seconds': ('histogram', 'Time spent in a pipeline stage, including nested stages'),
+    'gmail_stage_errors_total': ('counter', 'Pipeline stage calls that raised'),
+    'gmail_api_seconds': ('histogram', 'Gmail API call latency by method'),
+    'gmail_api_calls_total': ('counter', 'Gmail API calls by method and status code, batch parts included'),
+    'gmail_quota_units_total': ('counter', 'Gmail quota units used by actor'),
+}
+
+_NAME = re.compile(r'[^a-zA-Z0-9_]')
+# URL path after users/ -> Gmail API method, see fetch.QUOTA_UNITS
+_METHODS = (('me/messages/', 'messages.get'), ('me/messages', 'messages.list'), ('me/history', 'history.list'),
+            ('me/labels', 'labels.list'), ('me/profile', 'getProfile'), ('me/watch', 'watch'), ('me/stop', 'stop'))
+
+
+def api_method(url):
+    """ The Gmail API method of a REST url, e.g. 'history.list'. """
+    path = url.split('?')[0]
+    i = path.find('/users/')
+    path = path[i + len('/users/'):] if i >= 0 else path
+    if '/attachments/' in path:
+        return 'messages.attachments.get'
+    for prefix, method in _METHODS:
+        if path.startswith(prefix):
+            return method
+    return 'other'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels, extra=''):
+    parts = ['%s="%s"' % (k, _escape(v)) for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return name + ('{' + ','.join(parts) + '}' if parts else '')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+
+    def __init__(self, buckets=BUCKETS, max_actors=METRICS_MAX_ACTORS):
+        self.buckets = tuple(buckets)
+        self.max_actors = max_actors
+        self._lock = threading.Lock()
+        # (name, labels) -> value
+        self._counters = {}
+        # (name, labels) -> [count, sum, count per bucket..., count above the last bucket]
+        self._timers = {}
+        self._collectors = {}
+        self._actors = set()
+        self._flushed = {}
+        self._flushed_at = 0.0
+        self._flush_lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = (name, labels)
+        with self._lock:
+            t = self._timers.get(key)
+            if t is None:
+                t = self._timers[key] = [0, 0.0] + [0] * (len(self.buckets) + 1)
+            t[0] += 1
+            t[1] += seconds
+            t[2 + i] += 1
+
+    def actor(self, actor_id):
+        """ The actor label for actor_id, 'other' once max_actors actors have been seen. """
+        if actor_id in self._actors:
+            return actor_id
+        with self._lock:
+            if len(self._actors) < self.max_actors:
+                self._actors.add(actor_id)
+                return actor_id
+        return 'other'
+
+    def collector(self, component, fn):
+        """ fn returns a dict of numbers, exported as gmail_<component>_<key> on each scrape. """
+        self._collectors[component] = fn
+
+    def _collect(self):
+        out = {}
+        for component, fn in list(self._collectors.items()):
+            try:
+                values = fn() or {}
+            except Exception as e:
+                logging.warning('Not able to collect ' + component + ' metrics: ' + str(e))
+                continue
+            for k, v in values.items():
+                if isinstance(v, (int, float)):
+                    out[_NAME.sub('_', 'gmail_' + component + '_' + k)] = v
+        return out
+
+    def _snapshot(self):
+        with self._lock:
+            return dict(self._counters), {k: list(v) for k, v in self._timers.items()}
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format. """
+        counters, timers = self._snapshot()
+        lines = []
+        for name, (kind, text) in HELP.items():
+            lines.extend(['# HELP %s %s' % (name, text), '# TYPE %s %s' % (name, kind)])
+            if kind == 'counter':
+                for (n, labels), v in sorted(counters.items()):
+                    if n == name:
+                        lines.append(_series(name, labels) + ' ' + _number(v))
+                continue
+            for (n, labels), t in sorted(timers.items()):
+                if n != name:
+                    continue
+                total = 0
+                for le, c in zip(self.buckets, t[2:]):
+                    total += c
+                    lines.append(_series(name + '_bucket', labels, 'le="%s"' % le) + ' ' + str(total))
+                lines.append(_series(name + '_bucket', labels, 'le="+Inf"') + ' ' + str(t[0]))
+                lines.append(_series(name + '_sum', labels) + ' ' + repr(t[1]))
+                lines.append(_series(name + '_count', labels) + ' ' + str(t[0]))
+        for name, v in sorted(self._collect().items()):
+            lines.extend(['# TYPE %s untyped' % name, name + ' ' + _number(v)])
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """ Log what changed since the last flush as one JSON line, returns the number of series logged. """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        counters, timers = self._snapshot()
+        series = []
+        flushed = {}
+        for (name, labels), v in counters.items():
+            flushed[(name, labels)] = v
+            delta = v - self._flushed.get((name, labels), 0)
+            if delta:
+                series.append(dict(labels, name=name, value=delta))
+        for (name, labels), t in timers.items():
+            flushed[(name, labels)] = (t[0], t[1])
+            count, total = self._flushed.get((name, labels), (0, 0.0))
+            if t[0] != count:
+                series.append(dict(labels, name=name, count=t[0] - count, sum=round(t[1] - total, 6)))
+        for name, v in self._collect().items():
+            flushed[name] = v
+            if self._flushed.get(name) != v:
+                series.append({'name': name, 'value': v})
+        self._flushed = flushed
+        self._flushed_at = time.time()
+        if series:
+            logging.info(json.dumps({'metrics': series, 'pid': os.getpid()}))
+        return len(series)
+
+    def maybe_flush(self):
+        """ flush() if GMAIL_METRICS_LOG is on and the interval has passed, called after each request. """
+        if METRICS and METRICS_LOG and time.time() - self._flushed_at >= METRICS_LOG_INTERVAL:
+            self.flush()
+
+
+REGISTRY = Registry()
+
+
+def collector(component, fn):
+    REGISTRY.collector(component, fn)
+
+
+def gmail_call(actor_id, method, code, seconds, parts=0):
+    """
+    Record one Gmail API call, or with parts a batch request of parts calls.
+    :param method: Gmail API method, see api_method() and fetch.QUOTA_UNITS
+    """
+    if not METRICS:
+        return
+    calls = parts or 1
+    REGISTRY.observe('gmail_api_seconds', (('method', 'batch' if parts else method),), seconds)
+    REGISTRY.inc('gmail_api_calls_total', (('method', method), ('code', str(code))), calls)
+    units = fetch.QUOTA_UNITS.get(method, 0) * calls
+    if units:
+        REGISTRY.inc('gmail_quota_units_total', (('actor', REGISTRY.actor(actor_id)),), units)
+
+
+def _record(stage, seconds, failed):
+    labels = (('stage', stage),)
+    REGISTRY.observe('gmail_stage_seconds', labels, seconds)
+    if failed:
+        REGISTRY.inc('gmail_stage_errors_total', labels)
+
+
+@contextmanager
+def timer(stage):
+    """ Time a block as stage. """
+    if not METRICS:
+        yield
+        return
+    start = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _record(stage, time.perf_counter() - start, failed)
+
+
+def _timed_generator(fn, stage):
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        gen = fn(*args, **kwargs)
+        spent = 0.0
+        failed = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    spent += time.perf_counter() - start
+                yield item
+        finally:
+            gen.close()
+            _record(stage, spent, failed)
+
+    return wrapper
+
+
+def _timed_async_generator(fn, stage):
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        gen = fn(*args, **kwargs)
+        spent = 0.0
+        failed = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = await gen.__anext__()
+                except StopAsyncIteration:
+                    return
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    spent += time.perf_counter() - start
+                yield item
+        finally:
+            await gen.aclose()
+            _record(stage, spent, failed)
+
+    return wrapper
+
+
+def _timed_coroutine(fn, stage):
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            res = await fn(*args, **kwargs)
+            failed = False
+            return res
+        finally:
+            _record(stage, time.perf_counter() - start, failed)
+
+    return wrapper
+
+
+def timed(stage):
+    """
+    Decorator timing each call of a function (or each item of a generator) as stage.
+    Coroutines and async generators are timed from start to finish, including the time other tasks ran.
+    """
+
+    def decorate(fn):
+        if not METRICS:
+            return fn
+        if inspect.isgeneratorfunction(fn):
+            return _timed_generator(fn, stage)
+        if inspect.isasyncgenfunction(fn):
+            return _timed_async_generator(fn, stage)
+        if inspect.iscoroutinefunction(fn):
+            return _timed_coroutine(fn, stage)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                res = fn(*args, **kwargs)
+                failed = False
+                return res
+            finally:
+                _record(stage, time.perf_counter() - start, failed)
+
+        return wrapper
+
+    return decorate
+
+
+def instrument(prefix):
+    """ Class decorator: timed() on every public method defined in the class, as stage prefix.method. """
+
+    def decorate(cls):
+        for name, fn in list(vars(cls).items()):
+            if inspect.isfunction(fn) and not name.startswith('_'):
+                setattr(cls, name, timed(prefix + '.' + name)(fn))
+        return cls
+
+    return decorate
@@ -0,0 +1,174 @@
+"""
+Append-only log of an actor's new messages, served from /<actor_id>/resources/messages.
+
+Messages get consecutive sequence numbers and are stored in segments of at most SEGMENT_SIZE
+messages and SEGMENT_MAX_BYTES, one attribute item per segment (bucket 'msglog', keyed by the
+sequence number of its first message) in the actingweb attribute table. Readers page through the
+log with the sequence number as cursor:
+
+    GET /<actor_id>/resources/messages?since=<cursor>&limit=100
+
+When a new segment is started, segments older than LOG_TTL seconds and all but the newest
+LOG_MAX_SEGMENTS segments are deleted. Writes are conditional on the segment not having changed
+since it was read, so concurrent callbacks for the same actor never overwrite each other.
+"""
+import os
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from pynamodb.exceptions import PutError
+from src import codec, projection, records
+
+BUCKET = 'msglog'
+SEGMENT_SIZE = int(os.getenv('GMAIL_LOG_SEGMENT_SIZE', '100'))
+# Well below DynamoDB's 400 KB item limit
+SEGMENT_MAX_BYTES = int(os.getenv('GMAIL_LOG_SEGMENT_BYTES', str(256 * 1024)))
+LOG_MAX_SEGMENTS = int(os.getenv('GMAIL_LOG_MAX_SEGMENTS', '50'))
+LOG_TTL = int(os.getenv('GMAIL_LOG_TTL', str(7 * 24 * 3600)))
+READ_LIMIT = 100
+READ_MAX_LIMIT = 1000
+APPEND_RETRIES = 10
+
+
+def _key(first):
+    return '%012d' % first
+
+
+def _size(entry):
+    return len(codec.dumps(entry))
+
+
+def _entry(msg):
+    """ A message as stored in the log, large messages are cut down to the top level fields. """
+    size = _size(msg)
+    if size <= SEGMENT_MAX_BYTES:
+        # The attribute table encodes item data with json itself
+        return msg.to_dict() if isinstance(msg, records.Message) else msg, size
+    msg = {k: msg[k] for k in projection.MESSAGE_FIELDS if k in msg}
+    msg['truncated'] = True
+    return msg, _size(msg)
+
+
+class MessageLog:
+
+    def __init__(self, actor_id, config):
+        self.actor_id = actor_id
+        self.model = config.DbAttribute.Attribute
+        self.stats = {'appended': 0, 'segments': 0, 'conflicts': 0, 'evicted': 0}
+
+    def _range(self, first=0):
+        return self.model.bucket_name.between(BUCKET + ':' + _key(first), BUCKET + ':~')
+
+    def _tail(self):
+        for item in self.model.query(self.actor_id, self._range(), scan_index_forward=False, limit=1,
+                                     consistent_read=True):
+            return item
+        return None
+
+    def append(self, messages):
+        """
+        Append messages (dict of id -> message, in order) to the log.
+        :return: (first, last) sequence numbers of the appended messages, None if nothing was appended
+        :raises PutError: If the tail segment kept changing for APPEND_RETRIES attempts, messages appended
+            before that stay in the log (so a redelivered push may append them again)
+        """
+        pending = [_entry(m) for m in messages.values() if m]
+        first = last = None
+        tail = self._tail() if pending else None
+        conflicts = 0
+        while pending:
+            if tail is None:
+                start, entries, used = 0, [], 0
+            else:
+                start, entries, used = int(tail.name), tail.data.get('entries', []), tail.data.get('bytes', 0)
+            if entries and (len(entries) >= SEGMENT_SIZE or used + pending[0][1] > SEGMENT_MAX_BYTES):
+                # The tail segment is full, start a new one after it
+                start, entries, used = start + len(entries), [], 0
+            seq = start + len(entries)
+            if entries:
+                condition = self.model.timestamp == tail.timestamp
+            else:
+                condition = self.model.bucket_name.does_not_exist()
+            take = 0
+            for _, size in pending:
+                if len(entries) + take >= SEGMENT_SIZE or (take and used + size > SEGMENT_MAX_BYTES):
+                    break
+                used += size
+                take += 1
+            item = self.model(
+                id=self.actor_id, bucket_name=BUCKET + ':' + _key(start), bucket=BUCKET, name=_key(start),
+                data={'entries': entries + [e for e, _ in pending[:take]], 'bytes': used},
+                timestamp=datetime.now(timezone.utc))
+            try:
+                item.save(condition=condition)
+            except PutError as e:
+                # Someone else appended in between, start over from the new tail
+                conflicts += 1
+                self.stats['conflicts'] += 1
+                if conflicts > APPEND_RETRIES:
+                    logging.warning('Not able to append to message log of ' + self.actor_id + ': ' + str(e))
+                    raise
+                time.sleep(random.uniform(0, 0.01 * conflicts))
+                tail = self._tail()
+                continue
+            if not entries:
+                self.stats['segments'] += 1
+                self._evict(start)
+            first = seq if first is None else first
+            last = seq + take - 1
+            self.stats['appended'] += take
+            pending = pending[take:]
+            tail = item
+        if first is None:
+            return None
+        return first, last
+
+    def _evict(self, newest):
+        """ Delete segments past LOG_TTL or beyond LOG_MAX_SEGMENTS, never the newest one. """
+        now = datetime.now(timezone.utc)
+        segments = [s for s in self.model.query(self.actor_id, self._range(), attributes_to_get=[
+            'id', 'bucket_name', 'timestamp']) if s.bucket_name != BUCKET + ':' + _key(newest)]
+        drop = segments[:max(0, len(segments) + 1 - LOG_MAX_SEGMENTS)]
+        drop += [s for s in segments[len(drop):]
+                 if s.timestamp and (now - s.timestamp).total_seconds() > LOG_TTL]
+        if not drop:
+            return
+        with self.model.batch_write() as batch:
+            for s in drop:
+                batch.delete(s)
+        self.stats['evicted'] += len(drop)
+
+    def read(self, since=None, limit=READ_LIMIT):
+        """
+        Messages after the cursor since, oldest first.
+        :param since: Sequence number of the last message already read, None to read from the oldest kept
+        :return: Dict with messages ([{'seq', 'message'}]), cursor (to pass as since next time), more (True if
+            there are more messages after this page) and gap (True if messages after since have been evicted)
+        """
+        limit = max(1, min(int(limit or READ_LIMIT), READ_MAX_LIMIT))
+        since = -1 if since is None else int(since)
+        out = []
+        more = False
+        gap = False
+        # A segment holds at most SEGMENT_SIZE messages, so the one holding since + 1 starts after this
+        lowest = max(0, since + 2 - SEGMENT_SIZE)
+        for seg in self.model.query(self.actor_id, self._range(lowest), consistent_read=True):
+            start = int(seg.name)
+            if not out and since >= 0 and start > since + 1:
+                gap = True
+            for n, msg in enumerate(seg.data.get('entries', [])):
+                if start + n <= since:
+                    continue
+                if len(out) >= limit:
+                    more = True
+                    break
+                out.append({'seq': start + n, 'message': msg})
+            if more:
+                break
+        return {
+            'messages': out,
+            'cursor': str(out[-1]['seq'] if out else max(since, -1)),
+            'more': more,
+            'gap': gap,
+        }
@@ -1,8 +1,19 @@
+import os
 import logging
 import json
-import time
-from actingweb import on_aw
-from src import gmail
+from actingweb import on_aw, actor, auth
+from src import gmail, worker, dedup, logutil, store, labels, msglog, diffs, codec, tokens, metrics, blobs
+
+# 'sync' processes a Gmail push before acking it, 'async' acks at once and lets an in-process
+# worker fetch the history (uwsgi only, Lambda freezes the process when the response is sent)
+CALLBACK_MODE = os.getenv('GMAIL_CALLBACK_MODE', 'sync')
+CALLBACK_WORKERS = int(os.getenv('GMAIL_CALLBACK_WORKERS', '2'))
+# What property 'new' and its diffs hold: 'blob' all the new messages as before, 'log' a pointer to
+# the appended range of the message log (read it from resources/messages), for peers that know it
+NEW_MODE = os.getenv('GMAIL_NEW_MODE', 'blob')
+
+# Diffs on property new are merged per history run, and over GMAIL_DIFF_WINDOW seconds if set
+DIFFS = diffs.DiffAggregator(merge=diffs.merge_pointers if NEW_MODE == 'log' else diffs.merge_messages)
 
 PROP_HIDE = []
 
@@ -14,6 +25,69 @@ PROP_PROTECT = PROP_HIDE + [
 ]
 
 
+@metrics.timed('on_aw.publish')
+def publish(myself, h):
+    """
+    Append a batch of new messages to the message log and queue the diff for subscribers.
+    :return: The diff payload, None if nothing was published
+    """
+    appended = msglog.MessageLog(myself.id, myself.config).append(h)
+    if NEW_MODE == 'log':
+        if not appended:
+            return None
+        payload = {'since': str(appended[0] - 1), 'cursor': str(appended[1]),
+                   'count': appended[1] - appended[0] + 1}
+    else:
+        payload = h
+    DIFFS.add(myself, payload, messages=len(h))
+    return payload
+
+
+@metrics.timed('on_aw.handle_history')
+def handle_history(myself, gm, pages):
+    """
+    Publish new messages from a history run and renew the watch if it is about to expire.
+    :param pages: Iterable of message dicts, e.g. GMail.iter_sync(), each is published before the next is fetched
+    """
+    run = None
+    try:
+        for h in pages:
+            logutil.trace(myself.id, 'Publishing %d new messages: %s', len(h), logutil.LazyJson(h))
+            payload = publish(myself, h)
+            if payload is None:
+                continue
+            run = DIFFS.merge(run, payload)
+            # Saved with the page checkpoint, property new covers the whole run like its diff
+            gm.uow.set_property('new', codec.dumps(run))
+    finally:
+        DIFFS.end_run(myself.id)
+    if gm.watch_expires_in() < 3 * 24 * 3600:
+        logging.debug('Less than 3 x 24h to gmail watch expiry, refreshing...')
+        gm.set_up(refresh=True)
+
+
+@metrics.timed('on_aw.process_notification')
+def process_notification(actor_id, history_id, config):
+    """
+    Fetch and publish new messages for an actor outside of a request, up to at least history_id.
+    :return: False if the actor does not exist
+    """
+    myself = actor.Actor(actor_id, config=config)
+    if not myself.id:
+        return False
+    with store.UnitOfWork(myself) as uow:
+        gm = gmail.GMail(myself, config, auth.Auth(actor_id, auth_type='oauth', config=config), uow=uow)
+        handle_history(myself, gm, gm.iter_sync(history_id))
+        logging.debug('Processed google notification for %s up to %s', actor_id, history_id)
+    return True
+
+
+CALLBACK_QUEUE = worker.CoalescingQueue(process_notification, workers=CALLBACK_WORKERS, name='gmail-callbacks')
+metrics.collector('callbacks', CALLBACK_QUEUE.stats)
+metrics.collector('diffs', DIFFS.stats)
+
+
+@metrics.instrument('on_aw')
 class OnAWGoogleMail(on_aw.OnAWBase):
 
     def bot_post(self, path):
@@ -104,8 +178,9 @@ class OnAWGoogleMail(on_aw.OnAWBase):
         if path and len(path) >= 1 and path[0] == 'config':
             if 'watchLabels' in new:
                 new_labels = new['watchLabels']
-                gm = gmail.GMail(self.myself, self.config, self.auth)
-                gm.create_watch(labels=new_labels, refresh=True)
+                with store.UnitOfWork(self.myself) as uow:
+                    gm = gmail.GMail(self.myself, self.config, self.auth, uow=uow)
+                    gm.create_watch(labels=new_labels, refresh=True)
         return new
 
     def post_properties(self, prop: str, data: dict) -> dict or None:
@@ -135,27 +210,32 @@ class OnAWGoogleMail(on_aw.OnAWBase):
     def post_callbacks(self, name):
         """Customizible function to handle POST /callbacks"""
         if name == 'messages':
-            gm = gmail.GMail(self.myself, self.config, self.auth)
             try:
-                h = gm.process_callback(json.loads(self.webobj.request.body.decode('utf-8')))
+                data = codec.loads(self.webobj.request.body)
             except json.JSONDecodeError:
                 return False
-            logging.debug('Processed google callback: ' + json.dumps(h, indent=4))
-            if h:
-                blob = json.dumps(h)
-                self.myself.property.new = blob
-                self.myself.register_diffs(target='properties', subtarget='new', blob=blob)
-            now = time.time()
-            if not gm.watch_exp or now > gm.watch_exp - (3 * 24 * 3600):
-                logging.debug('Less than 3 x 24h to gmail watch expiry, refreshing...')
-                gm.set_up(refresh=True)
+            payload = gmail.parse_notification(data)
+            if payload and dedup.WATERMARKS.is_stale(self.myself.id, int(payload.get('historyId'))):
+                logging.debug('Dropping duplicate google callback for %s', self.myself.id)
+                return True
+            if CALLBACK_MODE == 'async':
+                if payload:
+                    CALLBACK_QUEUE.submit(self.myself.id, int(payload.get('historyId')), self.config)
+                return True
+            self.process_push(data)
         return True
 
+    def process_push(self, data):
+        """ Fetch and publish the new messages of a Gmail push (the decoded Pub/Sub body) before it is acked. """
+        with store.UnitOfWork(self.myself) as uow:
+            gm = gmail.GMail(self.myself, self.config, self.auth, uow=uow)
+            handle_history(self.myself, gm, gm.iter_callback(data))
+
     def post_subscriptions(self, sub, peerid, data):
         """Customizible function to process incoming callbacks/subscriptions/ callback with json body,
         return True if processed, False if not."""
-        logging.debug("Got callback and processed " + sub["subscriptionid"] +
-                      " subscription from peer " + peerid + " with json blob: " + json.dumps(data))
+        logutil.trace(self.myself.id, 'Got callback and processed %s subscription from peer %s with json blob: %s',
+                      sub["subscriptionid"], peerid, logutil.LazyJson(data))
         return True
 
     def delete_actor(self):
@@ -163,6 +243,10 @@ class OnAWGoogleMail(on_aw.OnAWBase):
         # THE BELOW IS SAMPLE CODE
         # Clean up anything associated with this actor before it is deleted.
         # END OF SAMPLE CODE
+        dedup.WATERMARKS.forget(self.myself.id)
+        dedup.SEEN.forget(self.myself.id)
+        labels.CACHE.forget(self.myself.id)
+        tokens.MANAGER.forget(self.myself.id)
         gm = gmail.GMail(self.myself, self.config, self.auth)
         if gm.cleanup():
             return True
@@ -171,14 +255,16 @@ class OnAWGoogleMail(on_aw.OnAWBase):
 
     def check_on_oauth_success(self, token=None):
         # THIS METHOD IS CALLED WHEN AN OAUTH AUTHORIZATION HAS BEEN SUCCESSFULLY MADE AND BEFORE APPROVAL
-        gm = gmail.GMail(self.myself, self.config, self.auth)
-        gm.get_profile()
+        with store.UnitOfWork(self.myself) as uow:
+            gm = gmail.GMail(self.myself, self.config, self.auth, uow=uow)
+            gm.get_profile()
         return True
 
     def actions_on_oauth_success(self):
         # THIS METHOD IS CALLED WHEN AN OAUTH AUTHORIZATION HAS BEEN SUCCESSFULLY MADE
-        gm = gmail.GMail(self.myself, self.config, self.auth)
-        gm.set_up(refresh=True)
+        with store.UnitOfWork(self.myself) as uow:
+            gm = gmail.GMail(self.myself, self.config, self.auth, uow=uow)
+            gm.set_up(refresh=True)
         return gm.all_ok()
 
     def get_resources(self, name):
@@ -186,6 +272,21 @@ class OnAWGoogleMail(on_aw.OnAWBase):
 
             Returning {} will give a 404 response back to requestor.
         """
+        if name == 'messages':
+            since = self.webobj.request.get('since')
+            limit = self.webobj.request.get('limit')
+            try:
+                return msglog.MessageLog(self.myself.id, self.config).read(
+                    since=int(since) if since else None, limit=int(limit) if limit else msglog.READ_LIMIT)
+            except ValueError:
+                return {}
+        if name.startswith('blobs/'):
+            chunk = self.webobj.request.get('chunk')
+            try:
+                return blobs.BlobStore(self.myself.id, self.config).read(name[len('blobs/'):],
+                                                                          chunk=int(chunk) if chunk else 0) or {}
+            except ValueError:
+                return {}
         return {}
 
     def delete_resources(self, name):
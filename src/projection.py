@@ -0,0 +1,139 @@
+import json
+import random
+import threading
+from urllib.parse import quote
+from src import labels
+
+# Message fields kept by GMail.get_message(), everything else in the payload is thrown away
+MESSAGE_FIELDS = ['id', 'threadId', 'labelIds', 'snippet', 'historyId', 'internalDate', 'sizeEstimate']
+# The only parts of a history page that get_history() reads
+HISTORY_FIELDS = 'history(id,messagesAdded(message(id,labelIds))),historyId,nextPageToken'
+# The only parts of a messages.list page that a full resync reads
+LIST_FIELDS = 'messages(id),nextPageToken'
+
+
+class ProjectionStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.samples = 0
+        self.bytes_projected = 0
+        self.bytes_full = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.calls += 1
+
+    def sample(self, projected, full):
+        with self._lock:
+            self.samples += 1
+            self.bytes_projected += len(json.dumps(projected or {}))
+            self.bytes_full += len(json.dumps(full or {}))
+
+    @property
+    def saved_per_call(self):
+        if not self.samples:
+            return 0
+        return (self.bytes_full - self.bytes_projected) // self.samples
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'samples': self.samples,
+            'bytes_saved_per_call': self.saved_per_call,
+            'bytes_saved_estimate': self.saved_per_call * self.calls,
+        }
+
+
+class Projection:
+    """
+    Request masks compiled from an actor's config, so Gmail only sends what we keep.
+    Use compile() to get a cached instance rather than creating one directly.
+    """
+
+    def __init__(self, myconf, sample_rate=0.0, bodies=False):
+        """ :param bodies: Keep the whole payload of 'full' messages, with part bodies (see src.blobs) """
+        self.fmt = myconf.get('msgFormat', 'metadata')
+        self.headers = frozenset(myconf.get('msgHeaders', []))
+        watch = myconf.get('watchLabels') or []
+        # history.list only takes one labelId (and no names), else we rely on the local label filter
+        self.label_id = watch[0] if len(watch) == 1 and labels.is_label_id(watch[0]) else None
+        self.sample_rate = sample_rate
+        self.stats = ProjectionStats()
+        fields = list(MESSAGE_FIELDS)
+        if self.fmt == 'full' and bodies:
+            fields.append('payload')
+        elif self.fmt != 'minimal':
+            fields.append('payload/headers')
+        if self.fmt == 'raw':
+            fields.append('raw')
+        self._message_fields = quote(','.join(fields), safe=',/()')
+        self._metadata_headers = ''.join('&metadataHeaders=' + quote(h) for h in sorted(self.headers))
+        self._history_fields = quote(HISTORY_FIELDS, safe=',/()')
+        self._list_fields = quote(LIST_FIELDS, safe=',/()')
+
+    def message_path(self, id, fmt=None, project=True):
+        fmt = fmt or self.fmt
+        path = 'me/messages/' + str(id) + '?format=' + fmt
+        if not project:
+            return path
+        if fmt == 'metadata':
+            path += self._metadata_headers
+        if fmt == self.fmt:
+            path += '&fields=' + self._message_fields
+        return path
+
+    def history_path(self, start, page_token=None, project=True):
+        path = 'me/history?historyTypes=messageAdded&startHistoryId=' + str(start)
+        if project:
+            if self.label_id:
+                path += '&labelId=' + quote(self.label_id)
+            path += '&fields=' + self._history_fields
+        if page_token:
+            path += '&pageToken=' + page_token
+        return path
+
+    def list_path(self, page_token=None, max_results=500, query=None, project=True):
+        path = 'me/messages?maxResults=' + str(max_results)
+        if query:
+            path += '&q=' + quote(query)
+        if project:
+            if self.label_id:
+                path += '&labelIds=' + quote(self.label_id)
+            path += '&fields=' + self._list_fields
+        if page_token:
+            path += '&pageToken=' + page_token
+        return path
+
+    def filter_headers(self, headers):
+        """ Turn a Gmail payload header list into a dict of name -> list of values for the kept headers. """
+        hs = {}
+        keep = self.headers
+        for h in headers:
+            name = h.get('name')
+            if name in keep:
+                hs.setdefault(name, []).append(h.get('value'))
+        return hs
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+_MAX_COMPILED = 1024
+
+
+def compile(myconf, sample_rate=0.0, bodies=False):
+    """ Projection for a config, shared between requests for as long as the config is unchanged. """
+    key = json.dumps([myconf.get('msgFormat'), myconf.get('msgHeaders'), myconf.get('watchLabels'), sample_rate,
+                      bodies], sort_keys=True)
+    with _compiled_lock:
+        p = _compiled.get(key)
+        if not p:
+            if len(_compiled) >= _MAX_COMPILED:
+                _compiled.clear()
+            p = Projection(myconf, sample_rate=sample_rate, bodies=bodies)
+            _compiled[key] = p
+        return p
@@ -0,0 +1,103 @@
+"""
+Process-wide Pub/Sub admin clients.
+
+Each PublisherClient/SubscriberClient opens its own gRPC channel and loads credentials, so they are
+created once per process on first use and shared by all requests and threads. gRPC channels do not
+survive a fork, so the registry is reset in the child (uwsgi forks its workers after loading the app).
+google.cloud.pubsub_v1 (gRPC, protobuf) is only imported when the first client is created, most
+requests never need one and it adds a third of a second to a Lambda cold start.
+"""
+import os
+import atexit
+import logging
+import threading
+from src import metrics
+
+_lock = threading.Lock()
+_clients = {}
+_pid = os.getpid()
+_stats = {'created': 0, 'reused': 0, 'closed': 0}
+
+
+def _reset():
+    global _pid
+    _clients.clear()
+    _pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
+
+
+def _get(kind, factory):
+    with _lock:
+        if _pid != os.getpid():
+            _reset()
+        client = _clients.get(kind)
+        if client is None:
+            client = factory()
+            _clients[kind] = client
+            _stats['created'] += 1
+        else:
+            _stats['reused'] += 1
+        return client
+
+
+def _pubsub():
+    from google.cloud import pubsub_v1
+    return pubsub_v1
+
+
+def publisher():
+    return _get('publisher', lambda: _pubsub().PublisherClient())
+
+
+def subscriber():
+    return _get('subscriber', lambda: _pubsub().SubscriberClient())
+
+
+def stats():
+    with _lock:
+        out = dict(_stats)
+        out['open'] = len(_clients)
+        return out
+
+
+def shutdown():
+    """ Close the channels of all clients created in this process. """
+    with _lock:
+        if _pid != os.getpid():
+            _reset()
+            return
+        for kind, client in list(_clients.items()):
+            try:
+                if hasattr(client, 'close'):
+                    client.close()
+                elif hasattr(client, 'stop'):
+                    client.stop()
+                else:
+                    continue
+                _stats['closed'] += 1
+            except Exception as e:
+                logging.warning('Not able to close pub/sub ' + kind + ' client: ' + str(e))
+        _clients.clear()
+
+
+def _uwsgi_atexit():
+    """ uwsgi has a single atexit hook, so the one set before this module was imported is called too. """
+    try:
+        shutdown()
+    finally:
+        if _previous_atexit:
+            _previous_atexit()
+
+
+metrics.collector('pubsub_clients', stats)
+atexit.register(shutdown)
+_previous_atexit = None
+try:
+    import uwsgi
+    _previous_atexit = getattr(uwsgi, 'atexit', None)
+    uwsgi.atexit = _uwsgi_atexit
+except ImportError:
+    pass
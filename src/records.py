@@ -0,0 +1,116 @@
+"""
+Compact message records for GMail.get_message() and get_history().
+
+A Message holds the kept message fields in slots instead of a dict, with label ids and header
+names interned and the headers in one flat tuple, so a page of new messages takes a fraction of
+the memory of the dicts Gmail returns. It is a read-only Mapping, so code written for the message
+dicts keeps working, and its JSON (see codec.dumps()) is byte for byte what json.dumps() gives
+for the dict it was made from. The JSON is cached on the record the first time it is encoded.
+"""
+import sys
+import json
+from collections.abc import Mapping
+from src import projection
+
+_SLOTTED = frozenset(projection.MESSAGE_FIELDS + ['headers', 'raw'])
+# Shared key order tuples, messages from one projection all have the same few shapes
+_shapes = {}
+
+
+def _shape(keys):
+    return _shapes.setdefault(keys, keys)
+
+
+def _pack_headers(headers):
+    """ dict of name -> list of values as a flat (name, value, ...) tuple, a value is a str or a tuple. """
+    out = []
+    for name, values in headers.items():
+        out.append(sys.intern(name))
+        out.append(values[0] if len(values) == 1 and isinstance(values[0], str) else tuple(values))
+    return tuple(out)
+
+
+def _unpack_headers(packed):
+    return {packed[i]: [packed[i + 1]] if isinstance(packed[i + 1], str) else list(packed[i + 1])
+            for i in range(0, len(packed), 2)}
+
+
+class Message(Mapping):
+    """ One message as kept by GMail.get_message(), see the module doc. labelIds reads as a tuple. """
+
+    __slots__ = tuple(sorted(_SLOTTED)) + ('_keys', '_extra', '_json')
+
+    def __init__(self, data):
+        """ :param data: Message dict as returned by Gmail, with payload/headers already filtered """
+        extra = None
+        for k, v in data.items():
+            if k == 'labelIds':
+                v = tuple(sys.intern(l) for l in v or ())
+            elif k == 'headers' and isinstance(v, dict):
+                v = _pack_headers(v)
+            elif k not in _SLOTTED:
+                if extra is None:
+                    extra = {}
+                extra[k] = v
+                continue
+            setattr(self, k, v)
+        self._keys = _shape(tuple(data))
+        self._extra = extra
+        self._json = None
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key not in _SLOTTED:
+            return self._extra[key]
+        if key == 'headers':
+            return _unpack_headers(self.headers)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Message(' + repr(self.to_dict()) + ')'
+
+    def _plain(self, lists=True):
+        out = {}
+        for k in self._keys:
+            if k not in _SLOTTED:
+                out[k] = self._extra[k]
+                continue
+            v = getattr(self, k)
+            if k == 'headers':
+                v = _unpack_headers(v)
+            elif k == 'labelIds' and lists:
+                v = list(v)
+            out[k] = v
+        return out
+
+    def to_dict(self):
+        """ The message as the plain dict it was made from. """
+        return self._plain()
+
+    def json(self):
+        """ json.dumps(self.to_dict()), encoded once. """
+        if self._json is None:
+            # Tuples encode like the lists they were made from
+            self._json = json.dumps(self._plain(lists=False))
+        return self._json
+
+    def encoded_size(self):
+        """ Bytes of json(), the same as its length as json.dumps() escapes everything outside ASCII. """
+        return len(self.json())
@@ -0,0 +1,132 @@
+"""
+Proactive Gmail watch renewal.
+
+Watches are otherwise only renewed when a callback arrives, so a quiet mailbox silently stops
+getting notifications after 7 days. sweep() renews the watches in src.watch_index that expire
+within the window, in parallel with a concurrency cap. Each run first rebuilds the index from all
+actors if it has never been built or was last built more than RENEWAL_REBUILD seconds ago, which
+picks up watches set before the index existed or whose index update failed. Run it from cron:
+
+    python -m src.renewal --window-hours 48 --concurrency 8
+    python -m src.renewal --rebuild     # rebuild the index from all actors now
+
+or as the scheduled Lambda function `renewal` (see serverless.yml).
+"""
+import os
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from actingweb import actor, auth
+from src import gmail, store, watch_index, metrics
+
+RENEWAL_WINDOW = int(os.getenv('GMAIL_RENEWAL_WINDOW', str(48 * 3600)))
+RENEWAL_CONCURRENCY = int(os.getenv('GMAIL_RENEWAL_CONCURRENCY', '8'))
+# Seconds between automatic index rebuilds, a watch lives 7 days. 0 only rebuilds with --rebuild.
+RENEWAL_REBUILD = int(os.getenv('GMAIL_RENEWAL_REBUILD', str(24 * 3600)))
+
+RENEWED = 'renewed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def renew(actor_id, config, window=RENEWAL_WINDOW, indexed_expiry=None):
+    """ Renew one actor's watch if it is still due, returns RENEWED, SKIPPED or FAILED. """
+    myself = actor.Actor(actor_id, config=config)
+    if not myself.id:
+        # Actor is gone, drop the stale index entry
+        watch_index.update(actor_id, old_expiry=indexed_expiry)
+        return SKIPPED
+    with store.UnitOfWork(myself) as uow:
+        gm = gmail.GMail(myself, config, auth.Auth(actor_id, auth_type='oauth', config=config), uow=uow)
+        if gm.watch_expires_in() >= window:
+            # Renewed by a callback since the index was read, make sure the entry has moved
+            watch_index.update(actor_id, old_expiry=indexed_expiry, new_expiry=gm.watch_exp)
+            return SKIPPED
+        if not gm.set_up(refresh=True):
+            return FAILED
+    return RENEWED
+
+
+def sweep(config, window=RENEWAL_WINDOW, concurrency=RENEWAL_CONCURRENCY):
+    """
+    Renew all watches expiring within window seconds.
+    :return: Dict with counts of renewed, skipped and failed actors and timings
+    """
+    start = time.time()
+    entries = watch_index.due(window=window, now=start)
+    report = {RENEWED: 0, SKIPPED: 0, FAILED: 0, 'due': len(entries)}
+
+    def run(entry):
+        try:
+            return renew(entry[0], config, window=window, indexed_expiry=entry[1])
+        except Exception as e:
+            logging.warning('Watch renewal failed for ' + entry[0] + ': ' + str(e))
+            return FAILED
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for result in pool.map(run, entries):
+            report[result] += 1
+    report['seconds'] = round(time.time() - start, 3)
+    logging.info('Gmail watch renewal: ' + json.dumps(report))
+    return report
+
+
+def rebuild(config, now=None):
+    """ Add every actor with a watch to the index, returns the number of entries written. """
+    now = now or time.time()
+    count = 0
+    for a in actor.Actors(config=config).fetch() or []:
+        me = actor.Actor(a['id'], config=config)
+        if me.id and me.store.watch_expiry:
+            watch_index.update(me.id, new_expiry=me.store.watch_expiry)
+            count += 1
+    watch_index.set_rebuilt(now)
+    return count
+
+
+def maybe_rebuild(config, every=RENEWAL_REBUILD, now=None):
+    """
+    rebuild() if the index has never been built or was last built more than every seconds ago.
+    :return: Number of entries written, None if the index was not rebuilt
+    """
+    now = now or time.time()
+    last = watch_index.rebuilt()
+    if last and (not every or now - last < every):
+        return None
+    count = rebuild(config, now=now)
+    logging.info('Gmail watch index rebuilt with ' + str(count) + ' actors')
+    return count
+
+
+def run(config, window=RENEWAL_WINDOW, concurrency=RENEWAL_CONCURRENCY, force_rebuild=False):
+    """ A scheduled run: rebuild the index if due (or forced), then sweep(). """
+    indexed = rebuild(config) if force_rebuild else maybe_rebuild(config)
+    report = sweep(config, window=window, concurrency=concurrency)
+    if indexed is not None:
+        report['indexed'] = indexed
+    return report
+
+
+def handler(event, context):
+    """ Entry point for the scheduled Lambda function. """
+    from application import get_config
+    res = run(get_config())
+    metrics.REGISTRY.maybe_flush()
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Renew Gmail watches that are about to expire')
+    parser.add_argument('--window-hours', type=float, default=RENEWAL_WINDOW / 3600)
+    parser.add_argument('--concurrency', type=int, default=RENEWAL_CONCURRENCY)
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the expiry index from all actors first')
+    args = parser.parse_args()
+    from application import get_config
+    print(json.dumps(run(get_config(), window=int(args.window_hours * 3600), concurrency=args.concurrency,
+                         force_rebuild=args.rebuild)))
+
+
+if __name__ == '__main__':
+    main()
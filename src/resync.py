@@ -0,0 +1,177 @@
+"""
+Full resync for actors whose stored historyId has expired.
+
+Gmail only keeps history records for a limited time. After that me/history answers 404, and the
+messages in between can only be found by listing the mailbox. run() lists it with messages.list
+and fetches message metadata for up to RESYNC_CONCURRENCY list pages in parallel, yielding the
+pages in list order. The list position is saved in the actor's store after each handled page, so
+a run that is interrupted (timeout, restart) continues where it stopped. When the list is done,
+historyId is set to the mailbox historyId read when the resync started and incremental history
+sync takes over from there.
+
+Only messages since the last time the mailbox was known to be in sync (see stamp()) are listed,
+less RESYNC_OVERLAP seconds, and at most RESYNC_MAX_PAGES list pages (newest first), so an
+expired history id does not republish the whole mailbox as new.
+"""
+import os
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src import dedup, metrics, tokens
+
+# messages.list page size (Gmail max 500) and number of pages fetched in parallel
+RESYNC_PAGE_SIZE = int(os.getenv('GMAIL_RESYNC_PAGE_SIZE', '500'))
+RESYNC_CONCURRENCY = int(os.getenv('GMAIL_RESYNC_CONCURRENCY', '4'))
+# Gmail search query limiting what is resynced further, e.g. 'newer_than:30d'
+RESYNC_QUERY = os.getenv('GMAIL_RESYNC_QUERY', '')
+# List pages resynced at most (0 for no limit), older messages are skipped
+RESYNC_MAX_PAGES = int(os.getenv('GMAIL_RESYNC_MAX_PAGES', '20'))
+# Seconds before the last sync stamp that are listed again, also the most the stamp can lag behind
+RESYNC_OVERLAP = int(os.getenv('GMAIL_RESYNC_OVERLAP', '3600'))
+# Attribute in the actor's internal store holding the resync checkpoint
+STATE = 'resync'
+# Attribute in the actor's internal store holding the last time (epoch seconds) history was in sync
+SYNCED = 'synced'
+
+
+class ResyncStats:
+
+    def __init__(self, resumed=False):
+        self.resumed = resumed
+        self.pages = 0
+        self.listed = 0
+        self.messages = 0
+        self.started = time.time()
+        self.seconds = 0.0
+
+    def as_dict(self):
+        return {
+            'resumed': self.resumed,
+            'pages': self.pages,
+            'listed': self.listed,
+            'messages': self.messages,
+            'seconds': round(self.seconds, 3),
+            'msgs_per_sec': round(self.messages / self.seconds, 1) if self.seconds else 0.0,
+        }
+
+
+def pending(gm):
+    """ The saved resync checkpoint of gm's actor, or None if no resync is in progress. """
+    state = gm.myself.store.resync
+    if not state:
+        return None
+    try:
+        return json.loads(state)
+    except (TypeError, ValueError):
+        return None
+
+
+def stamp(gm, now=None):
+    """ Record that gm's mailbox is in sync now, written at most every RESYNC_OVERLAP / 2 seconds. """
+    now = int(now or time.time())
+    try:
+        last = int(gm.myself.store.synced or 0)
+    except (TypeError, ValueError):
+        last = 0
+    if now - last > RESYNC_OVERLAP // 2:
+        gm.uow.set_store(SYNCED, str(now))
+
+
+def bounded_query(gm, query=RESYNC_QUERY):
+    """ query limited to messages after the last sync stamp of gm's actor, if there is one. """
+    try:
+        synced = int(gm.myself.store.synced or 0)
+    except (TypeError, ValueError):
+        synced = 0
+    if not synced:
+        return query
+    return ' '.join(q for q in (query, 'after:%d' % max(0, synced - RESYNC_OVERLAP)) if q)
+
+
+def _save(gm, state):
+    gm.uow.set_store(STATE, json.dumps(state))
+    gm.uow.flush()
+
+
+@metrics.timed('resync.run')
+def run(gm, concurrency=RESYNC_CONCURRENCY, page_size=RESYNC_PAGE_SIZE, query=RESYNC_QUERY,
+        max_pages=None):
+    """
+    Resync gm's mailbox, or continue a resync in progress (with the query it was started with).
+    Yields a dict of message id -> message per list page, like GMail.iter_history(). The page is
+    checkpointed when the next one is requested. Stats for the run end up in gm.resync_stats.
+    """
+    if max_pages is None:
+        max_pages = RESYNC_MAX_PAGES
+    state = pending(gm)
+    stats = ResyncStats(resumed=bool(state))
+    gm.resync_stats = stats
+    if not state:
+        history_id = gm.mailbox_history_id()
+        if not history_id:
+            logging.warning('Not able to read the mailbox historyId of ' + gm.myself.id + ', resync aborted')
+            return
+        state = {'historyId': history_id, 'pageToken': None, 'messages': 0, 'pages': 0,
+                 'started': int(stats.started), 'query': bounded_query(gm, query)}
+        _save(gm, state)
+    query = state.get('query', query)
+    logging.info('Starting full resync of %s from page %s', gm.myself.id, state.get('pageToken') or 'first')
+    try:
+        in_flight = deque()
+        token = state.get('pageToken')
+        listed_pages = state.get('pages', 0)
+        listing = True
+        # A token about to expire is refreshed once here, not by every thread
+        tokens.MANAGER.prepare(gm.auth)
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            while listing or in_flight:
+                # Keep up to concurrency list pages being fetched ahead of the one handed to the caller
+                while listing and len(in_flight) < max(1, concurrency):
+                    res = gm.list_messages(page_token=token, max_results=page_size, query=query)
+                    if res is None:
+                        if token and token == state.get('pageToken') and not in_flight:
+                            # The saved page token is no longer accepted, list from the start again
+                            logging.warning('Resync page token of ' + gm.myself.id + ' expired, restarting list')
+                            token = None
+                            state['pageToken'] = None
+                            continue
+                        # Leave the checkpoint where it is, the next run continues from there
+                        logging.warning('Not able to list messages of ' + gm.myself.id + ', resync interrupted')
+                        listing = False
+                        break
+                    ids = [m['id'] for m in res.get('messages') or []]
+                    token = res.get('nextPageToken')
+                    stats.listed += len(ids)
+                    listed_pages += 1
+                    if token and max_pages and listed_pages >= max_pages:
+                        logging.warning('Resync of %s stops after %d pages, older messages are skipped',
+                                        gm.myself.id, listed_pages)
+                        token = None
+                    in_flight.append((pool.submit(gm.get_messages, dedup.SEEN.unseen(gm.myself.id, ids)), token))
+                    if not token:
+                        listing = False
+                if not in_flight:
+                    break
+                future, next_token = in_flight.popleft()
+                msgs = gm.label_rules().filter(future.result())
+                stats.pages += 1
+                if msgs:
+                    stats.messages += len(msgs)
+                    yield msgs
+                    # Only once the caller has published the page
+                    dedup.SEEN.mark(gm.myself.id, msgs.keys())
+                state['pageToken'] = next_token
+                state['messages'] = state.get('messages', 0) + len(msgs)
+                state['pages'] = state.get('pages', 0) + 1
+                if next_token:
+                    _save(gm, state)
+                else:
+                    # All pages handled, hand over to incremental sync
+                    gm.uow.set_store(STATE, None)
+                    gm.checkpoint(state['historyId'])
+                    gm.uow.flush()
+    finally:
+        stats.seconds = time.time() - stats.started
+        logging.info('Resync of %s: %s', gm.myself.id, json.dumps(stats.as_dict()))
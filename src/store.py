@@ -0,0 +1,302 @@
+"""
+Unit of work for an actor's properties and internal store.
+
+actor.property reads and writes one DynamoDB item per attribute access. UnitOfWork loads the
+properties GMail needs with one BatchGetItem into the actor's property cache, keeps writes in
+memory and flushes them with one BatchWriteItem per table at the end of the request:
+
+    with store.UnitOfWork(myself) as uow:
+        gm = gmail.GMail(myself, config, auth, uow=uow)
+        ...
+
+Writes are discarded if the block raises, so e.g. historyId is never advanced past messages that
+were not published.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from src import metrics
+
+# Properties read by GMail, loaded in one go
+GMAIL_PROPERTIES = ('historyId', 'config')
+# Internal attributes live in this bucket (see actingweb.attribute.InternalStore)
+STORE_BUCKET = '_internal'
+# DynamoDB BatchWriteItem takes at most 25 items per call
+BATCH_WRITE_MAX = 25
+# Internal attribute changed on every property write, used for ETags (see src.conditional)
+VERSION = 'version'
+# Internal attributes shown by /meta, their writes change the version too
+META_STORE = ('trustee_root',)
+
+
+def new_version():
+    """ A new version stamp: microseconds since the epoch plus random bits, in hex. """
+    return '%x%04x' % (int(time.time() * 1000000), random.getrandbits(16))
+
+
+def version_time(version):
+    """ Epoch seconds a version stamp was made at, or None. """
+    try:
+        return int(version[:-4], 16) / 1000000.0
+    except (TypeError, ValueError):
+        return None
+
+
+def bump_version(config, actor_id, me=None):
+    """
+    Give the actor a new version stamp. Done after the writes it covers, so a reader never gets an
+    old stamp with new data (only new data with an old stamp, which just costs a full response).
+    """
+    model = config.DbAttribute.Attribute
+    version = new_version()
+    model(id=actor_id, bucket_name=STORE_BUCKET + ':' + VERSION, bucket=STORE_BUCKET, name=VERSION,
+          data=version).save()
+    if me is not None:
+        me.store.__dict__[VERSION] = version
+    return version
+
+
+def save_store(config, actor_id, values, me=None):
+    """ Write internal store attributes of an actor in one batch, outside of any unit of work. """
+    model = config.DbAttribute.Attribute
+    with model.batch_write() as batch:
+        for n, v in values.items():
+            batch.save(model(id=actor_id, bucket_name=STORE_BUCKET + ':' + n, bucket=STORE_BUCKET, name=n, data=v))
+    if me is not None:
+        me.store.__dict__.update(values)
+
+
+def _changed(config, actor_id):
+    if not actor_id:
+        return
+    try:
+        bump_version(config, actor_id)
+    except Exception as e:
+        logging.warning('Not able to update version of ' + str(actor_id) + ': ' + str(e))
+
+
+class _Module:
+    """ A datastore module of the config with some of its classes replaced. """
+
+    def __init__(self, module, **classes):
+        self._module = module
+        self.__dict__.update(classes)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def track_versions(config):
+    """
+    Change an actor's version on every write of a property or of an internal attribute shown by meta, made
+    by anything going through the actingweb datastore classes of config (actor.property, actor.store,
+    the actingweb handlers). UnitOfWork writes the models directly and changes the version in flush().
+    """
+    db_property = config.DbProperty
+    db_attribute = config.DbAttribute
+
+    class DbProperty(db_property.DbProperty):
+
+        def set(self, actor_id=None, name=None, value=None):
+            done = super().set(actor_id=actor_id, name=name, value=value)
+            # An empty value goes through delete()
+            if done and name and value:
+                _changed(config, actor_id)
+            return done
+
+        def delete(self):
+            actor_id = self.handle.id if self.handle else None
+            done = super().delete()
+            if done:
+                _changed(config, actor_id)
+            return done
+
+    class DbPropertyList(db_property.DbPropertyList):
+
+        def delete(self):
+            actor_id = self.actor_id
+            done = super().delete()
+            if done:
+                _changed(config, actor_id)
+            return done
+
+    class DbAttribute(db_attribute.DbAttribute):
+
+        @staticmethod
+        def set_attr(actor_id=None, bucket=None, name=None, data=None, timestamp=None):
+            done = db_attribute.DbAttribute.set_attr(actor_id=actor_id, bucket=bucket, name=name, data=data,
+                                                     timestamp=timestamp)
+            if done and bucket == STORE_BUCKET and name in META_STORE:
+                _changed(config, actor_id)
+            return done
+
+    config.DbProperty = _Module(db_property, DbProperty=DbProperty, DbPropertyList=DbPropertyList)
+    config.DbAttribute = _Module(db_attribute, DbAttribute=DbAttribute)
+    return config
+
+
+class UnitOfWork:
+
+    def __init__(self, me, defer=True):
+        """
+        :param me: actingweb actor
+        :param defer: If False, writes go straight to the datastore as before
+        """
+        self.me = me
+        self.config = me.config
+        self.defer = defer
+        self._props = {}
+        self._store = {}
+        self._after = []
+        self.ops = {'reads': 0, 'writes': 0, 'round_trips': 0}
+
+    def load(self, names=GMAIL_PROPERTIES):
+        """ Read the named properties not already cached on the actor in one round trip. """
+        cache = self.me.property.__dict__
+        missing = [n for n in names if n not in cache]
+        if not missing:
+            return
+        model = self.config.DbProperty.Property
+        for n in missing:
+            cache[n] = None
+        try:
+            for item in model.batch_get([(self.me.id, n) for n in missing], consistent_read=True):
+                cache[item.name] = item.value
+        except Exception as e:
+            logging.warning('Batch load of properties failed, falling back to single reads: ' + str(e))
+            for n in missing:
+                del cache[n]
+            return
+        self.ops['reads'] += len(missing)
+        self.ops['round_trips'] += 1
+
+    def set_property(self, name, value):
+        if not self.defer:
+            # The version changes with the write (see track_versions())
+            setattr(self.me.property, name, value)
+            self._count_write()
+            return
+        self.me.property.__dict__[name] = value
+        self._props[name] = value
+
+    def set_store(self, name, value):
+        if not self.defer:
+            setattr(self.me.store, name, value)
+            self._count_write()
+            return
+        if value is None:
+            self.me.store.__dict__.pop(name, None)
+        else:
+            self.me.store.__dict__[name] = value
+        self._store[name] = value
+
+    def after_flush(self, fn):
+        """
+        Call fn() once the writes made so far are in the datastore, e.g. to update an index that must agree
+        with them. Right away if writes are not deferred, never if the unit of work is discarded.
+        """
+        if not self.defer:
+            fn()
+            return
+        self._after.append(fn)
+
+    def _count_write(self):
+        self.ops['writes'] += 1
+        self.ops['round_trips'] += 1
+
+    def _bump(self):
+        try:
+            bump_version(self.config, self.me.id, me=self.me)
+        except Exception as e:
+            logging.warning('Not able to update version of ' + str(self.me.id) + ': ' + str(e))
+            return
+        self._count_write()
+
+    def dirty(self):
+        return bool(self._props or self._store)
+
+    @metrics.timed('store.flush')
+    def flush(self):
+        """ Write all dirty properties and store attributes, one batch write per table. """
+        changed = bool(self._props) or any(n in META_STORE for n in self._store)
+        if self._props:
+            model = self.config.DbProperty.Property
+            self._write(model, [
+                (model(self.me.id, n), v and model(id=self.me.id, name=n, value=v))
+                for n, v in self._props.items()])
+            self._props = {}
+        if self._store:
+            model = self.config.DbAttribute.Attribute
+            self._write(model, [
+                (model(self.me.id, STORE_BUCKET + ':' + n), v and model(
+                    id=self.me.id, bucket_name=STORE_BUCKET + ':' + n, bucket=STORE_BUCKET, name=n, data=v))
+                for n, v in self._store.items()])
+            self._store = {}
+        if changed:
+            self._bump()
+        after, self._after = self._after, []
+        for fn in after:
+            fn()
+        logging.debug('Datastore operations: %s', self.ops)
+
+    def _write(self, model, items):
+        with model.batch_write() as batch:
+            for key, item in items:
+                if item:
+                    batch.save(item)
+                else:
+                    batch.delete(key)
+        self.ops['writes'] += len(items)
+        self.ops['round_trips'] += (len(items) + BATCH_WRITE_MAX - 1) // BATCH_WRITE_MAX
+
+    def discard(self):
+        self._props = {}
+        self._store = {}
+        self._after = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.discard()
+        else:
+            self.flush()
+        return False
+
+
+class OpCounter:
+    """ Counts DynamoDB API calls made through the actingweb models, by operation name. """
+
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, model=None, **kwargs):
+        name = getattr(model, 'name', 'unknown')
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+
+@contextmanager
+def count_ops(config):
+    """ Count DynamoDB calls in the block, by hooking the botocore clients of the actingweb models. """
+    counter = OpCounter()
+    clients = []
+    for model in (config.DbProperty.Property, config.DbAttribute.Attribute):
+        client = model._get_connection().connection.client
+        if client not in clients:
+            clients.append(client)
+    for client in clients:
+        client.meta.events.register('before-call.dynamodb', counter)
+    try:
+        yield counter
+    finally:
+        for client in clients:
+            client.meta.events.unregister('before-call.dynamodb', counter)
@@ -0,0 +1,223 @@
+"""
+Access tokens for the Gmail calls, cached per actor and refreshed before they expire.
+
+actingweb's Auth.oauth_get()/oauth_post() only refresh an access token after a call with it has
+failed, which puts a failed call, a refresh and a retry in the middle of a push. GMail instead
+asks MANAGER.prepare(auth) before each call, which hands auth the newest token this process has
+for the actor and refreshes it first if less than TOKEN_MIN_TTL seconds are left. Only one
+refresh per actor runs at a time, concurrent requests wait for it and use its token.
+
+A background thread (started on first use and after a fork, uwsgi only) refreshes the tokens of
+actors active in the last TOKEN_ACTIVE seconds once they are within TOKEN_REFRESH_AHEAD seconds
+of expiry, so busy actors are never refreshed on the hot path. It is off by default on Lambda, which
+freezes the process between invocations, tokens are then only refreshed in prepare().
+"""
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from actingweb import oauth
+from src import store, metrics
+
+# Refresh in the background when less than this many seconds are left
+TOKEN_REFRESH_AHEAD = int(os.getenv('GMAIL_TOKEN_REFRESH_AHEAD', '600'))
+# Refresh before the call when less than this many seconds are left
+TOKEN_MIN_TTL = int(os.getenv('GMAIL_TOKEN_MIN_TTL', '60'))
+TOKEN_BACKGROUND = os.getenv('GMAIL_TOKEN_BACKGROUND', 'false' if os.getenv('AWS_LAMBDA_FUNCTION_NAME') else 'true'
+                             ).lower() == 'true'
+# Only actors used this recently are refreshed in the background
+TOKEN_ACTIVE = int(os.getenv('GMAIL_TOKEN_ACTIVE', '3600'))
+TOKEN_SWEEP = 30
+# Parallel refreshes in the background, for when many tokens come due together
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv('GMAIL_TOKEN_REFRESH_CONCURRENCY', '4'))
+# Seconds to wait before trying again after a failed refresh
+TOKEN_RETRY = 60
+
+
+def refresh_oauth(token):
+    """ Refresh token with the OAuth token endpoint, returns the token response or None. """
+    return oauth.OAuth(token=None, config=token.config).oauth_refresh_token(token.refresh_token)
+
+
+def persist(token, values):
+    """ Store a refreshed token the way actingweb's Auth does, so other processes pick it up. """
+    store.save_store(token.config, token.actor_id, values)
+
+
+class _Token:
+    __slots__ = ('actor_id', 'config', 'token', 'expiry', 'refresh_token', 'used', 'retry_at', 'lock')
+
+    def __init__(self, actor_id, config):
+        self.actor_id = actor_id
+        self.config = config
+        self.token = None
+        self.expiry = 0.0
+        self.refresh_token = None
+        self.used = 0.0
+        self.retry_at = 0.0
+        # Held while the token is refreshed, so there is one refresh per actor at a time
+        self.lock = threading.Lock()
+
+
+def _expiry(auth):
+    try:
+        return float(auth.expiry)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+
+    def __init__(self, refresh=refresh_oauth, save=persist, ahead=TOKEN_REFRESH_AHEAD, min_ttl=TOKEN_MIN_TTL,
+                 background=TOKEN_BACKGROUND, active=TOKEN_ACTIVE, sweep=TOKEN_SWEEP,
+                 concurrency=TOKEN_REFRESH_CONCURRENCY, max_actors=10000, name='gmail-tokens'):
+        self.refresh = refresh
+        self.save = save
+        self.ahead = ahead
+        self.min_ttl = min_ttl
+        self.background = background
+        self.active = active
+        self.sweep = sweep
+        self.concurrency = concurrency
+        self.max_actors = max_actors
+        self.name = name
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.stats = {'hits': 0, 'inline': 0, 'ahead': 0, 'reactive': 0, 'joined': 0, 'failed': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def prepare(self, auth):
+        """
+        Make sure auth carries a token valid for at least min_ttl more seconds, before a Gmail call.
+        Auth objects without an actor, refresh token or known expiry are left alone.
+        """
+        me = getattr(auth, 'actor', None)
+        expiry = _expiry(auth)
+        if not me or not getattr(auth, 'refresh_token', None) or expiry is None:
+            return
+        now = time.time()
+        with self._lock:
+            t = self._tokens.get(me.id)
+            if not t:
+                if len(self._tokens) >= self.max_actors:
+                    self._tokens.clear()
+                t = self._tokens[me.id] = _Token(me.id, auth.config)
+            if expiry > t.expiry:
+                # A token from the datastore or a refresh in another process
+                t.token, t.expiry, t.refresh_token = auth.token, expiry, auth.refresh_token
+            t.used = now
+        if t.expiry - now < self.min_ttl:
+            self._refresh(t, 'inline', self.min_ttl)
+        else:
+            self._count('hits')
+        if t.token and t.token != auth.token:
+            auth.token = t.token
+            auth.expiry = str(t.expiry)
+            auth.oauth.set_token(t.token)
+            me.store.__dict__.update({'oauth_token': t.token, 'oauth_token_expiry': auth.expiry})
+        if self.background:
+            self._ensure_started()
+
+    def fresh(self, auth):
+        """ True if prepare() has no refresh to do for auth, so it does not block on the network. """
+        me = getattr(auth, 'actor', None)
+        expiry = _expiry(auth)
+        if not me or not getattr(auth, 'refresh_token', None) or expiry is None:
+            return True
+        t = self._tokens.get(me.id)
+        return max(expiry, t.expiry if t else 0) - time.time() >= self.min_ttl
+
+    def observe(self, auth):
+        """ After a Gmail call: pick up a token actingweb refreshed itself because the call failed. """
+        me = getattr(auth, 'actor', None)
+        t = self._tokens.get(me.id) if me else None
+        if not t or not auth.token or auth.token == t.token:
+            return
+        expiry = _expiry(auth)
+        with t.lock:
+            # Else auth just has an older token than ours, it gets ours on the next prepare()
+            if not expiry or expiry <= t.expiry:
+                return
+            t.token, t.expiry, t.refresh_token = auth.token, expiry, auth.refresh_token
+        self._count('reactive')
+
+    def _refresh(self, t, reason, threshold):
+        with t.lock:
+            now = time.time()
+            if t.expiry - now >= threshold:
+                # Refreshed by another request while this one waited
+                self._count('joined')
+                return True
+            if t.retry_at > now:
+                return False
+            result = self.refresh(t)
+            if not result or not result.get('access_token'):
+                t.retry_at = now + TOKEN_RETRY
+                self._count('failed')
+                logging.warning('Not able to refresh token for ' + t.actor_id)
+                return False
+            now = time.time()
+            t.token = result['access_token']
+            t.expiry = now + float(result.get('expires_in') or 3600)
+            values = {'oauth_token': t.token, 'oauth_token_expiry': str(t.expiry)}
+            if result.get('refresh_token'):
+                t.refresh_token = result['refresh_token']
+                values['oauth_refresh_token'] = t.refresh_token
+                values['oauth_refresh_token_expiry'] = str(
+                    now + float(result.get('refresh_token_expires_in') or 365 * 24 * 3600))
+            try:
+                self.save(t, values)
+            except Exception as e:
+                logging.warning('Not able to store refreshed token for ' + t.actor_id + ': ' + str(e))
+        self._count(reason)
+        return True
+
+    def forget(self, actor_id):
+        with self._lock:
+            self._tokens.pop(actor_id, None)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep)
+            self.refresh_due()
+
+    def refresh_due(self):
+        """ Refresh the tokens of active actors that expire within ahead seconds, done by the background thread. """
+        now = time.time()
+        with self._lock:
+            due = [t for t in self._tokens.values()
+                   if now - t.used < self.active and t.expiry - now < self.ahead and t.retry_at <= now]
+            for k in [k for k, t in self._tokens.items() if now - t.used >= self.active and not t.lock.locked()]:
+                del self._tokens[k]
+        if due:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(due)))) as pool:
+                list(pool.map(self._refresh_ahead, due))
+        return len(due)
+
+    def _refresh_ahead(self, t):
+        try:
+            self._refresh(t, 'ahead', self.ahead)
+        except Exception as e:
+            logging.warning('Not able to refresh token for ' + t.actor_id + ': ' + str(e))
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self.stats, actors=len(self._tokens))
+
+
+MANAGER = TokenManager()
+metrics.collector('tokens', MANAGER.as_dict)
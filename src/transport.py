@@ -0,0 +1,192 @@
+"""
+Pooled HTTP transport for the Gmail REST calls.
+
+actingweb's OAuth helper opens a new connection (and TLS session) for every call. GMail sends its
+calls through TRANSPORT instead: one requests.Session per process with a pool of keep-alive
+connections per host, gzip responses (Google only compresses for user agents containing 'gzip')
+and separate connect and read timeouts. With GMAIL_HTTP2=true and httpx (with h2) installed, an
+httpx client multiplexes the calls over HTTP/2 instead.
+
+Set GMAIL_TRANSPORT=actingweb to go back to the actingweb helper for everything.
+"""
+import os
+import logging
+import threading
+from src import codec, metrics
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# 'pooled' or 'actingweb'
+GMAIL_TRANSPORT = os.getenv('GMAIL_TRANSPORT', 'pooled')
+# Keep-alive connections kept per host, should be at least GMAIL_FETCH_CONCURRENCY
+HTTP_POOL_SIZE = int(os.getenv('GMAIL_HTTP_POOL_SIZE', '16'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('GMAIL_HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('GMAIL_HTTP_READ_TIMEOUT', '30'))
+HTTP2 = os.getenv('GMAIL_HTTP2', 'false').lower() == 'true'
+USER_AGENT = 'actingweb-googlemail (gzip)'
+
+
+class GmailTransport:
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, http2=HTTP2, verify=True):
+        """ :param verify: True, or the path of a CA bundle (e.g. for a local TLS test server) """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        self.http2 = http2
+        if http2 and not httpx:
+            logging.warning('GMAIL_HTTP2 is set, but httpx is not installed, using HTTP/1.1')
+            self.http2 = False
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'gzip': 0, 'http2': 0}
+
+    def _session(self):
+        # A new pool after a fork, connections can not be shared between processes
+        if self._pid == os.getpid() and self._client:
+            return self._client
+        with self._lock:
+            if self._pid != os.getpid() or not self._client:
+                self._client = self._new_client()
+                self._pid = os.getpid()
+        return self._client
+
+    def _new_client(self):
+        headers = {'Accept-Encoding': 'gzip', 'User-Agent': USER_AGENT}
+        if self.http2:
+            return httpx.Client(http2=True, verify=self.verify, headers=headers,
+                                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                                limits=httpx.Limits(max_connections=self.pool_size,
+                                                    max_keepalive_connections=self.pool_size))
+        session = requests.Session()
+        session.headers.update(headers)
+        session.verify = self.verify
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method, url, token=None, data=None, headers=None):
+        """
+        One HTTP request over the pool.
+        :return: (status code, body bytes, content type), status code 0 if the request failed
+        """
+        headers = dict(headers or {})
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        client = self._session()
+        try:
+            if self.http2:
+                res = client.request(method, url, content=data, headers=headers)
+            else:
+                res = client.request(method, url, data=data, headers=headers, timeout=self.timeout,
+                                     verify=self.verify)
+            content = res.content
+        except Exception as e:
+            self._count('errors')
+            logging.warning('Gmail ' + method + ' ' + url.split('?')[0] + ' failed: ' + str(e))
+            return 0, b'', None
+        self._count('requests', gzip=res.headers.get('Content-Encoding') == 'gzip',
+                    http2=getattr(res, 'http_version', '') == 'HTTP/2')
+        return res.status_code, content, res.headers.get('Content-Type')
+
+    def stream(self, url, token, write, chunk_size=64 * 1024):
+        """
+        A GET whose (decompressed) body is passed to write() in chunks as it arrives, instead of being read
+        into memory first. A failed call passes nothing to write().
+        :return: Status code, 0 if the request failed
+        """
+        headers = {'Authorization': 'Bearer ' + token}
+        client = self._session()
+        try:
+            if self.http2:
+                with client.stream('GET', url, headers=headers) as res:
+                    if 200 <= res.status_code <= 299:
+                        for chunk in res.iter_bytes(chunk_size):
+                            write(chunk)
+            else:
+                with client.get(url, headers=headers, timeout=self.timeout, verify=self.verify, stream=True) as res:
+                    if 200 <= res.status_code <= 299:
+                        for chunk in res.iter_content(chunk_size):
+                            write(chunk)
+        except Exception as e:
+            self._count('errors')
+            logging.warning('Gmail GET ' + url.split('?')[0] + ' failed: ' + str(e))
+            return 0
+        self._count('requests', gzip=res.headers.get('Content-Encoding') == 'gzip',
+                    http2=getattr(res, 'http_version', '') == 'HTTP/2')
+        if res.status_code < 200 or res.status_code > 299:
+            logging.info('Gmail GET ' + url.split('?')[0] + ' returned ' + str(res.status_code))
+        return res.status_code
+
+    def call(self, method, url, token, params=None):
+        """
+        A Gmail JSON call with the results of actingweb's Auth.oauth_get()/oauth_post().
+        :return: (status code, decoded body; {} for an empty success, None on failure)
+        """
+        data, headers = encode_params(params)
+        code, content, _ = self.request(method, url, token, data=data, headers=headers)
+        return decode_result(method, url, code, content)
+
+    def _count(self, key, gzip=False, http2=False):
+        with self._lock:
+            self._stats[key] += 1
+            self._stats['gzip'] += gzip
+            self._stats['http2'] += http2
+
+    def stats(self):
+        """ Requests and connections since start, reused is the share of requests on an existing connection. """
+        with self._lock:
+            out = dict(self._stats)
+        connections = None
+        client = self._client
+        if client is not None and not self.http2:
+            connections = 0
+            for adapter in set(client.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+        out['connections'] = connections
+        if connections is not None and out['requests']:
+            out['reused'] = round(1 - min(connections, out['requests']) / out['requests'], 3)
+        return out
+
+
+def encode_params(params):
+    """ Body and headers for the json params of a Gmail call, (None, None) without params. """
+    if not params:
+        return None, None
+    return codec.dumps(params).encode('utf-8'), {'Content-Type': 'application/json'}
+
+
+def decode_result(method, url, code, content):
+    """ (status code, decoded body) of a Gmail call, see GmailTransport.call(). """
+    if code < 200 or code > 299:
+        if code:
+            logging.info('Gmail ' + method + ' ' + url.split('?')[0] + ' returned ' + str(code))
+        return code, None
+    if not content:
+        return code, {}
+    try:
+        return code, codec.loads(content)
+    except ValueError:
+        return code, None
+
+
+TRANSPORT = GmailTransport() if GMAIL_TRANSPORT == 'pooled' and requests else None
+if GMAIL_TRANSPORT == 'pooled' and not requests:
+    logging.warning('requests is not installed, Gmail calls go through the actingweb OAuth helper')
+if TRANSPORT:
+    metrics.collector('transport', TRANSPORT.stats)
@@ -0,0 +1,101 @@
+"""
+Index of Gmail watches ordered by expiry, so actors due for renewal can be found with one query
+instead of scanning every actor. Stored in its own DynamoDB table next to the actingweb tables.
+"""
+import os
+import logging
+import time
+from pynamodb.models import Model
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.exceptions import PynamoDBException
+
+# All entries share one partition, the range key sorts them by expiry
+PARTITION = 'watch'
+# Bookkeeping of the index itself, e.g. when it was last rebuilt from all actors
+META = 'meta'
+REBUILT = 'rebuilt'
+
+
+def expiry_seconds(expiry):
+    """ Gmail returns the watch expiration in epoch milliseconds, return it in seconds (or None). """
+    if not expiry:
+        return None
+    expiry = int(expiry)
+    if expiry > 10 ** 11:
+        return expiry // 1000
+    return expiry
+
+
+def _key(expiry, actor_id):
+    return '%012d:%s' % (expiry, actor_id)
+
+
+class WatchEntry(Model):
+    """
+       DynamoDB data model for a watch in the expiry index
+    """
+    class Meta(object):
+        table_name = os.getenv('AWS_DB_PREFIX', 'demo_actingweb') + "_watches"
+        read_capacity_units = 2
+        write_capacity_units = 1
+        region = os.getenv('AWS_DEFAULT_REGION', 'us-west-1')
+        host = os.getenv('AWS_DB_HOST', None)
+
+    partition = UnicodeAttribute(hash_key=True)
+    expiry_actor = UnicodeAttribute(range_key=True)
+    actor_id = UnicodeAttribute()
+    expiry = NumberAttribute()
+
+
+_table_checked = False
+
+
+def _ensure_table():
+    global _table_checked
+    if not _table_checked:
+        if not WatchEntry.exists():
+            WatchEntry.create_table(wait=True)
+        _table_checked = True
+
+
+def update(actor_id, old_expiry=None, new_expiry=None):
+    """ Move an actor's entry from old_expiry to new_expiry (either may be None). """
+    old_expiry = expiry_seconds(old_expiry)
+    new_expiry = expiry_seconds(new_expiry)
+    if not actor_id or old_expiry == new_expiry:
+        return
+    try:
+        _ensure_table()
+        with WatchEntry.batch_write() as batch:
+            if old_expiry:
+                batch.delete(WatchEntry(PARTITION, _key(old_expiry, actor_id)))
+            if new_expiry:
+                batch.save(WatchEntry(PARTITION, _key(new_expiry, actor_id), actor_id=actor_id,
+                                      expiry=new_expiry))
+    except PynamoDBException as e:
+        logging.warning('Not able to update watch index for ' + actor_id + ': ' + str(e))
+
+
+def due(window=24 * 3600, now=None):
+    """
+    Watches expiring before now + window, soonest first.
+    :return: List of (actor_id, expiry in epoch seconds)
+    """
+    now = now or time.time()
+    _ensure_table()
+    return [(e.actor_id, int(e.expiry)) for e in WatchEntry.query(
+        PARTITION, WatchEntry.expiry_actor < _key(int(now + window) + 1, ''))]
+
+
+def rebuilt():
+    """ When the index was last rebuilt from all actors (epoch seconds), None if never. """
+    _ensure_table()
+    try:
+        return int(WatchEntry.get(META, REBUILT).expiry)
+    except WatchEntry.DoesNotExist:
+        return None
+
+
+def set_rebuilt(now=None):
+    _ensure_table()
+    WatchEntry(META, REBUILT, actor_id='', expiry=int(now or time.time())).save()
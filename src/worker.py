@@ -0,0 +1,104 @@
+import os
+import logging
+import threading
+import time
+
+
+class CoalescingQueue:
+    """
+    In-process work queue keyed by actor id. Pending items for the same key are collapsed into one,
+    keeping the highest value, and a key is never processed by two workers at the same time.
+
+    Threads are started on first submit() (and restarted after a fork), so it is safe to create the
+    queue at import time under uwsgi. Not usable on Lambda, where the process is frozen between requests.
+    """
+
+    def __init__(self, handler, workers=1, name='worker'):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.name = name
+        self._pending = {}
+        self._order = []
+        self._running = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.processed = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+            return
+        self._pid = os.getpid()
+        self._threads = []
+        for n in range(self.workers):
+            t = threading.Thread(target=self._run, name=self.name + '-' + str(n), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, value, context=None):
+        """ Queue value for key, returns True if it was merged with an already pending item. """
+        with self._cond:
+            self._ensure_started()
+            self.submitted += 1
+            old = self._pending.get(key)
+            if old:
+                self.coalesced += 1
+                self._pending[key] = (max(old[0], value), context)
+                return True
+            self._pending[key] = (value, context)
+            self._order.append(key)
+            self._cond.notify()
+            return False
+
+    def _next(self):
+        for key in self._order:
+            if key not in self._running:
+                self._order.remove(key)
+                self._running.add(key)
+                return key, self._pending.pop(key)
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key, item = self._next()
+                while key is None:
+                    self._cond.wait()
+                    key, item = self._next()
+            try:
+                self.handler(key, item[0], item[1])
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.warning('Worker ' + self.name + ' failed on ' + str(key) + ': ' + str(e))
+            finally:
+                with self._cond:
+                    self._running.discard(key)
+                    self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending) + len(self._running)
+
+    def drain(self, timeout=None):
+        """ Wait until nothing is pending or running, returns False on timeout. """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._running:
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'processed': self.processed,
+            'failed': self.failed,
+            'pending': self.pending(),
+        }
@@ -0,0 +1,56 @@
+"""
+DynamoDB is mocked with moto, Gmail is bench.fake_gmail on a local port.
+
+    pip install pytest moto
+    python -m pytest tests
+"""
+import os
+
+# Before anything creates a boto client
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-1')
+
+import pytest
+from moto import mock_aws
+
+from bench.fake_gmail import FakeGmailServer
+
+
+@pytest.fixture
+def config():
+    """ The app's actingweb config with empty actor, property and attribute tables. """
+    with mock_aws():
+        import application
+        config = application.get_config()
+        for model in (config.DbActor.Actor, config.DbProperty.Property, config.DbAttribute.Attribute):
+            model.create_table(wait=True, read_capacity_units=1, write_capacity_units=1)
+        yield config
+
+
+@pytest.fixture
+def me(config):
+    from actingweb import actor
+    myself = actor.Actor(config=config)
+    myself.create(url=config.root, creator='test@example.com', passphrase='test')
+    return myself
+
+
+@pytest.fixture
+def gmail_server():
+    server = FakeGmailServer(messages=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def gm(gmail_server, monkeypatch):
+    """ A GMail for a bench.common.FakeActor, reading history from gmail_server two messages per page. """
+    from bench.common import gmail_for
+    from src import dedup, gmail
+    # gmail_for() points these at the fake server
+    monkeypatch.setattr(gmail, 'GMAIL_URL', gmail.GMAIL_URL)
+    monkeypatch.setattr(gmail, 'GMAIL_BATCH_URL', gmail.GMAIL_BATCH_URL)
+    monkeypatch.setattr(dedup, 'SEEN', dedup.SeenIndex())
+    gmail_server.mailbox.page_size = 2
+    return gmail_for(gmail_server)
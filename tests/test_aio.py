@@ -0,0 +1,28 @@
+import asyncio
+
+from bench.common import gmail_for
+from src import aio, codec
+
+
+def test_async_history_matches_sync(gm, gmail_server):
+    start = gm.history_id
+    gmail_server.mailbox.deliver(5)
+    sync = gm.get_history()
+    assert len(sync) == 5
+    again = gmail_for(gmail_server, historyId=str(start))
+    # Already published by gm
+    assert asyncio.run(aio.AsyncGMail(again).get_history()) == {}
+    assert again.history_id == gm.history_id
+    gmail_server.mailbox.deliver(3)
+    pages = []
+
+    async def walk():
+        async for page in aio.AsyncGMail(again).iter_sync(gmail_server.mailbox.history_id):
+            pages.append(page)
+
+    asyncio.run(walk())
+    assert [len(p) for p in pages] == [2, 1]
+    assert again.history_id == gmail_server.mailbox.history_id
+    # The same messages as the sync path fetches
+    ids = [i for page in pages for i in page]
+    assert codec.dumps({i: m for page in pages for i, m in page.items()}) == codec.dumps(gm.get_messages(ids))
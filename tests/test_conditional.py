@@ -0,0 +1,71 @@
+import base64
+import json
+
+import pytest
+from actingweb import actor
+
+from src import store
+
+AUTH = {'Authorization': 'Basic ' + base64.b64encode(b'test@example.com:test').decode('utf-8')}
+
+
+@pytest.fixture
+def client(config):
+    import application
+    return application.app.test_client()
+
+
+def get(client, path, tag=None):
+    headers = dict(AUTH)
+    if tag:
+        headers['If-None-Match'] = tag
+    return client.get(path, headers=headers)
+
+
+def test_not_modified_until_a_property_changes(me, client):
+    me.property.config = json.dumps({'a': 1})
+    path = '/' + me.id + '/properties'
+    r = get(client, path)
+    tag = r.headers['ETag']
+    assert r.status_code == 200 and json.loads(r.data)['config'] == {'a': 1}
+    r = get(client, path, tag)
+    assert r.status_code == 304 and r.headers['ETag'] == tag and not r.data
+    # Through the actingweb handler
+    assert client.put(path + '/config', data=json.dumps({'a': 2}), headers=AUTH).status_code < 300
+    r = get(client, path, tag)
+    assert r.status_code == 200 and json.loads(r.data)['config'] == {'a': 2}
+    tag = r.headers['ETag']
+    # Outside of any request, as the push path does
+    actor.Actor(me.id, config=me.config).property.config = None
+    r = get(client, path, tag)
+    assert r.status_code != 304 and r.headers.get('ETag') != tag
+
+
+def test_unit_of_work_changes_the_tag(me, client):
+    path = '/' + me.id + '/properties/historyId'
+    with store.UnitOfWork(me) as uow:
+        uow.set_property('historyId', '1')
+    tag = get(client, path).headers['ETag']
+    with store.UnitOfWork(actor.Actor(me.id, config=me.config)) as uow:
+        uow.set_property('historyId', '2')
+    r = get(client, path, tag)
+    assert r.status_code == 200 and r.data == b'2'
+
+
+def test_meta_changes_with_trustee_root(me, client):
+    path = '/' + me.id + '/meta/trustee_root'
+    me.property.config = '{}'
+    tag = get(client, path).headers['ETag']
+    assert get(client, path, tag).status_code == 304
+    actor.Actor(me.id, config=me.config).store.trustee_root = 'https://trustee.example.com/'
+    r = get(client, path, tag)
+    assert r.status_code == 200 and r.data == b'https://trustee.example.com/'
+
+
+def test_wrong_credentials_get_no_304(me, client):
+    me.property.config = '{}'
+    path = '/' + me.id + '/properties'
+    tag = get(client, path).headers['ETag']
+    r = client.get(path, headers={'If-None-Match': tag, 'Authorization': 'Basic ' + base64.b64encode(
+        b'test@example.com:wrong').decode('utf-8')})
+    assert r.status_code in (401, 403)
@@ -0,0 +1,51 @@
+import pytest
+
+from src import dedup
+
+
+def test_watermarks():
+    marks = dedup.Watermarks(max_actors=2)
+    assert not marks.is_stale('a', 10)
+    marks.advance('a', '10')
+    marks.advance('a', 5)
+    assert marks.is_stale('a', 10) and marks.is_stale('a', 9)
+    assert not marks.is_stale('a', 11)
+    marks.advance('b', 1)
+    marks.advance('c', 1)
+    # 'a' is the least recently advanced
+    assert not marks.is_stale('a', 1)
+    marks.forget('c')
+    assert not marks.is_stale('c', 1)
+    assert marks.stats() == {'duplicates': 2, 'passed': 4}
+
+
+def test_seen_index_is_bounded():
+    seen = dedup.SeenIndex(max_actors=2, max_messages=2)
+    seen.mark('a', ['1', '2', '3'])
+    assert seen.unseen('a', ['1', '2', '3', '4']) == ['1', '4']
+    seen.mark('b', ['1'])
+    seen.mark('c', ['1'])
+    assert seen.unseen('a', ['2']) == ['2']
+    assert seen.skipped == 2
+
+
+def test_published_messages_are_skipped(gm, gmail_server):
+    gmail_server.mailbox.deliver(2)
+    first = gm.get_history()
+    assert len(first) == 2
+    # A redelivered push for the same range fetches nothing
+    gm.history_id = gmail_server.mailbox.first_history_id
+    assert gm.get_history() == {}
+    assert dedup.SEEN.skipped == len(first)
+
+
+def test_failed_publish_does_not_mark(gm, gmail_server):
+    start = gmail_server.mailbox.history_id
+    gmail_server.mailbox.deliver(2)
+    with pytest.raises(RuntimeError):
+        for _ in gm.iter_history():
+            raise RuntimeError('publish failed')
+    assert gm.myself.property.historyId == str(start)
+    # The redelivered push fetches and publishes the same messages again
+    retried = next(gm.iter_history())
+    assert list(retried) == [m for m in gmail_server.mailbox.order]
@@ -0,0 +1,179 @@
+"""
+The dispatcher for GMAIL_PUBSUB_MODE=shared. The tests marked emulator need the Pub/Sub emulator
+(docker-compose up -d pubsub, PUBSUB_EMULATOR_HOST=localhost:8085) and are skipped without it.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+import pytest
+from actingweb import actor
+
+from bench.common import gmail_for
+from src import dedup, dispatcher, gmail
+
+emulator = pytest.mark.skipif(not os.getenv('PUBSUB_EMULATOR_HOST'), reason='PUBSUB_EMULATOR_HOST is not set')
+
+
+class Message:
+    """ A pulled Pub/Sub message. """
+
+    def __init__(self, email, history_id):
+        self.data = json.dumps({'emailAddress': email, 'historyId': history_id}).encode('utf-8')
+        self.acked = 0
+        self.nacked = 0
+
+    def ack(self):
+        self.acked += 1
+
+    def nack(self):
+        self.nacked += 1
+
+
+class Process:
+    """ Records the notifications it gets, False for actors in missing, raises for actors in failing. """
+
+    def __init__(self, missing=(), failing=()):
+        self.calls = []
+        self.missing = set(missing)
+        self.failing = set(failing)
+        self._lock = threading.Lock()
+
+    def __call__(self, actor_id, history_id, config):
+        with self._lock:
+            self.calls.append((actor_id, history_id))
+        if actor_id in self.failing:
+            raise RuntimeError('Gmail is down')
+        if actor_id in self.missing:
+            return False
+        dedup.WATERMARKS.advance(actor_id, history_id)
+        return True
+
+
+@pytest.fixture(autouse=True)
+def watermarks(monkeypatch):
+    monkeypatch.setattr(dedup, 'WATERMARKS', dedup.Watermarks())
+
+
+def new_actor(config, email):
+    me = actor.Actor(config=config)
+    me.create(url=config.root, creator=email, passphrase='test')
+    return me
+
+
+def test_email_index_caches_hits_for_ttl(config):
+    me = new_actor(config, 'a@example.com')
+    index = dispatcher.EmailIndex(config, ttl=300)
+    assert index.lookup('a@example.com') == me.id
+    me.delete()
+    # Cached, the dispatcher finds out when processing fails
+    assert index.lookup('a@example.com') == me.id
+    index.forget('a@example.com')
+    assert index.lookup('a@example.com') is None
+
+
+def test_email_index_expires_and_does_not_cache_misses(config):
+    index = dispatcher.EmailIndex(config, ttl=0)
+    assert index.lookup('b@example.com') is None
+    me = new_actor(config, 'b@example.com')
+    assert index.lookup('b@example.com') == me.id
+    me.delete()
+    again = new_actor(config, 'b@example.com')
+    assert index.lookup('b@example.com') == again.id
+
+
+def test_notifications_are_grouped_per_actor_and_acked(config):
+    a = new_actor(config, 'a@example.com')
+    b = new_actor(config, 'b@example.com')
+    process = Process()
+    d = dispatcher.Dispatcher(config, process=process, workers=2)
+    msgs = [Message('a@example.com', 10), Message('a@example.com', 12), Message('b@example.com', 5),
+            Message('nobody@example.com', 1)]
+    bad = Message('a@example.com', 'x')
+    d.dispatch(msgs + [bad])
+    assert sorted(process.calls) == sorted([(a.id, 12), (b.id, 5)])
+    assert all(m.acked == 1 and not m.nacked for m in msgs + [bad])
+    assert d.stats()['actors_dispatched'] == 2 and d.stats()['unrouted'] == 1
+    # Already processed up to 12
+    d.dispatch([Message('a@example.com', 11)])
+    assert len(process.calls) == 2 and d.stats()['duplicates'] == 1
+
+
+def test_failed_processing_is_nacked(config):
+    a = new_actor(config, 'a@example.com')
+    d = dispatcher.Dispatcher(config, process=Process(failing=[a.id]))
+    msgs = [Message('a@example.com', 10), Message('a@example.com', 11)]
+    d.dispatch(msgs)
+    assert all(m.nacked == 1 and not m.acked for m in msgs)
+    assert d.stats()['failed'] == 1
+    # Not advanced, the redelivery is processed
+    assert not dedup.WATERMARKS.is_stale(a.id, 11)
+
+
+def test_deleted_actor_is_looked_up_again(config):
+    old = new_actor(config, 'a@example.com')
+    process = Process(missing=[old.id])
+    d = dispatcher.Dispatcher(config, process=process)
+    assert d.index.lookup('a@example.com') == old.id
+    old.delete()
+    new = new_actor(config, 'a@example.com')
+    msg = Message('a@example.com', 11)
+    d.dispatch([msg])
+    assert process.calls == [(old.id, 11), (new.id, 11)]
+    assert msg.acked == 1 and d.stats()['actors_dispatched'] == 1
+    assert d.index.lookup('a@example.com') == new.id
+
+
+def test_email_with_several_actors_is_not_routed(config):
+    new_actor(config, 'a@example.com')
+    new_actor(config, 'a@example.com')
+    process = Process()
+    d = dispatcher.Dispatcher(config, process=process)
+    msg = Message('a@example.com', 10)
+    d.dispatch([msg])
+    assert process.calls == [] and msg.acked == 1
+    assert d.stats()['unrouted'] == 1
+
+
+def test_shared_mode_uses_the_shared_topic(gmail_server, monkeypatch):
+    monkeypatch.setattr(gmail, 'GMAIL_URL', gmail.GMAIL_URL)
+    monkeypatch.setattr(gmail, 'GMAIL_BATCH_URL', gmail.GMAIL_BATCH_URL)
+    monkeypatch.setattr(gmail, 'GMAIL_PUBSUB_MODE', 'shared')
+    gm = gmail_for(gmail_server)
+    assert gm._create_pubsub(refresh=True)
+    assert gm.topic == gmail.GMAIL_SHARED_TOPIC
+    assert gm.subscription == gmail.GMAIL_SHARED_SUBSCRIPTION
+    assert gm.myself.store.pubsub_topic == gmail.GMAIL_SHARED_TOPIC
+    # Never deleted with one actor's watch
+    assert gm._delete_pubsub()
+
+
+@emulator
+def test_pulls_from_the_shared_subscription(config):
+    from src import pubsub_clients
+    name = uuid.uuid4().hex[:8]
+    topic = 'projects/' + gmail.GMAIL_PROJECT + '/topics/test-' + name
+    subscription = 'projects/' + gmail.GMAIL_PROJECT + '/subscriptions/test-' + name
+    subscriber = dispatcher.ensure_shared_pubsub(topic=topic, subscription=subscription)
+    # Again, as every dispatcher does on start
+    dispatcher.ensure_shared_pubsub(topic=topic, subscription=subscription)
+    a = new_actor(config, 'a@example.com')
+    process = Process()
+    d = dispatcher.Dispatcher(config, process=process, subscription=subscription, batch_size=10, batch_wait=0.1)
+    d.start(subscriber)
+    try:
+        publisher = pubsub_clients.publisher()
+        for history_id in (10, 11):
+            publisher.publish(topic, json.dumps({'emailAddress': 'a@example.com', 'historyId': history_id}).encode(
+                'utf-8')).result(timeout=10)
+        deadline = time.time() + 20
+        while time.time() < deadline and not dedup.WATERMARKS.is_stale(a.id, 11):
+            time.sleep(0.1)
+    finally:
+        d.stop()
+        subscriber.delete_subscription(request={'subscription': subscription})
+        pubsub_clients.publisher().delete_topic(request={'topic': topic})
+    assert dedup.WATERMARKS.is_stale(a.id, 11)
+    assert d.stats()['received'] == 2
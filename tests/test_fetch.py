@@ -0,0 +1,68 @@
+import pytest
+
+from bench.common import gmail_for
+from bench.fake_gmail import Mailbox
+from src import batch, codec, fetch, gmail
+
+
+class Bucket:
+    """ Records the quota units taken, never waits. """
+
+    def __init__(self):
+        self.taken = []
+
+    def acquire(self, units=1):
+        self.taken.append(units)
+        return 0.0
+
+
+@pytest.fixture
+def gm(gmail_server, monkeypatch):
+    monkeypatch.setattr(gmail, 'GMAIL_URL', gmail.GMAIL_URL)
+    monkeypatch.setattr(gmail, 'GMAIL_BATCH_URL', gmail.GMAIL_BATCH_URL)
+    gmail_server.mailbox.deliver(120)
+    return gmail_for(gmail_server)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    b = Bucket()
+    monkeypatch.setattr(fetch, 'bucket_for', lambda user, **kwargs: b)
+    return b
+
+
+def fetched(gm, mode, ids, monkeypatch):
+    monkeypatch.setattr(gmail, 'GMAIL_FETCH_MODE', mode)
+    msgs = gm.get_messages(ids)
+    assert list(msgs) == ids
+    return codec.dumps(msgs)
+
+
+def test_batch_matches_serial(gm, gmail_server, bucket, monkeypatch):
+    ids = [Mailbox.message_id(n) for n in range(120)] + ['ffffffffffffffff']
+    serial = fetched(gm, 'serial', ids, monkeypatch)
+    gmail_server.stats.reset()
+    assert fetched(gm, 'batch', ids, monkeypatch) == serial
+    stats = gmail_server.stats.as_dict()
+    # 121 parts in chunks of BATCH_MAX, the missing message once more on its own
+    assert stats['calls']['batch'] == 3
+    assert stats['batch_parts'] == 121
+    assert stats['calls']['messages.get'] == 121 + 1
+    units = fetch.QUOTA_UNITS['messages.get']
+    assert bucket.taken[:3] == [batch.BATCH_MAX * units, batch.BATCH_MAX * units, 21 * units]
+    assert max(bucket.taken) <= fetch.DEFAULT_RATE
+
+
+def test_concurrent_matches_serial(gm, bucket, monkeypatch):
+    ids = [Mailbox.message_id(n) for n in range(0, 120, 7)]
+    assert fetched(gm, 'concurrent', ids, monkeypatch) == fetched(gm, 'serial', ids, monkeypatch)
+
+
+def test_history_and_list_calls_are_charged(gm, gmail_server, bucket):
+    gmail_server.mailbox.expire_history()
+    # The 404 of history.list comes back with the call, not through the shared Auth object
+    gm.auth.oauth.last_response_code = 200
+    assert len(gm.get_history()) == 120
+    # The expired page, the resync's list page and the history since the resync
+    units = fetch.QUOTA_UNITS
+    assert bucket.taken == [units['history.list'], units['messages.list'], units['history.list']]
@@ -0,0 +1,26 @@
+from src import dedup
+
+
+def test_pages_are_checkpointed_and_marked_after_they_are_handled(gm, gmail_server):
+    start = gmail_server.mailbox.history_id
+    gmail_server.mailbox.deliver(4)
+    pages = gm.iter_history()
+    first = next(pages)
+    assert len(first) == 2
+    # Not handled yet
+    assert dedup.SEEN.unseen(gm.myself.id, first) == list(first)
+    assert gm.myself.property.historyId == str(start)
+    second = next(pages)
+    assert dedup.SEEN.unseen(gm.myself.id, first) == []
+    assert int(gm.myself.property.historyId) > start
+    assert list(pages) == []
+    assert dedup.SEEN.unseen(gm.myself.id, second) == []
+    assert gm.myself.property.historyId == str(gmail_server.mailbox.history_id)
+
+
+def test_sync_only_walks_history_for_newer_notifications(gm, gmail_server):
+    gmail_server.mailbox.deliver(3)
+    head = gmail_server.mailbox.history_id
+    assert len(gm.sync(head)) == 3
+    assert gm.sync(head) == {}
+    assert dedup.WATERMARKS.is_stale(gm.myself.id, head)
@@ -0,0 +1,75 @@
+import pytest
+from pynamodb.exceptions import PutError
+
+from src import msglog
+
+
+def messages(first, count):
+    return {'m%d' % n: {'id': 'm%d' % n} for n in range(first, first + count)}
+
+
+@pytest.fixture
+def log(me, monkeypatch):
+    monkeypatch.setattr(msglog, 'SEGMENT_SIZE', 3)
+    monkeypatch.setattr(msglog, 'LOG_MAX_SEGMENTS', 50)
+    return msglog.MessageLog(me.id, me.config)
+
+
+def segments(log):
+    return [int(s.name) for s in log.model.query(log.actor_id, log._range())]
+
+
+def test_append_and_read_in_pages(log):
+    assert log.append(messages(0, 4)) == (0, 3)
+    assert log.append(messages(4, 3)) == (4, 6)
+    assert log.append({}) is None
+    assert segments(log) == [0, 3, 6]
+    page = log.read(limit=5)
+    assert [m['message']['id'] for m in page['messages']] == ['m0', 'm1', 'm2', 'm3', 'm4']
+    assert page['cursor'] == '4' and page['more'] and not page['gap']
+    page = log.read(since=page['cursor'], limit=5)
+    assert [m['seq'] for m in page['messages']] == [5, 6]
+    assert page['cursor'] == '6' and not page['more']
+    assert log.read(since=6) == {'messages': [], 'cursor': '6', 'more': False, 'gap': False}
+
+
+def test_eviction_keeps_the_newest_segments(log, monkeypatch):
+    monkeypatch.setattr(msglog, 'LOG_MAX_SEGMENTS', 2)
+    log.append(messages(0, 12))
+    assert segments(log) == [6, 9]
+    assert log.stats['evicted'] == 2
+    page = log.read(since=1)
+    assert page['gap']
+    assert page['messages'][0]['seq'] == 6
+
+
+def test_eviction_by_age_never_drops_the_newest(log, monkeypatch):
+    monkeypatch.setattr(msglog, 'LOG_TTL', -1)
+    log.append(messages(0, 3))
+    log.append(messages(3, 1))
+    assert segments(log) == [3]
+    assert log.read()['messages'] == [{'seq': 3, 'message': {'id': 'm3'}}]
+
+
+def test_append_starts_over_after_a_concurrent_append(log, me):
+    log.append(messages(0, 1))
+    stale = log._tail()
+    msglog.MessageLog(me.id, me.config).append(messages(1, 1))
+    tails = iter([stale])
+    real_tail = log._tail
+    log._tail = lambda: next(tails, None) or real_tail()
+    assert log.append(messages(2, 1)) == (2, 2)
+    assert log.stats['conflicts'] == 1
+    assert [m['message']['id'] for m in log.read()['messages']] == ['m0', 'm1', 'm2']
+
+
+def test_append_raises_when_the_tail_keeps_changing(log, monkeypatch):
+    monkeypatch.setattr(msglog, 'APPEND_RETRIES', 2)
+    log.append(messages(0, 1))
+    stale = log._tail()
+    log.append(messages(1, 1))
+    log._tail = lambda: stale
+    with pytest.raises(PutError):
+        log.append(messages(2, 1))
+    assert log.stats['conflicts'] == 3
+    assert [m['message']['id'] for m in log.read()['messages']] == ['m0', 'm1']
@@ -0,0 +1,64 @@
+import time
+
+import pytest
+from actingweb import actor
+
+from bench.common import FakeAuth
+from src import gmail, renewal, store, watch_index
+
+
+@pytest.fixture
+def server(gmail_server, monkeypatch):
+    monkeypatch.setattr(gmail, 'GMAIL_URL', gmail_server.url + '/gmail/v1/users/')
+    monkeypatch.setattr(watch_index, '_table_checked', False)
+    return gmail_server
+
+
+def gmail_of(me, uow, history_id=None):
+    if history_id:
+        uow.set_property('historyId', str(history_id))
+    me.store.pubsub_topic = 'projects/test/topics/mail-' + me.id
+    return gmail.GMail(me, me.config, FakeAuth(), uow=uow)
+
+
+def indexed():
+    return [a for a, _ in watch_index.due(window=30 * 24 * 3600)]
+
+
+def test_renewed_watch_keeps_the_history_id(me, server):
+    start = server.mailbox.history_id
+    with store.UnitOfWork(me) as uow:
+        gm = gmail_of(me, uow, history_id=start)
+        server.mailbox.deliver(3)
+        assert gm.create_watch(refresh=True)
+        # Not indexed before the expiry is stored
+        assert indexed() == []
+    again = actor.Actor(me.id, config=me.config)
+    assert again.property.historyId == str(start)
+    assert again.store.watch_expiry
+    assert indexed() == [me.id]
+    # The next notification picks up the messages delivered before the watch was renewed
+    with store.UnitOfWork(again) as uow:
+        assert len(gmail_of(again, uow).sync(server.mailbox.history_id)) == 3
+
+
+def test_first_watch_sets_the_history_id(me, server):
+    with store.UnitOfWork(me) as uow:
+        assert gmail_of(me, uow).create_watch(refresh=True)
+    assert actor.Actor(me.id, config=me.config).property.historyId == str(server.mailbox.history_id)
+
+
+def test_failed_block_leaves_the_index_alone(me, server):
+    with pytest.raises(RuntimeError):
+        with store.UnitOfWork(me) as uow:
+            assert gmail_of(me, uow, history_id=1).create_watch(refresh=True)
+            raise RuntimeError('publish failed')
+    assert actor.Actor(me.id, config=me.config).store.watch_expiry is None
+    assert indexed() == []
+
+
+def test_scheduled_run_rebuilds_a_missing_index(me, server):
+    me.store.watch_expiry = str(int((time.time() + 24 * 3600) * 1000))
+    assert renewal.maybe_rebuild(me.config) == 1
+    assert indexed() == [me.id]
+    assert renewal.maybe_rebuild(me.config) is None
@@ -0,0 +1,72 @@
+import pytest
+from actingweb import actor
+
+from src import store
+
+
+def reload(me):
+    return actor.Actor(me.id, config=me.config)
+
+
+def test_flush_writes_properties_and_store_in_one_batch_each(me):
+    with store.UnitOfWork(me) as uow:
+        uow.set_property('historyId', '1234')
+        uow.set_property('config', '{}')
+        uow.set_store('watch_expiry', '99')
+        # Visible on the actor right away, written at the end of the block
+        assert me.property.historyId == '1234'
+        assert reload(me).property.historyId is None
+    assert uow.ops['writes'] == 4
+    # Properties, the version stamp and the store
+    assert uow.ops['round_trips'] == 3
+    again = reload(me)
+    assert again.property.historyId == '1234'
+    assert again.store.watch_expiry == '99'
+    assert again.store.version == me.store.__dict__[store.VERSION]
+
+
+def test_failed_block_writes_nothing(me):
+    with pytest.raises(RuntimeError):
+        with store.UnitOfWork(me) as uow:
+            uow.set_property('historyId', '1234')
+            uow.set_store('watch_expiry', '99')
+            raise RuntimeError('publish failed')
+    again = reload(me)
+    assert again.property.historyId is None
+    assert again.store.watch_expiry is None
+
+
+def test_none_deletes(me):
+    me.property.historyId = '1'
+    me.store.watch_expiry = '2'
+    with store.UnitOfWork(reload(me)) as uow:
+        uow.set_property('historyId', None)
+        uow.set_store('watch_expiry', None)
+    again = reload(me)
+    assert again.property.historyId is None
+    assert again.store.watch_expiry is None
+
+
+def test_load_reads_missing_properties_in_one_round_trip(me):
+    me.property.historyId = '42'
+    fresh = reload(me)
+    uow = store.UnitOfWork(fresh)
+    uow.load()
+    assert uow.ops == {'reads': 2, 'writes': 0, 'round_trips': 1}
+    assert fresh.property.__dict__['historyId'] == '42'
+    assert fresh.property.__dict__['config'] is None
+    uow.load()
+    assert uow.ops['round_trips'] == 1
+
+
+def test_property_writes_change_the_version(me):
+    with store.UnitOfWork(me) as uow:
+        uow.set_property('historyId', '1')
+    first = me.store.__dict__[store.VERSION]
+    with store.UnitOfWork(me) as uow:
+        uow.set_store('watch_expiry', '1')
+    assert me.store.__dict__[store.VERSION] == first
+    with store.UnitOfWork(me) as uow:
+        uow.set_property('historyId', '2')
+    assert me.store.__dict__[store.VERSION] != first
+    assert store.version_time(first) <= store.version_time(me.store.__dict__[store.VERSION])